@@ -5,9 +5,9 @@ import chatbot.llm_kg_retrieval as llm_kg_retrieval
 import os
 import re
 import json
-import requests
 import base64
 from dotenv import load_dotenv
+from data_pipeline.http_client import get_client
 
 # load secrets
 load_dotenv("../../config/config.env")
@@ -47,8 +47,8 @@ def display_pdf(doc_id, col):
 
     pdf_url = f"https://kungorelse.nykarleby.fi:8443/ktwebbin/ktproxy2.dll?doctype=3&docid={doc_id}"
 
-    # Send a GET request to the URL
-    response = requests.get(pdf_url)
+    # Send a GET request to the URL, repeated previews are served from the HTTP cache
+    response = get_client().get(pdf_url)
 
     # Ensure the request was successful
     response.raise_for_status()
@@ -0,0 +1,125 @@
+import json
+import os
+
+# Limits of a single input file of the OpenAI Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_FILE_SIZE_MB = 200
+
+
+def get_shards_path(batch_file_path):
+    """
+    Returns the path of the manifest listing the shards of a batch file.
+    """
+    return os.path.splitext(batch_file_path)[0] + "_shards.json"
+
+
+def get_shard_path(batch_file_path, index):
+    """
+    Returns the path of a shard of a batch file. The first shard is the batch file itself, the following ones
+    are numbered from 2, for example 'agenda_batch_2.jsonl'.
+    """
+    if index == 0:
+        return batch_file_path
+    base, extension = os.path.splitext(batch_file_path)
+    return f"{base}_{index + 1}{extension}"
+
+
+def get_batch_shards(batch_file_path):
+    """
+    Returns the paths of the shards of a batch file from its shard manifest. A batch file without a manifest,
+    for example one written before batch files were sharded, is a single shard.
+
+    Args:
+        batch_file_path (str): The path of the batch file.
+
+    Returns:
+        list: The paths of the shards, the first one being the batch file itself.
+    """
+    shards_path = get_shards_path(batch_file_path)
+    if not os.path.exists(shards_path):
+        return [batch_file_path]
+    with open(shards_path, 'r', encoding='utf-8') as file:
+        shards = json.load(file)["shards"]
+    # the shards are listed by file name, relative to the batch file
+    directory = os.path.dirname(batch_file_path)
+    return [os.path.join(directory, shard["file"]) for shard in shards]
+
+
+class BatchFileWriter:
+    """
+    Streaming writer of a batch file that keeps one file open and starts a new shard whenever the next task
+    would exceed the number of requests or the size allowed per batch input file. The shards are listed in
+    a manifest next to the batch file, see get_batch_shards, so that they can be submitted as separate jobs.
+    """
+
+    def __init__(self, batch_file_path, max_requests=None, max_bytes=None):
+        """
+        Args:
+            batch_file_path (str): The path of the batch file, which is also the path of the first shard.
+            max_requests (int): The maximum number of tasks per shard. Defaults to the environment variable MAX_BATCH_REQUESTS or 50 000.
+            max_bytes (int): The maximum size of a shard in bytes. Defaults to the environment variable MAX_BATCH_FILE_SIZE_MB or 200 MB.
+        """
+        self.batch_file_path = batch_file_path
+        self.max_requests = max_requests or int(os.getenv("MAX_BATCH_REQUESTS", MAX_BATCH_REQUESTS))
+        self.max_bytes = max_bytes or int(os.getenv("MAX_BATCH_FILE_SIZE_MB", MAX_BATCH_FILE_SIZE_MB)) * 1024**2
+        self.shards = []
+        self._file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Removes the shards of a previous batch file at the same path and opens the first shard.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.batch_file_path)), exist_ok=True)
+        for shard_path in get_batch_shards(self.batch_file_path)[1:]:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+        self.shards = []
+        self._open_shard()
+
+    def _open_shard(self):
+        if self._file:
+            self._file.close()
+        shard_path = get_shard_path(self.batch_file_path, len(self.shards))
+        self.shards.append({"file": os.path.basename(shard_path), "requests": 0, "bytes": 0})
+        self._file = open(shard_path, "wb")
+
+    def write(self, task):
+        """
+        Writes a task as a line of the current shard, starting a new shard if the current one is full.
+
+        Args:
+            task (dict): The batch task.
+
+        Raises:
+            ValueError: If the task alone is larger than max_bytes, the Batch API would reject any shard holding it.
+                Nothing is written then.
+        """
+        line = (json.dumps(task, indent=None, ensure_ascii=False) + '\n').encode('utf-8')
+        if len(line) > self.max_bytes:
+            raise ValueError(f"Batch task {task.get('custom_id')} is {len(line)} bytes, "
+                             f"larger than the {self.max_bytes} bytes allowed per batch file")
+        shard = self.shards[-1]
+        if shard["requests"] and (shard["requests"] >= self.max_requests or shard["bytes"] + len(line) > self.max_bytes):
+            self._open_shard()
+            shard = self.shards[-1]
+        self._file.write(line)
+        shard["requests"] += 1
+        shard["bytes"] += len(line)
+
+    def close(self):
+        """
+        Closes the current shard and saves the shard manifest.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        with open(get_shards_path(self.batch_file_path), "w", encoding="utf-8") as file:
+            json.dump({"shards": self.shards}, file, indent=4, ensure_ascii=False)
@@ -0,0 +1,290 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .utils import extract_doc_id
+
+
+def build_custom_id_index(filepaths):
+    """
+    Builds the index from the custom IDs of batch tasks to the filepaths of their documents, so that every
+    result is matched to its document with a lookup instead of extracting the ID of every filepath.
+
+    Args:
+        filepaths (list): The filepaths of the documents of the batch job.
+
+    Returns:
+        dict: The filepaths by custom ID. If several filepaths have the same ID, the first one is used.
+    """
+    index = {}
+    for filepath in filepaths:
+        index.setdefault(extract_doc_id(filepath), filepath)
+    return index
+
+
+def get_errors_path(batch_file_path):
+    """
+    Returns the path of the report of the batch results that could not be saved.
+    """
+    return os.path.splitext(batch_file_path)[0] + "_errors.jsonl"
+
+
+class BatchErrorReport:
+    """
+    JSONL report of the batch results that could not be saved, with the custom ID, the error and the original
+    output line of each. The report is only written if there are errors, a report of a previous run is removed.
+    """
+
+    def __init__(self, report_path=None):
+        """
+        Args:
+            report_path (str): The path of the report. If not provided, the errors are only counted.
+        """
+        self.report_path = report_path
+        self.count = 0
+        self._file = None
+        if report_path and os.path.exists(report_path):
+            os.remove(report_path)
+
+    def add(self, custom_id, error, line=None):
+        """
+        Adds an error to the report.
+
+        Args:
+            custom_id (str): The custom ID of the result, if known.
+            error (object): The error, for example the error object of the result or an exception.
+            line (str): The output line of the result.
+        """
+        self.count += 1
+        if not self.report_path:
+            return
+        if self._file is None:
+            self._file = open(self.report_path, "w", encoding="utf-8")
+        error = error if isinstance(error, (dict, list, str)) else repr(error)
+        self._file.write(json.dumps({"custom_id": custom_id, "error": error, "line": line}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def iter_batch_contents(output_lines, error_report):
+    """
+    Parses the output of a batch job line by line and yields the message contents of the successful results.
+    Lines that are not valid JSON, failed requests and responses without a message are added to the error report.
+
+    Args:
+        output_lines (str | iterable): The JSONL output of the batch job, or its lines.
+        error_report (BatchErrorReport): The report of the failed results.
+
+    Yields:
+        (str, str, str): The custom ID, the message content and the output line of each result.
+    """
+    if isinstance(output_lines, str):
+        output_lines = io.StringIO(output_lines)
+    for line in output_lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError as e:
+            error_report.add(None, f"Invalid JSON: {e}", line)
+            continue
+        custom_id = result.get("custom_id")
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code", 200) != 200:
+            error_report.add(custom_id, result.get("error") or response.get("body"), line)
+            continue
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            error_report.add(custom_id, "No message content in the response", line)
+            continue
+        yield custom_id, content, line
+
+
+def iter_batch_results(output_lines, filepaths_by_custom_id, error_report):
+    """
+    Yields the successful results of a batch job with the filepaths of their documents, see iter_batch_contents.
+    Results with an unknown custom ID are added to the error report too.
+
+    Args:
+        output_lines (str | iterable): The JSONL output of the batch job, or its lines.
+        filepaths_by_custom_id (dict): The index from custom IDs to filepaths, see build_custom_id_index.
+        error_report (BatchErrorReport): The report of the failed results.
+
+    Yields:
+        (str, str, str): The custom ID, the filepath and the message content of each result.
+    """
+    for custom_id, content, line in iter_batch_contents(output_lines, error_report):
+        filepath = filepaths_by_custom_id.get(custom_id)
+        if not filepath:
+            error_report.add(custom_id, "Filepath not found for custom ID", line)
+            continue
+        yield custom_id, filepath, content
+
+
+class BatchOutputIndex:
+    """
+    Index of the message contents of a batch output by custom ID, for joining the outputs of per-document side
+    jobs, such as the references, to the main results. Every output line is parsed once when it is added. The
+    contents are kept in a dict until they exceed max_memory_size, then they are moved to a temporary SQLite
+    table, so that large outputs are joined without holding them in memory.
+    """
+
+    def __init__(self, output_lines=None, max_memory_size=None):
+        """
+        Args:
+            output_lines (str | iterable): The JSONL output to add, see add_output.
+            max_memory_size (int): The total size of the contents in characters above which they are moved to SQLite.
+                Defaults to the environment variable BATCH_OUTPUT_MAX_MEMORY_MB or 256 MB.
+        """
+        self.max_memory_size = max_memory_size or int(os.getenv("BATCH_OUTPUT_MAX_MEMORY_MB", 256)) * 1024**2
+        self._contents = {}
+        self._size = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        if output_lines:
+            self.add_output(output_lines)
+
+    def __len__(self):
+        if self._connection is None:
+            return len(self._contents)
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM contents").fetchone()[0]
+
+    def add_output(self, output_lines):
+        """
+        Adds the successful results of a batch output. If a custom ID occurs several times, the first result is kept.
+
+        Args:
+            output_lines (str | iterable): The JSONL output of the batch job, or its lines.
+        """
+        for custom_id, content, _ in iter_batch_contents(output_lines, BatchErrorReport()):
+            if self._connection is None:
+                if custom_id not in self._contents:
+                    self._contents[custom_id] = content
+                    self._size += len(content)
+                if self._size > self.max_memory_size:
+                    self._move_to_sqlite()
+            else:
+                with self._lock:
+                    self._connection.execute(
+                        "INSERT OR IGNORE INTO contents (custom_id, content) VALUES (?, ?)", (custom_id, content))
+        if self._connection is not None:
+            with self._lock:
+                self._connection.commit()
+
+    def _move_to_sqlite(self):
+        # an empty database name is a temporary database on disk, removed when the connection is closed
+        connection = sqlite3.connect("", check_same_thread=False)
+        connection.execute("CREATE TABLE contents (custom_id TEXT PRIMARY KEY, content TEXT NOT NULL)")
+        connection.executemany("INSERT INTO contents (custom_id, content) VALUES (?, ?)", self._contents.items())
+        connection.commit()
+        self._connection = connection
+        self._contents = {}
+
+    def get(self, custom_id):
+        """
+        Returns the parsed message content of the result with the given custom ID.
+
+        Args:
+            custom_id (str): The custom ID.
+
+        Returns:
+            dict | None: The content, or None if the output has no result for the custom ID.
+        """
+        if self._connection is None:
+            content = self._contents.get(custom_id)
+        else:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT content FROM contents WHERE custom_id = ?", (custom_id,)).fetchone()
+            content = row[0] if row else None
+        return json.loads(content) if content is not None else None
+
+    def close(self):
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+
+
+def copy_lines(output_lines, file):
+    """
+    Yields the lines of a batch output and writes them to a file as they pass, to keep a copy of an output that
+    is streamed into the ingestion.
+
+    Args:
+        output_lines (str | iterable): The JSONL output of the batch job, or its lines.
+        file (file): The file the lines are written to.
+
+    Yields:
+        str: The lines of the output.
+    """
+    if isinstance(output_lines, str):
+        output_lines = io.StringIO(output_lines)
+    for line in output_lines:
+        file.write(line if line.endswith("\n") else line + "\n")
+        yield line
+
+
+def ingest_batch_output(output_lines, filepaths, save_result, error_report_path=None, max_workers=8, contents_path=None):
+    """
+    Saves the results of a batch job. The output is parsed line by line on the calling thread while the results
+    are saved by a pool of worker threads, with a bounded number of results in flight, so the output can be
+    streamed from an open file or any other iterator of lines and is never held in memory as a whole. Results
+    that cannot be parsed or saved are written to the error report instead of stopping the ingestion.
+
+    Args:
+        output_lines (str | iterable): The JSONL output of the batch job, or its lines, for example an open file.
+        filepaths (list): The filepaths of the documents of the batch job.
+        save_result (callable): Saves one result, called with the message content, the filepath and the custom ID.
+        error_report_path (str): The path of the error report, see BatchErrorReport.
+        max_workers (int): The number of worker threads (default is 8).
+        contents_path (str): The path of a file the message contents of the results are written to, one per line
+            in the order of the output. Defaults to None, in which case they are not written.
+
+    Returns:
+        (int, int): The number of saved results and the number of results that could not be saved.
+    """
+    error_report = BatchErrorReport(error_report_path)
+    contents_file = None
+    saved = 0
+    pending = {}
+
+    def collect(done):
+        nonlocal saved
+        for future in done:
+            custom_id = pending.pop(future)
+            if future.exception():
+                error_report.add(custom_id, future.exception())
+            else:
+                saved += 1
+
+    try:
+        if contents_path:
+            contents_file = open(contents_path, "w", encoding="utf-8")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for custom_id, filepath, content in iter_batch_results(output_lines, build_custom_id_index(filepaths), error_report):
+                if contents_file:
+                    contents_file.write(content + "\n")
+                if len(pending) >= max_workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(save_result, content, filepath, custom_id)] = custom_id
+            collect(wait(pending)[0])
+    finally:
+        error_report.close()
+        if contents_file:
+            contents_file.close()
+
+    print(f"Saved {saved} batch results.")
+    if error_report.count:
+        print(f"{error_report.count} batch results could not be saved" +
+              (f", see {error_report_path}" if error_report_path else "."))
+    return saved, error_report.count
@@ -0,0 +1,137 @@
+import os
+import time
+from .html_parser import parse_html, get_parser_backend, PARSER_BACKENDS
+from .file_converter import get_documents_filepaths, clean_html, remove_ids_from_tags
+
+
+def get_html_corpus(directory=None, depth=5, file_types=['.html', '.webhtml']):
+    """
+    Gets the filepaths of the stored HTML documents to benchmark with.
+
+    Args:
+        directory (str, optional): The directory to search. Defaults to the path in 'PROTOCOLS_PATH'.
+        depth (int, optional): The depth of recursion. Defaults to 5, which includes the attachments.
+        file_types (list, optional): List of file extensions to include. Defaults to ['.html', '.webhtml'].
+
+    Returns:
+        list: A list of filepaths of HTML documents.
+    """
+    directory = directory or os.getenv("PROTOCOLS_PATH")
+    if not directory or not os.path.exists(directory):
+        raise ValueError(f"Directory does not exist: {directory}")
+    return get_documents_filepaths(os.path.normpath(directory), depth=depth, file_types=file_types)
+
+
+def read_corpus(filepaths):
+    """
+    Reads the given files into memory so that disk access is not part of the measurements.
+    """
+    documents = []
+    for filepath in filepaths:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            documents.append(f.read())
+    return documents
+
+
+def check_parser_equivalence(filepaths, backends=PARSER_BACKENDS):
+    """
+    Checks that every parser backend builds the same tree as 'html.parser' for the given documents,
+    by comparing the serialized trees. The HTML normalization functions only operate on the parsed tree,
+    so identical trees give identical output for all of them.
+
+    Args:
+        filepaths (list): The filepaths of the HTML documents to check.
+        backends (list, optional): The backends to compare with 'html.parser'. Defaults to all backends.
+
+    Returns:
+        dict: The filepaths of the differing documents for each backend.
+    """
+    differences = {}
+    for backend in backends:
+        if backend == 'html.parser' or get_parser_backend(backend) != backend:
+            continue
+        differences[backend] = []
+        for filepath, document in zip(filepaths, read_corpus(filepaths)):
+            if str(parse_html(document, backend)) != str(parse_html(document, 'html.parser')):
+                differences[backend].append(filepath)
+        print(f"{backend}: {len(filepaths) - len(differences[backend])}/{len(filepaths)} documents identical to html.parser")
+    return differences
+
+
+def benchmark_parser_backends(filepaths, backends=PARSER_BACKENDS, repeat=3):
+    """
+    Measures the parsing throughput of each available parser backend on the given documents.
+
+    Args:
+        filepaths (list): The filepaths of the HTML documents to parse.
+        backends (list, optional): The backends to benchmark. Defaults to all backends.
+        repeat (int, optional): The number of times the documents are parsed, the best run is reported. Defaults to 3.
+
+    Returns:
+        dict: The pages parsed per second for each backend.
+    """
+    documents = read_corpus(filepaths)
+    results = {}
+    for backend in backends:
+        if get_parser_backend(backend) != backend:
+            print(f"{backend}: not installed, skipped")
+            continue
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for document in documents:
+                parse_html(document, backend)
+            best = min(best, time.perf_counter() - start)
+        results[backend] = len(documents) / best if best else float('inf')
+        print(f"{backend}: {results[backend]:.1f} pages/second")
+    return results
+
+
+def get_largest_documents(filepaths, count=20):
+    """
+    Returns the filepaths of the largest documents, largest first.
+    """
+    return sorted(filepaths, key=os.path.getsize, reverse=True)[:count]
+
+
+def benchmark_html_cleaning(filepaths, count=20, repeat=3):
+    """
+    Measures the throughput of clean_html and remove_ids_from_tags on the largest of the given documents,
+    and how their running time scales with the size of a document: every document is also processed doubled,
+    and a time ratio close to 2 means the function is linear in the size of the document, 4 quadratic.
+
+    Args:
+        filepaths (list): The filepaths of the HTML documents, for example from get_html_corpus.
+        count (int, optional): The number of largest documents to benchmark with. Defaults to 20.
+        repeat (int, optional): The number of times each document is processed, the best run is reported. Defaults to 3.
+
+    Returns:
+        dict: The characters processed per second and the median time ratio of the doubled documents for each function.
+    """
+    documents = read_corpus(get_largest_documents(filepaths, count))
+
+    def measure(function, document):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(document)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    results = {}
+    for function in [clean_html, remove_ids_from_tags]:
+        total_time = 0
+        ratios = []
+        for document in documents:
+            single = measure(function, document)
+            total_time += single
+            if single:
+                ratios.append(measure(function, document + document) / single)
+        ratios.sort()
+        results[function.__name__] = {
+            'chars_per_second': sum(map(len, documents)) / total_time if total_time else float('inf'),
+            'doubling_ratio': ratios[len(ratios) // 2] if ratios else None
+        }
+        print(f"{function.__name__}: {results[function.__name__]['chars_per_second']:.0f} chars/second, "
+              f"doubling ratio {results[function.__name__]['doubling_ratio'] or 0:.2f}")
+    return results
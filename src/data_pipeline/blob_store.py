@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Size of the chunks in which files are read for hashing
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(filepath):
+    """
+    Calculates the SHA-256 hash of a file, reading it in chunks.
+
+    Args:
+        filepath (str): The path of the file.
+
+    Returns:
+        str: The hex digest of the content of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class BlobStore:
+    """
+    Content-addressed store of downloaded documents. Every unique content is stored once under its SHA-256 hash
+    in the 'blobs' folder, and the per-document paths are hard links to the blobs, so that an attachment linked
+    from several agenda items takes disk space only once. The manifest 'manifest.json' maps every document path
+    to the hash of its content.
+    """
+
+    def __init__(self, store_path):
+        """
+        Args:
+            store_path (str): The directory of the store.
+        """
+        self.store_path = store_path
+        self.blobs_path = os.path.join(store_path, 'blobs')
+        self.manifest_path = os.path.join(store_path, 'manifest.json')
+        self._lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def get_blob_path(self, sha256):
+        """
+        Returns the path of the blob with the given hash.
+        """
+        return os.path.join(self.blobs_path, sha256[:2], sha256)
+
+    def _get_key(self, filepath):
+        # paths are stored relative to the store, so that the data folder can be moved as a whole
+        return os.path.relpath(os.path.abspath(filepath), os.path.abspath(self.store_path)).replace(os.sep, '/')
+
+    def get_hash(self, filepath):
+        """
+        Returns the hash of a document, from the manifest if the document is still linked to its blob
+        and by hashing the file otherwise.
+
+        Args:
+            filepath (str): The path of the document.
+
+        Returns:
+            str: The SHA-256 hash of the content of the document.
+        """
+        sha256 = self.manifest.get(self._get_key(filepath))
+        blob_path = self.get_blob_path(sha256) if sha256 else None
+        if blob_path and os.path.exists(blob_path) and os.path.samefile(filepath, blob_path):
+            return sha256
+        return hash_file(filepath)
+
+    def add(self, filepath):
+        """
+        Adds a document to the store. If a blob with the same content exists already, the document is replaced
+        by a hard link to it, otherwise the document becomes the blob. If hard links are not supported, the
+        blob is a copy of the document.
+
+        Args:
+            filepath (str): The path of the document.
+
+        Returns:
+            str: The SHA-256 hash of the content of the document.
+        """
+        sha256 = self.get_hash(filepath)
+        blob_path = self.get_blob_path(sha256)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                try:
+                    os.link(filepath, blob_path)
+                except OSError:
+                    shutil.copyfile(filepath, blob_path)
+            elif not os.path.samefile(filepath, blob_path):
+                # replace the duplicate with a link to the stored blob in a single rename
+                temp_path = f"{filepath}.{threading.get_ident()}.link"
+                try:
+                    os.link(blob_path, temp_path)
+                    os.replace(temp_path, filepath)
+                except OSError:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            self.manifest[self._get_key(filepath)] = sha256
+        return sha256
+
+    def save(self):
+        """
+        Saves the manifest of the store.
+        """
+        os.makedirs(self.store_path, exist_ok=True)
+        with self._lock:
+            with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, ensure_ascii=False, indent=0)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+
+def group_by_content(filepaths, blob_store=None):
+    """
+    Groups files with identical content, so that each unique content is processed only once.
+
+    Args:
+        filepaths (list): The paths of the files to group.
+        blob_store (BlobStore): The store whose manifest is used for the hashes of stored documents. If not provided, every file is hashed.
+
+    Returns:
+        dict: The paths of the files by the SHA-256 hash of their content, in the order of first appearance.
+    """
+    groups = {}
+    for filepath in filepaths:
+        sha256 = blob_store.get_hash(filepath) if blob_store else hash_file(filepath)
+        groups.setdefault(sha256, []).append(filepath)
+    return groups
+
+
+def get_blob_store():
+    """
+    Returns the blob store in the directory of the environment variable BLOB_STORE_PATH, or None if it is not set.
+    """
+    BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH")
+    return BlobStore(BLOB_STORE_PATH) if BLOB_STORE_PATH else None
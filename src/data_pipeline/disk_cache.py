@@ -0,0 +1,83 @@
+import os
+import threading
+
+
+class LRUDirectory:
+    """
+    Size bound of an on-disk cache directory. Every cache entry is a file with the entry suffix, and may have
+    companion files with the same name and other suffixes, which are removed with it but do not count towards
+    the size. The modification time of an entry is its last use, and the least recently used entries are
+    removed when the total size of the entries exceeds max_size.
+
+    The total size is listed from the directory once and then tracked from the changes reported with add, so
+    entries written by other processes are only accounted for when the directory is listed by a new instance.
+    """
+
+    def __init__(self, path, max_size, suffix, companion_suffixes=()):
+        """
+        Args:
+            path (str): The directory of the cache.
+            max_size (int): The maximum total size of the entries in bytes.
+            suffix (str): The suffix of the entry files, for example '.body'.
+            companion_suffixes (tuple): The suffixes of the files removed together with an entry, for example ('.json',).
+        """
+        self.path = path
+        self.max_size = max_size
+        self.suffix = suffix
+        self.companion_suffixes = companion_suffixes
+        self._lock = threading.Lock()
+        self._total_size = None
+
+    def touch(self, entry_path):
+        """
+        Marks an entry as recently used for the eviction.
+        """
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    def add(self, size_change):
+        """
+        Accounts for a written entry and evicts the least recently used entries if the cache is too large.
+
+        Args:
+            size_change (int): The size of the written entry minus the size of the entry it replaced.
+        """
+        with self._lock:
+            if self._total_size is not None:
+                self._total_size += size_change
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of the entries is below max_size.
+        """
+        with self._lock:
+            entries = None
+            if self._total_size is None:
+                entries = self._list_entries()
+                self._total_size = sum(size for _, size, _ in entries)
+            if self._total_size <= self.max_size:
+                return
+            if entries is None:
+                entries = self._list_entries()
+            for entry_path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+                if self._total_size <= self.max_size:
+                    break
+                base_path = entry_path[:-len(self.suffix)]
+                for path in [entry_path] + [base_path + suffix for suffix in self.companion_suffixes]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        # already removed, for example by another process
+                        pass
+                self._total_size -= size
+
+    def _list_entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
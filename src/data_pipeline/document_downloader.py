@@ -1,17 +1,55 @@
-import requests
 import os
-from urllib.parse import unquote
+import hashlib
+from urllib.parse import unquote, urlparse, parse_qs
 import re
 from tqdm import tqdm
 import json
-from bs4 import BeautifulSoup, Comment
-from .file_converter import add_ids_to_tags_
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from bs4 import Comment, Tag
+from .file_converter import TagIdStamper, STRUCTURAL_TAGS
+from .blob_store import get_blob_store
+from .download_state import DownloadState, apply_download_state, get_item_key, FAILED
+from .http_client import get_client, HostLimiter
+from .html_parser import parse_html
 from .utils import read_json_file, convert_file_path
 
 
+# Size of the chunks in which downloads are written to disk
+CHUNK_SIZE = 1024 * 1024
+
+
+
+def get_file_name_from_headers(headers):
+    """
+    Extracts the filename from the Content-Disposition header of a response.
+
+    Args:
+        headers (dict): The headers of the response.
+
+    Returns:
+        str: The filename, or None if the header has no filename.
+    """
+    cd = headers.get('content-disposition', '')
+    filename = re.findall('filename=(.+)', cd)
+
+    if filename:
+        # Decoding any URL encoded characters
+        return unquote(filename[0])
+    return None
+
+
 def get_file_name_from_url(url):
     """
-    Extracts the filename from the given URL.
+    Extracts the filename from the given URL with a HEAD request. The downloader takes the filename from
+    the response of the download itself instead, see download_named_file.
 
     Args:
         url (str): The URL to extract the filename from.
@@ -20,42 +58,266 @@ def get_file_name_from_url(url):
         str: The filename extracted from the URL.
     """
     try:
-        header = requests.head(url).headers
-
-        # Extract filename from Content-Disposition header
-        cd = header.get('content-disposition', '')
-        filename = re.findall('filename=(.+)', cd)
-
-        if filename:
-            # Decoding any URL encoded characters
-            return unquote(filename[0])
-        else:
-            return None
+        return get_file_name_from_headers(get_client().head(url).headers)
     except:
         return None
 
 
-def download_file(url, save_path):
+def get_doc_id(url):
+    """
+    Returns the document ID (the 'docid' query parameter) of a document URL, or the URL itself if it has none.
+    """
+    return parse_qs(urlparse(url).query).get('docid', [url])[0]
+
+
+def load_filename_map(filename_map_path):
+    """
+    Loads the map from document ID to filename saved by earlier downloads.
+
+    Args:
+        filename_map_path (str): The path to the JSON file of the map. If None, an empty map is returned.
+
+    Returns:
+        dict: The filenames by document ID.
+    """
+    if filename_map_path and os.path.exists(filename_map_path):
+        return read_json_file(filename_map_path) or {}
+    return {}
+
+
+def save_filename_map(filename_map, filename_map_path):
+    """
+    Saves the map from document ID to filename so that later runs know the filenames without any request.
+
+    Args:
+        filename_map (dict): The filenames by document ID.
+        filename_map_path (str): The path to the JSON file of the map. If None, nothing is saved.
+    """
+    if not filename_map_path:
+        return
+    os.makedirs(os.path.dirname(filename_map_path), exist_ok=True)
+    with open(filename_map_path, 'w', encoding="utf-8") as file:
+        json.dump(filename_map, file, ensure_ascii=False)
+
+
+def get_temp_file_path(url, temp_path):
+    """
+    Returns the path of the partial file of a download, keyed by the document ID of the URL.
+    """
+    doc_id = get_doc_id(url)
+    if doc_id == url:
+        doc_id = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(temp_path, f"{doc_id}.part")
+
+
+def get_lock_path(temp_file_path):
+    """
+    Returns the path of the lock file of a partial file.
+    """
+    return temp_file_path + '.lock'
+
+
+def lock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        return
+    file.seek(0)
+    while True:
+        try:
+            # gives up after 10 seconds, the lock is held for a whole download
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def unlock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def lock_temp_file(temp_file_path):
+    """
+    Holds the partial file of a download inside the block. The same URL can be downloaded by several workers at
+    the same time, for example an attachment of several documents, in this process or in other downloader
+    processes, and they would write to the same partial file. The lock is an exclusive OS lock on a lock file next
+    to the partial file, which is released if the process exits, and the lock file is removed with the lock held.
+    """
+    lock_path = get_lock_path(temp_file_path)
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    while True:
+        file = open(lock_path, 'a+b')
+        lock_file(file)
+        # the previous holder removes the lock file, a lock on the removed file does not exclude anyone
+        try:
+            if os.path.samestat(os.fstat(file.fileno()), os.stat(lock_path)):
+                break
+        except FileNotFoundError:
+            pass
+        file.close()
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            # Windows does not remove open files, the lock file is used again by the next download
+            pass
+        unlock_file(file)
+        file.close()
+
+
+def get_validator_path(temp_file_path):
+    """
+    Returns the path of the file with the validator (the ETag or Last-Modified header) of a partial file.
+    """
+    return temp_file_path + '.validator'
+
+
+def get_validator(headers):
+    """
+    Returns the validator of a response for an If-Range header: the ETag if it is a strong one, since weak
+    ETags cannot be used for ranges, otherwise the Last-Modified date, or None if the response has neither.
+    """
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def open_download(url, temp_file_path):
+    """
+    Sends a streamed GET request for a download. If a partial file of an interrupted download exists, only the
+    missing bytes are requested with a Range header, with an If-Range header holding the validator of the partial
+    file, so that the server sends the whole file instead if it has changed. A partial file without a validator
+    cannot be checked and is downloaded again from the beginning.
+
+    Args:
+        url (str): The URL of the file to download.
+        temp_file_path (str): The path of the partial file.
+
+    Returns:
+        requests.Response: The streamed response, with status 206 if the download is resumed.
+    """
+    offset = os.path.getsize(temp_file_path) if os.path.exists(temp_file_path) else 0
+    validator = None
+    if offset and os.path.exists(get_validator_path(temp_file_path)):
+        with open(get_validator_path(temp_file_path), 'r', encoding='utf-8') as f:
+            validator = f.read()
+    headers = {'Range': f"bytes={offset}-", 'If-Range': validator} if validator else {}
+    response = get_client().get(url, allow_redirects=True, stream=True, headers=headers)
+
+    # The partial file does not match the file on the server anymore, start again from the beginning
+    if validator and response.status_code == 416:
+        response.close()
+        os.remove(temp_file_path)
+        response = get_client().get(url, allow_redirects=True, stream=True)
+    response.raise_for_status()  # Raise an error for bad status codes
+    if response.status_code == 206 and not response.headers.get('content-range', '').startswith(f"bytes {offset}-"):
+        response.close()
+        raise ValueError(f"Unexpected Content-Range {response.headers.get('content-range')} for offset {offset}")
+    return response
+
+
+def write_download(response, temp_file_path):
+    """
+    Writes a streamed response to the partial file in chunks, so that the memory used does not depend on the
+    size of the file. A 206 Partial Content response is appended to the partial file. Any other response, for
+    example a 200 response to a resumed download of a file that has changed, replaces it, and its validator is
+    saved for resuming the partial file, see open_download.
+
+    Args:
+        response (requests.Response): The streamed response of open_download.
+        temp_file_path (str): The path of the partial file.
+    """
+    os.makedirs(os.path.dirname(temp_file_path), exist_ok=True)
+    if response.status_code == 206:
+        mode = 'ab'
+    else:
+        mode = 'wb'
+        validator = get_validator(response.headers)
+        if validator:
+            with open(get_validator_path(temp_file_path), 'w', encoding='utf-8') as f:
+                f.write(validator)
+        elif os.path.exists(get_validator_path(temp_file_path)):
+            os.remove(get_validator_path(temp_file_path))
+    with open(temp_file_path, mode) as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+
+
+def finish_download(temp_file_path, save_path):
+    """
+    Moves a completed partial file to its save path in a single rename, so the save path never holds a partial file.
+    """
+    # make dir is not exists
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    os.replace(temp_file_path, save_path)
+    if os.path.exists(get_validator_path(temp_file_path)):
+        os.remove(get_validator_path(temp_file_path))
+
+
+def download_named_file(url, get_save_path, temp_path):
+    """
+    Downloads a file with a single GET request whose filename is not known yet. The filename is taken from
+    the Content-Disposition header of the response while the body is streamed to a partial file, which is
+    moved to the save path for that filename when the download is complete. Interrupted downloads are resumed.
+
+    Args:
+        url (str): The URL of the file to download.
+        get_save_path (callable): Returns the path where the file will be saved for a given filename.
+        temp_path (str): The directory where the file is written while it is downloaded.
+
+    Returns:
+        (str, str): The filename and the save path of the file, or (None, None) if the download failed.
+    """
+    try:
+        temp_file_path = get_temp_file_path(url, temp_path)
+        with lock_temp_file(temp_file_path):
+            with open_download(url, temp_file_path) as response:
+                filename = get_file_name_from_headers(response.headers)
+                if not filename:
+                    print(f"Error: No filename in the response of {url}")
+                    return None, None
+
+                # The file is already downloaded, the body is not needed
+                save_path = get_save_path(filename)
+                if os.path.exists(save_path):
+                    return filename, save_path
+
+                write_download(response, temp_file_path)
+
+            finish_download(temp_file_path, save_path)
+        return filename, save_path
+    except Exception as e:
+        print(f"Error downloading {url}: {str(e)}")
+        return None, None
+
+
+def download_file(url, save_path, temp_path=None):
     """
-    Downloads a PDF file from the given URL and saves it in the given path
+    Downloads a PDF file from the given URL and saves it in the given path. The file is streamed to a partial
+    file in chunks and renamed to the save path when complete. Interrupted downloads are resumed.
 
     Args:
         url (str): The URL of the PDF file to download.
         save_path (str): The path where the file will be saved.
+        temp_path (str): The directory where the file is written while it is downloaded. Defaults to the directory of the save path.
 
     Returns:
         bool: True if the file was downloaded successfully, False otherwise.
     """
     try:
-        response = requests.get(url, allow_redirects=True)
-        response.raise_for_status()  # Raise an error for bad status codes
+        temp_file_path = get_temp_file_path(url, temp_path or os.path.dirname(save_path))
+        with lock_temp_file(temp_file_path):
+            with open_download(url, temp_file_path) as response:
+                write_download(response, temp_file_path)
 
-        # make dir is not exists
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-
-        # save the file
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
+            finish_download(temp_file_path, save_path)
         return True
     except Exception as e:
         print(f"Error downloading {url}: {str(e)}")
@@ -118,26 +380,88 @@ def get_attachment_save_path(parent_folder, filename):
     return save_path
 
 
-def save_scraped_data(count_downloaded, scraped_data, scraped_data_file_path):
+def save_scraped_data(scraped_data, scraped_data_file_path):
     """
-    Saves the scraped data to the specified file path.
+    Saves the scraped data to the specified file path. The file is replaced in a single rename, so it is never
+    left half written.
 
     Args:
-        count_downloaded (int): The number of documents that have been downloaded.
         scraped_data (dict): The scraped data to save.
         scraped_data_file_path (str): The file path to save the scraped data to.
     """
-    # Save the updated data to the same file after every 20 document,
-    # when the download is cancelled and resumed, we will not re-download the files
-    if count_downloaded % 20 == 0:
-        with open(scraped_data_file_path, 'w', encoding="utf-8") as file:
-            json.dump(scraped_data, file,
-                      ensure_ascii=False, indent=4)
-            
+    temp_file_path = f"{scraped_data_file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, 'w', encoding="utf-8") as file:
+        json.dump(scraped_data, file,
+                  ensure_ascii=False, indent=4)
+    os.replace(temp_file_path, scraped_data_file_path)
+
+
+def get_download_state_path(scraped_data_file_path):
+    """
+    Returns the default path of the download state database of a scraped data file.
+    """
+    return os.path.splitext(scraped_data_file_path)[0] + '_download_state.sqlite'
+
+
+def materialize_scraped_data(scraped_data_file_path, download_state_path=None):
+    """
+    Writes the file paths recorded in the download state into the scraped data file, for example after
+    a cancelled download run.
+
+    Args:
+        scraped_data_file_path (str): The path to the scraped data file.
+        download_state_path (str): The path to the download state database. Defaults to the path from get_download_state_path.
+
+    Returns:
+        scraped_data (dict): The scraped data with the file paths of the downloaded documents.
+    """
+    download_state = DownloadState(download_state_path or get_download_state_path(scraped_data_file_path))
+    scraped_data = apply_download_state(read_json_file(scraped_data_file_path), download_state)
+    download_state.close()
+    save_scraped_data(scraped_data, scraped_data_file_path)
+    return scraped_data
+
+
+def normalize_web_html(body_content):
+    """
+    Normalizes the body of a web HTML page in a single walk over the tree: removes the elements with
+    class 'paluu' (the back links), the comments and the attributes of all tags below the body, and collects
+    the structural tags, which get their ids in document order once the walk has removed everything else.
+
+    Args:
+        body_content (bs4.Tag): The body tag of the page, modified in place.
+
+    Returns:
+        bs4.Tag: The normalized body tag.
+    """
+    structural_tags = []
+    stack = list(reversed(body_content.contents))
+    while stack:
+        element = stack.pop()
+        if isinstance(element, Comment):
+            element.extract()
+        elif isinstance(element, Tag):
+            # Remove elements with class 'paluu'
+            if 'paluu' in element.get('class', []):
+                element.decompose()
+                continue
+            element.attrs = {}
+            if element.name in STRUCTURAL_TAGS:
+                structural_tags.append(element)
+            # visit the children next, in document order
+            stack.extend(reversed(element.contents))
+
+    # Add IDs to tags, content-derived ids depend on the text without the removed elements
+    stamper = TagIdStamper()
+    stamper.prepare(body_content)
+    for tag in structural_tags:
+        stamper.stamp(tag)
+    return body_content
+
 
 def download_html(html_link):
     """
-    Downloads an HTML file from the given URL and returns the content.
+    Downloads an HTML file from the given URL and returns the normalized body, see normalize_web_html.
 
     Args:
         html_link (str): The URL of the HTML file to download.
@@ -146,31 +470,16 @@ def download_html(html_link):
         str: The content of the downloaded HTML file, or None if an error occurs.
     """
     try:
-        response = requests.get(html_link)
+        response = get_client().get(html_link)
         response.raise_for_status()  # Raise an error for bad status codes
 
         # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = parse_html(response.content)
         body_content = soup.find('body')
 
         if body_content:
-            # Remove elements with class 'paluu'
-            for tag in body_content.find_all(class_='paluu'):
-                tag.decompose()
-
-            # remove all attributes from tags
-            for tag in body_content.find_all(True):
-                tag.attrs = {}
-
-            # remove all html comments
-            for comment in soup.findAll(text=lambda text: isinstance(text, Comment)):
-                comment.extract()
-
-            # Add IDs to tags
-            body_content = add_ids_to_tags_(body_content.prettify())
-
-            # Return the HTML string
-            return body_content
+            # Return the compact HTML string
+            return str(normalize_web_html(body_content))
         else:
             print(f"Error: <body> tag not found in {html_link}")
             return None
@@ -179,16 +488,31 @@ def download_html(html_link):
         return None
 
 
-def download_files(scraped_data, protocols_path, scraped_data_file_path, overwrite=True):
+def download_files(scraped_data, protocols_path, scraped_data_file_path, overwrite=True, max_workers=8, max_connections_per_host=4,
+                   filename_map_path=None, temp_path=None, blob_store=None, download_state_path=None):
     """
-    Downloads files from the provided scraped data and saves them in the specified directory, 
-    with multi-level tqdm progress bars.
+    Downloads files from the provided scraped data and saves them in the specified directory,
+    with a tqdm progress bar. Documents and attachments are downloaded concurrently by a bounded
+    pool of workers sharing the keep-alive connections of the shared HTTP client.
+
+    Every file costs a single GET request: the filename is taken from the response headers, and it is
+    remembered in a map from document ID to filename so that later runs do not need any request for
+    files that are already downloaded.
+
+    The state of every download is committed to a download state database as soon as the file is saved,
+    and the scraped data file is written once at the end, see materialize_scraped_data for cancelled runs.
 
     Args:
         scraped_data (dict): The scraped data in the form of a dictionary.
         protocols_path (str): The path to the directory where the PDFs will be saved.
         scraped_data_file_path (str): The path to the file where the scraped data is saved.
         overwrite (bool): Whether to overwrite existing files. Defaults to True.
+        max_workers (int): The maximum number of files downloaded at the same time. Defaults to 8.
+        max_connections_per_host (int): The maximum number of concurrent requests to a single host. Defaults to 4.
+        filename_map_path (str): The path to the JSON file of the document ID to filename map. Defaults to None, in which case the map is not saved.
+        temp_path (str): The directory for files that are being downloaded. Defaults to 'temp/downloads' next to the protocols directory.
+        blob_store (BlobStore): The content-addressed store that deduplicates the downloaded files. Defaults to None, in which case files are not deduplicated.
+        download_state_path (str): The path to the download state database. Defaults to the path from get_download_state_path.
 
     Returns:
         scraped_data (dict): The scraped data with the filenames of the downloaded PDFs added.
@@ -206,101 +530,154 @@ def download_files(scraped_data, protocols_path, scraped_data_file_path, overwri
                 for attachment in document['attachments']:
                     document_count += 1
 
-    # Iterate through the scraped data with tqdm for progress tracking
-    progress = tqdm(scraped_data, total=document_count,
+    if temp_path is None:
+        temp_path = os.path.join(os.path.dirname(os.path.normpath(protocols_path)), 'temp', 'downloads')
+    filename_map = load_filename_map(filename_map_path)
+    # resume from the downloads recorded by earlier runs
+    download_state = DownloadState(download_state_path or get_download_state_path(scraped_data_file_path))
+    apply_download_state(scraped_data, download_state)
+
+    progress = tqdm(total=document_count,
                     desc=f"Downloading files from {meeting_count} meetings")
-    for body in progress:
-        # Iterate through the meetings and protocols
-        for meeting in body['meetings']:
-            # Iterate through the documents and download the files
-            for document in meeting['documents']:
-                # get the link to the document
-                doc_link = document.get('doc_link', None)
-                # Skip if the file already exists
-                if not ('filepath' in document.keys() and os.path.exists(document['filepath'])):
-                    html_link = document.get('html_link', None)
-                    # get the filename from the link
-                    filename = get_file_name_from_url(doc_link)
-                    if filename:
-                        save_path = get_doc_save_path(
-                            protocols_path, body['body'], meeting['meeting_date'], document['section'], filename)
-                        save_path = os.path.normpath(
-                            os.path.join(save_path, filename))
-
-                        # Check if the file already exists and download it if it doesn't
-                        if not os.path.exists(save_path):
-                            is_download_successful = download_file(
-                                doc_link, save_path)
-                            # If the download was successful, update the file path in the scraped data
-                            if is_download_successful:
-                                document['filepath'] = save_path
-                        else:
-                            document['filepath'] = save_path
-                
-                        # update scraped data file with the filepath of downloaded file
-                        save_scraped_data(progress.n, scraped_data,
-                                          scraped_data_file_path)
-                    else:
-                        print(f"Error: Could not download file {doc_link}")
-                else:
-                    save_path = document['filepath']
-                # add the completed file to the progress bar
-                progress.update(1)
-
-                 # download the html file if it exists
-                if 'html_link' in document.keys() and os.path.exists(document['filepath']):
-                    html_link = document.get('html_link', None)
-                    html_save_path = convert_file_path(document['filepath'], 'webhtml')
-                    if html_link:
-                        if not os.path.exists(html_save_path) or overwrite:
-                            html_content = download_html(html_link)
-                            if html_content:
-                                with open(html_save_path, 'w', encoding="utf-8") as file:
-                                    file.write(html_content)
-                    progress.update(1)
-
-                # Iterate through the attachments and download the files
-                for attachment in document['attachments']:
-                    # Skip if the file already exists
-                    if not ('filepath' in attachment.keys() and os.path.exists(attachment['filepath'])):
-                        attachment_link = attachment['doc_link']
-                        # get the filename from the link
-                        attachment_filename = get_file_name_from_url(
-                            attachment_link)
-
-                        if attachment_filename:
-                            attachment_save_path = get_attachment_save_path(
-                                os.path.dirname(save_path), attachment_filename)
-                            attachment_save_path = os.path.normpath(os.path.join(
-                                attachment_save_path, attachment_filename))
-                            # Check if the file already exists and download it if it doesn't
-                            if not os.path.exists(attachment_save_path):
-                                is_download_successful = download_file(
-                                    attachment_link, attachment_save_path)
-                                # If the download was successful, update the file path in the scraped data
-                                if is_download_successful:
-                                    attachment['filepath'] = attachment_save_path
-                            else:
-                                attachment['filepath'] = attachment_save_path
-                            # update scraped data file
-                            save_scraped_data(progress.n, scraped_data,
-                                              scraped_data_file_path)
-                        else:
-                            print(
-                                f"Error: Could not download file {attachment_link}")
-                    progress.update(1)
-
-    # save the final scraped data, passing 20 as the count_downloaded as it is the minimum number of documents after which save is triggered
-    save_scraped_data(progress.n, scraped_data, scraped_data_file_path)
+    host_limiter = HostLimiter(max_connections_per_host)
+    # Guards the scraped data and the progress bar, which are shared by all workers
+    lock = threading.Lock()
+
+    def set_filepath(item, filepath):
+        with lock:
+            item['filepath'] = filepath
+
+    def update_progress():
+        with lock:
+            progress.update(1)
+
+    def download(url, get_save_path, item_key):
+        """
+        Downloads a file unless it already exists and returns its save path, or None if the download failed.
+        """
+        doc_id = get_doc_id(url)
+        filename = filename_map.get(doc_id)
+        with host_limiter.limit(url):
+            if filename:
+                # The filename is known from an earlier run
+                save_path = get_save_path(filename)
+                if not (os.path.exists(save_path) or download_file(url, save_path, temp_path)):
+                    save_path = None
+            else:
+                filename, save_path = download_named_file(url, get_save_path, temp_path)
+                if filename:
+                    with lock:
+                        filename_map[doc_id] = filename
+        if not save_path:
+            download_state.record(url, item_key, status=FAILED)
+            return None
+        # store duplicate files only once
+        sha256 = blob_store.add(save_path) if blob_store else None
+        download_state.record(url, item_key, save_path, sha256=sha256)
+        return save_path
+
+    def download_document(body_name, meeting, document):
+        """
+        Downloads a document and its web HTML and returns the attachment download jobs.
+        """
+        meeting_date = meeting['meeting_date']
+        # get the link to the document
+        doc_link = document.get('doc_link', None)
+        # Skip if the file already exists
+        if not ('filepath' in document.keys() and os.path.exists(document['filepath'])):
+            def get_save_path(filename):
+                save_path = get_doc_save_path(
+                    protocols_path, body_name, meeting_date, document['section'], filename)
+                return os.path.normpath(os.path.join(save_path, filename))
+
+            # If the download was successful, update the file path in the scraped data
+            save_path = download(doc_link, get_save_path, get_item_key(body_name, meeting, document))
+            if save_path:
+                set_filepath(document, save_path)
+                update_progress()
+            else:
+                print(f"Error: Could not download file {doc_link}")
+                update_progress()
+        else:
+            save_path = document['filepath']
+            update_progress()
+
+        # download the html file if it exists
+        if 'html_link' in document.keys():
+            html_link = document.get('html_link', None)
+            if html_link and document.get('filepath') and os.path.exists(document['filepath']):
+                html_save_path = convert_file_path(document['filepath'], 'webhtml')
+                if not os.path.exists(html_save_path) or overwrite:
+                    with host_limiter.limit(html_link):
+                        html_content = download_html(html_link)
+                    if html_content:
+                        with open(html_save_path, 'w', encoding="utf-8") as file:
+                            file.write(html_content)
+            update_progress()
+
+        # The attachments are saved in the folder of the document
+        if save_path is None:
+            for attachment in document['attachments']:
+                print(f"Error: Could not download attachment {attachment['doc_link']} of {doc_link}")
+                update_progress()
+            return []
+        return [(os.path.dirname(save_path), attachment, get_item_key(body_name, meeting, document, attachment))
+                for attachment in document['attachments']]
+
+    def download_attachment(parent_folder, attachment, item_key):
+        """
+        Downloads an attachment into the folder of its document.
+        """
+        # Skip if the file already exists
+        if not ('filepath' in attachment.keys() and os.path.exists(attachment['filepath'])):
+            attachment_link = attachment['doc_link']
+
+            def get_save_path(attachment_filename):
+                attachment_save_path = get_attachment_save_path(
+                    parent_folder, attachment_filename)
+                return os.path.normpath(os.path.join(
+                    attachment_save_path, attachment_filename))
+
+            # If the download was successful, update the file path in the scraped data
+            attachment_save_path = download(attachment_link, get_save_path, item_key)
+            if attachment_save_path:
+                set_filepath(attachment, attachment_save_path)
+                update_progress()
+                return
+            print(
+                f"Error: Could not download file {attachment_link}")
+        update_progress()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(download_document, body['body'], meeting, document)
+                   for body in scraped_data
+                   for meeting in body['meetings']
+                   for document in meeting['documents']}
+        # Queue the attachments of each document as soon as the folder of the document is known
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for parent_folder, attachment, item_key in future.result() or []:
+                    pending.add(executor.submit(download_attachment, parent_folder, attachment, item_key))
+
+    # save the final scraped data
+    save_scraped_data(scraped_data, scraped_data_file_path)
+    download_state.close()
+    save_filename_map(filename_map, filename_map_path)
+    if blob_store:
+        blob_store.save()
     progress.close()
     return scraped_data
 
 
-def main(overwrite=True):
+def main(overwrite=True, max_workers=8, max_connections_per_host=4):
 
     # Constants
     PROTOCOLS_PATH = os.getenv("PROTOCOLS_PATH")
     SCRAPED_DATA_FILE_PATH = os.getenv("SCRAPED_DATA_FILE_PATH")
+    DOC_FILENAMES_FILE_PATH = os.getenv("DOC_FILENAMES_FILE_PATH")
+    DOWNLOADS_TEMP_PATH = os.getenv("DOWNLOADS_TEMP_PATH")
+    DOWNLOAD_STATE_FILE_PATH = os.getenv("DOWNLOAD_STATE_FILE_PATH")
 
     # check if env variables is set and path exists
     if not PROTOCOLS_PATH:
@@ -319,7 +696,10 @@ def main(overwrite=True):
             f"Scraped data file is empty: {SCRAPED_DATA_FILE_PATH}")
 
     # download the files
-    download_files(scraped_data, PROTOCOLS_PATH, SCRAPED_DATA_FILE_PATH, overwrite=overwrite)
+    download_files(scraped_data, PROTOCOLS_PATH, SCRAPED_DATA_FILE_PATH, overwrite=overwrite,
+                   max_workers=max_workers, max_connections_per_host=max_connections_per_host,
+                   filename_map_path=DOC_FILENAMES_FILE_PATH, temp_path=DOWNLOADS_TEMP_PATH,
+                   blob_store=get_blob_store(), download_state_path=DOWNLOAD_STATE_FILE_PATH)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Statuses of a download
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+
+def get_item_key(body_name, meeting, document, attachment=None):
+    """
+    Returns the key of a document or an attachment by its place in the scraped data, so that a file linked from
+    several agenda items or meetings has a separate key, and a separate file, for each of them.
+
+    Args:
+        body_name (str): The name of the body of the meeting.
+        meeting (dict): The meeting.
+        document (dict): The document, or the document of the attachment.
+        attachment (dict): The attachment. Defaults to None for the key of the document itself.
+
+    Returns:
+        str: The body, the meeting reference (or the date if there is no reference), the section and the link of the
+            document, followed by the link of the attachment for attachments.
+    """
+    parts = [body_name, meeting.get('meeting_reference') or meeting['meeting_date'],
+             document.get('section') or '', document['doc_link']]
+    if attachment is not None:
+        parts.append(attachment['doc_link'])
+    return '|'.join(str(part) for part in parts)
+
+
+def iter_scraped_items(scraped_data):
+    """
+    Yields every document and attachment of the scraped data with its key, see get_item_key.
+
+    Args:
+        scraped_data (list): The scraped data.
+
+    Yields:
+        (str, dict): The key and the document or attachment.
+    """
+    for body in scraped_data:
+        for meeting in body['meetings']:
+            for document in meeting['documents']:
+                yield get_item_key(body['body'], meeting, document), document
+                for attachment in document['attachments']:
+                    yield get_item_key(body['body'], meeting, document, attachment), attachment
+
+
+class DownloadState:
+    """
+    Download state of every document and attachment (URL, file path, size, hash and status), keyed by the URL and
+    the place of the item in the scraped data, see get_item_key, and kept in a SQLite database.
+    Every download is committed on its own, so a checkpoint costs one row per file and a cancelled run loses
+    nothing. The database runs in WAL mode, so several downloader processes can record into it at the same time.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # the connection is shared by the download workers, the lock serializes its use
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(downloads)")]
+            if columns and 'item_key' not in columns:
+                # rows keyed by the URL only cannot be matched to their items, the files are found again
+                # through the filename map without downloading them
+                self._connection.execute("DROP TABLE downloads")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS downloads (
+                    url TEXT NOT NULL,
+                    item_key TEXT NOT NULL,
+                    filepath TEXT,
+                    size INTEGER,
+                    sha256 TEXT,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (url, item_key)
+                )""")
+
+    def record(self, url, item_key, filepath=None, sha256=None, status=DOWNLOADED):
+        """
+        Records the state of a download.
+
+        Args:
+            url (str): The URL of the document.
+            item_key (str): The key of the document or attachment in the scraped data, see get_item_key.
+            filepath (str): The path of the downloaded file.
+            sha256 (str): The SHA-256 hash of the content of the file, if known.
+            status (str): Either 'downloaded' or 'failed'. Defaults to 'downloaded'.
+        """
+        size = os.path.getsize(filepath) if filepath and os.path.exists(filepath) else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO downloads (url, item_key, filepath, size, sha256, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, item_key, filepath, size, sha256, status, time.time()))
+
+    def get_filepaths(self):
+        """
+        Returns the file paths of the downloaded documents.
+
+        Returns:
+            dict: The file paths by document URL and item key.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT url, item_key, filepath FROM downloads WHERE status = ?", (DOWNLOADED,)).fetchall()
+        return {(url, item_key): filepath for url, item_key, filepath in rows}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def apply_download_state(scraped_data, download_state):
+    """
+    Sets the file path of every document and attachment in the scraped data that has been downloaded for that
+    item and whose file still exists. A file downloaded for another item with the same link is not used.
+
+    Args:
+        scraped_data (dict): The scraped data.
+        download_state (DownloadState): The download state.
+
+    Returns:
+        scraped_data (dict): The scraped data with the file paths of the downloaded documents.
+    """
+    filepaths = download_state.get_filepaths()
+    for item_key, item in iter_scraped_items(scraped_data):
+        filepath = filepaths.get((item['doc_link'], item_key))
+        if filepath and os.path.exists(filepath):
+            item['filepath'] = filepath
+    return scraped_data
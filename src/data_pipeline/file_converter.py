@@ -4,35 +4,237 @@ from mammoth import convert_to_html
 import os
 from tqdm import tqdm
 import html
-from bs4 import BeautifulSoup
+import json
+import re
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import Comment, NavigableString, Tag
+from bs4.element import PreformattedString
+from .html_parser import parse_html, STRUCTURAL_TAGS
+from .blob_store import group_by_content, get_blob_store
+from .disk_cache import LRUDirectory
+
+# Version of the conversion output, increase it when a change to the conversion changes the output files
+CONVERTER_VERSION = 2
+
+# Matches the opening tags of structural tags, with the attributes in group 1
+STRUCTURAL_TAG_PATTERN = re.compile(
+    r'<(?:' + '|'.join(sorted(STRUCTURAL_TAGS, key=len, reverse=True)) + r')(\s[^>]*)?/?>', re.IGNORECASE)
+ID_ATTRIBUTE_PATTERN = re.compile(r'\sid\s*=', re.IGNORECASE)
+
+# Output types of convert_files and the extensions of their files
+OUTPUT_TYPES = {'text': '.txt', 'xhtml': '.html', 'markdown': '.md'}
+
+# Anchors of the blocks in markdown output: '{#id}' after a block or on its own line before a table,
+# and in the first column of a table row
+MARKDOWN_ANCHOR_PATTERN = re.compile(r'^(.*?) ?\{#([\w-]+)\}$')
+MARKDOWN_ROW_PATTERN = re.compile(r'^\| \{#([\w-]+)\} \|(.*)\|$')
+MARKDOWN_PREFIX_PATTERN = re.compile(r'^(#{1,6} |- |\d+\. )')
+
+# Modes of tag ids: 'sequential' numbers the tags in hex, 'content' derives the ids from the tag path and text
+TAG_ID_MODES = ['sequential', 'content']
+
+# Length of the content-derived ids in hex characters
+CONTENT_ID_LENGTH = 8
+
+# Tag ids of each mode: hex numbers from 1, without leading zeros, and hashes of CONTENT_ID_LENGTH with an optional suffix
+TAG_ID_PATTERNS = {
+    'sequential': re.compile(r'[1-9a-f][0-9a-f]*'),
+    'content': re.compile(r'[0-9a-f]{%d}(-[1-9]\d*)?' % CONTENT_ID_LENGTH)
+}
+# Ids of the page divs of PyMuPDF, which are kept in both modes
+PAGE_ID_PATTERN = re.compile(r'page\d+')
+
+def get_tag_id_mode(id_mode=None):
+    '''
+    Get the mode of tag ids from the argument or the environment variable TAG_ID_MODE. Defaults to 'sequential'.
+
+    Args:
+        id_mode (str, optional): The requested mode, either 'sequential' or 'content'.
+
+    Returns:
+        str: The mode that will be used.
+    '''
+    id_mode = id_mode or os.getenv("TAG_ID_MODE") or TAG_ID_MODES[0]
+    if id_mode not in TAG_ID_MODES:
+        raise ValueError(f"Tag id mode must be one of {TAG_ID_MODES}")
+    return id_mode
+
+def get_content_ids(root):
+    '''
+    Get the content-derived ids of the structural tags below a root in one pass, see TagIdStamper. The digest of
+    the path of a tag is chained from the digest of the path of its parent, and the digest of the text of a tag is
+    built bottom-up from its whitespace-normalized strings and the text digests of its child tags, so that the text
+    of every tag is hashed once instead of once for every ancestor.
+
+    Args:
+        root (bs4.Tag): The root of the tags, usually the whole document.
+
+    Returns:
+        dict: The ids, without suffixes, by the id() of the structural tags.
+    '''
+    root_path = b''
+    for tag in reversed([root] + list(root.parents)):
+        if tag.name != '[document]':
+            root_path = hashlib.sha1(root_path + b'/' + tag.name.encode('utf-8')).digest()
+
+    content_ids = {}
+    text_digests = {}
+    # iterative post-order walk, deeply nested documents would exceed the recursion limit
+    stack = [(root, root_path, False)]
+    while stack:
+        tag, path, visited = stack.pop()
+        if not visited:
+            stack.append((tag, path, True))
+            for child in tag.contents:
+                if isinstance(child, Tag):
+                    stack.append((child, hashlib.sha1(path + b'/' + child.name.encode('utf-8')).digest(), False))
+            continue
+        text_digest = hashlib.sha1()
+        for child in tag.contents:
+            if isinstance(child, Tag):
+                text_digest.update(b'\x01' + text_digests.pop(id(child)))
+            elif not isinstance(child, PreformattedString):
+                # comments, CDATA and declarations are not part of the text
+                words = " ".join(child.split())
+                if words:
+                    text_digest.update(b'\x02' + words.encode('utf-8') + b'\x00')
+        text_digests[id(tag)] = text_digest.digest()
+        if tag.name in STRUCTURAL_TAGS:
+            content_ids[id(tag)] = hashlib.sha1(path + text_digests[id(tag)]).hexdigest()[:CONTENT_ID_LENGTH]
+    return content_ids
+
+class TagIdStamper:
+    '''
+    Adds ids to the structural tags of a document, which must be stamped in document order.
 
-def add_ids_to_tags_(html):
+    In 'sequential' mode the tags are numbered in hex, so inserting a tag shifts the ids of all later tags.
+    In 'content' mode the id is a hash of the path of tag names from the root and the whitespace-normalized text
+    of the tag, so blocks that do not change keep their ids when the document is converted again and the LLM
+    results that refer to them stay valid. Blocks with the same path and text get the suffixes -2, -3 and so on.
+    '''
+
+    def __init__(self, id_mode=None):
+        '''
+        Args:
+            id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        '''
+        self.id_mode = get_tag_id_mode(id_mode)
+        self.next_id = 1
+        self.used_ids = set()
+        self.content_ids = {}
+
+    def prepare(self, root):
+        '''
+        Compute the content-derived ids of all structural tags below a root at once, see get_content_ids.
+        Only needed in 'content' mode, tags that are not prepared are hashed on their own when they are stamped.
+
+        Args:
+            root (bs4.Tag): The root of the tags that will be stamped.
+        '''
+        if self.id_mode == 'content':
+            self.content_ids = get_content_ids(root)
+
+    def get_content_id(self, tag):
+        digest = self.content_ids.get(id(tag)) or get_content_ids(tag)[id(tag)]
+        tag_id = digest
+        suffix = 2
+        while tag_id in self.used_ids:
+            tag_id = f"{digest}-{suffix}"
+            suffix += 1
+        return tag_id
+
+    def stamp(self, tag):
+        '''
+        Add an id to a tag if it is a structural tag without an id.
+
+        Args:
+            tag (bs4.Tag): The tag to add the id to.
+        '''
+        if tag.name not in STRUCTURAL_TAGS or 'id' in tag.attrs:
+            return
+        if self.id_mode == 'sequential':
+            tag_id = f"{self.next_id:x}"
+            self.next_id += 1
+        else:
+            tag_id = self.get_content_id(tag)
+        self.used_ids.add(tag_id)
+        tag['id'] = tag_id
+
+def add_ids_to_tags_(html, id_mode=None, stamper=None):
     '''
     Add ids to structural tags in an HTML document, excluding styling tags.
 
     Args:
         html (str): The HTML document to add ids to tags.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        stamper (TagIdStamper, optional): The stamper to continue with, for documents stamped in parts. Defaults to a new stamper.
 
     Returns:
         str: The HTML document with ids added to structural tags only.
     '''
-    # Define structural tags we want to add IDs to
-    structural_tags = {'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'table', 'tr', 'td', 'th', 'section', 'header', 'footer', 'article', 'aside', 'main', 'nav'}
-    
     # Parse the HTML document
-    soup = BeautifulSoup(html, 'html.parser')
-    tag_id = 1
-    
-    # Traverse all tags in the document
-    for tag in soup.find_all(structural_tags):  # Only get tags in structural_tags set
-        # Add an id if it doesn't already exist
-        if 'id' not in tag.attrs:
-            tag['id'] = f"{tag_id:x}"
-            tag_id += 1
+    soup = parse_html(html)
+    add_ids_to_soup(soup, id_mode=id_mode, stamper=stamper)
             
     # Return the modified HTML as a string
     return str(soup)
 
+def add_ids_to_soup(soup, id_mode=None, stamper=None):
+    '''
+    Add ids to structural tags of a parsed HTML document in place, see add_ids_to_tags_.
+
+    Args:
+        soup (BeautifulSoup): The parsed HTML document.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        stamper (TagIdStamper, optional): The stamper to continue with. Defaults to a new stamper.
+
+    Returns:
+        BeautifulSoup: The same document with ids added to structural tags.
+    '''
+    stamper = stamper or TagIdStamper(id_mode)
+    stamper.prepare(soup)
+
+    # Traverse all tags in the document
+    for tag in soup.find_all(STRUCTURAL_TAGS):  # Only get tags in STRUCTURAL_TAGS set
+        # Add an id if it doesn't already exist
+        stamper.stamp(tag)
+    return soup
+
+def has_ids_in_tags(html):
+    '''
+    Check whether all structural tags in an HTML document have ids, with a regex scan instead of parsing the document.
+
+    Args:
+        html (str): The HTML document to check.
+
+    Returns:
+        bool: True if no structural tag is missing an id.
+    '''
+    return all(match.group(1) and ID_ATTRIBUTE_PATTERN.search(match.group(1))
+               for match in STRUCTURAL_TAG_PATTERN.finditer(html))
+
+def add_ids_to_file(filepath, id_mode=None):
+    '''
+    Add ids to the structural tags of an HTML file, unless all of them already have ids.
+
+    Args:
+        filepath (str): The path to the HTML file.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+
+    Returns:
+        bool: True if the file was changed.
+    '''
+    with open(filepath, "r") as file:
+        text = file.read()
+    if has_ids_in_tags(text):
+        return False
+    with open(filepath, "w") as file:
+        file.write(add_ids_to_tags_(text, id_mode=id_mode))
+    return True
+
 def remove_ids_from_tags(html):
     '''
     Remove ids from all tags in an HTML document.
@@ -44,17 +246,233 @@ def remove_ids_from_tags(html):
         str: The HTML document with ids removed from all tags.
     '''
     # Parse the HTML document
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # Traverse all tags in the document
-    for tag in soup.find_all():
-        # Remove the id attribute if it exists
-        if 'id' in tag.attrs:
-            del tag['id']
+    soup = parse_html(html)
+    remove_ids_from_soup(soup)
             
     # Return the modified HTML as a string
     return str(soup)
 
+def remove_ids_from_soup(soup):
+    '''
+    Remove ids from all tags of a parsed HTML document in place, see remove_ids_from_tags.
+
+    Args:
+        soup (BeautifulSoup): The parsed HTML document.
+
+    Returns:
+        BeautifulSoup: The same document with ids removed from all tags.
+    '''
+    # Only visit the tags that have an id
+    for tag in soup.find_all(id=True):
+        del tag['id']
+    return soup
+
+def get_markdown_text(tag):
+    return " ".join(tag.get_text().split())
+
+def get_markdown_anchor(tag):
+    return f" {{#{tag['id']}}}" if tag.get('id') else ""
+
+def table_to_markdown(table):
+    '''
+    Render a table as a pipe table. The first row is the header, and if the rows have ids, the first column holds
+    them as anchors.
+    '''
+    rows = [[get_markdown_text(cell).replace("|", "\\|") for cell in row.find_all(['td', 'th'])] + [row.get('id')]
+            for row in table.find_all('tr')]
+    if not rows:
+        return get_markdown_text(table) + get_markdown_anchor(table)
+    column_count = max(len(row) - 1 for row in rows)
+    with_ids = any(row[-1] for row in rows)
+
+    lines = [f"{{#{table['id']}}}"] if table.get('id') else []
+    for index, row in enumerate(rows):
+        cells = row[:-1] + [""] * (column_count - len(row) + 1)
+        if with_ids:
+            cells = [f"{{#{row[-1]}}}" if row[-1] else ""] + cells
+        lines.append("| " + " | ".join(cells) + " |")
+        if index == 0:
+            lines.append("|" + " --- |" * len(cells))
+    return "\n".join(lines)
+
+def html_to_markdown(html):
+    '''
+    Render an HTML document as compact markdown. Every block keeps its id as an anchor, '{#id}' after headings,
+    paragraphs and list items, so that the ids referred to by the extraction prompts can be resolved to text
+    with get_markdown_anchor_texts. List items with nested lists keep their own text and anchor before the nested
+    list. Tables become pipe tables with the row anchors in the first column.
+
+    Args:
+        html (str): The HTML document to render.
+
+    Returns:
+        str: The markdown document.
+    '''
+    return soup_to_markdown(parse_html(html))
+
+def soup_to_markdown(soup):
+    '''
+    Render a parsed HTML document as compact markdown, see html_to_markdown.
+
+    Args:
+        soup (BeautifulSoup): The parsed HTML document.
+
+    Returns:
+        str: The markdown document.
+    '''
+    blocks = []
+    loose_text = []
+
+    def flush_loose_text():
+        text = " ".join(" ".join(loose_text).split())
+        if text:
+            blocks.append(text)
+        loose_text.clear()
+
+    # Find the tags with structural descendants in one pass, marking the ancestors of every structural tag
+    # up to the first one that is already marked, instead of searching the subtree of every tag
+    has_blocks_ids = set()
+    for tag in soup.find_all(STRUCTURAL_TAGS):
+        for parent in tag.parents:
+            if id(parent) in has_blocks_ids:
+                break
+            has_blocks_ids.add(id(parent))
+
+    def is_inline(element):
+        return not isinstance(element, Tag) or (element.name not in STRUCTURAL_TAGS and id(element) not in has_blocks_ids)
+
+    def get_list_item_prefix(tag):
+        return "1. " if tag.parent.name == 'ol' else "- "
+
+    def render(element, blocks_only=False):
+        for child in element.children:
+            if isinstance(child, Comment) or (is_inline(child) and blocks_only):
+                continue
+            if not isinstance(child, Tag):
+                loose_text.append(child)
+                continue
+            is_block = child.name in STRUCTURAL_TAGS
+            has_blocks = id(child) in has_blocks_ids
+            if not is_block and not has_blocks:
+                # inline tag
+                loose_text.append(child.get_text())
+                continue
+            flush_loose_text()
+            if child.name == 'table':
+                blocks.append(table_to_markdown(child))
+            elif is_block and not has_blocks:
+                text = get_markdown_text(child)
+                if not text:
+                    continue
+                if child.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+                    text = "#" * int(child.name[1]) + " " + text
+                elif child.name == 'li':
+                    text = get_list_item_prefix(child) + text
+                blocks.append(text + get_markdown_anchor(child))
+            elif child.name == 'li':
+                # the text of the item itself comes before its nested lists, with the anchor of the item
+                text = " ".join(" ".join(grandchild.get_text() for grandchild in child.children
+                                         if is_inline(grandchild) and not isinstance(grandchild, Comment)).split())
+                if text:
+                    blocks.append(get_list_item_prefix(child) + text + get_markdown_anchor(child))
+                render(child, blocks_only=True)
+                flush_loose_text()
+            else:
+                render(child)
+                flush_loose_text()
+
+    render(soup)
+    flush_loose_text()
+    return "\n\n".join(blocks) + "\n"
+
+def get_markdown_anchor_texts(markdown):
+    '''
+    Get the text of every anchored block of a markdown document rendered by html_to_markdown.
+
+    Args:
+        markdown (str): The markdown document.
+
+    Returns:
+        dict: The text of the blocks by id.
+    '''
+    texts = {}
+    table_id = None
+    for line in markdown.splitlines():
+        # skip the separator row below the header of a table
+        if line.startswith("|") and not line.strip("|- "):
+            continue
+        row_match = MARKDOWN_ROW_PATTERN.match(line)
+        anchor_match = MARKDOWN_ANCHOR_PATTERN.match(line)
+        if row_match:
+            text = " ".join(cell.strip().replace("\\|", "|") for cell in row_match.group(2).split(" | ") if cell.strip())
+            texts[row_match.group(1)] = text
+            if table_id:
+                texts[table_id] = f"{texts[table_id]} {text}".strip()
+        elif anchor_match:
+            text = MARKDOWN_PREFIX_PATTERN.sub("", anchor_match.group(1))
+            texts[anchor_match.group(2)] = text
+            # an anchor on its own line belongs to the table below it
+            table_id = anchor_match.group(2) if not text else None
+        elif not line.startswith("|"):
+            table_id = None
+    return texts
+
+def get_html_id_texts(html):
+    '''
+    Get the text of every tag with an id of an HTML document, in one pass over the tags with ids.
+
+    Args:
+        html (str): The HTML document.
+
+    Returns:
+        dict: The text of the tags by id. If several tags have the same id, the text of the first one is used.
+    '''
+    texts = {}
+    for tag in parse_html(html).find_all(id=True):
+        texts.setdefault(tag['id'], tag.get_text(strip=True))
+    return texts
+
+def get_id_texts_path(filepath):
+    '''
+    Get the path of the cached id texts of a converted document.
+    '''
+    return filepath + ".ids.json"
+
+def load_id_texts(filepath):
+    '''
+    Get the text of every id of an HTML or markdown document, see get_html_id_texts and get_markdown_anchor_texts.
+    The texts are cached next to the document with the hash of its content, so that a document is only parsed
+    again when it changes.
+
+    Args:
+        filepath (str): The path of the HTML, web HTML or markdown document.
+
+    Returns:
+        dict: The text of the blocks by id.
+    '''
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    cache_path = get_id_texts_path(filepath)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['sha256'] == sha256:
+            return cached['texts']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    texts = get_markdown_anchor_texts(content) if filepath.endswith('.md') else get_html_id_texts(content)
+    try:
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'sha256': sha256, 'texts': texts}, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+    return texts
+
 def clean_html(html):
     '''
     Remove empty tags and unnecessary attributes from an HTML document.
@@ -66,93 +484,463 @@ def clean_html(html):
         str: The HTML document with empty tags removed.
     '''
     # Parse the HTML document
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # Traverse all tags in the document
-    for tag in soup.find_all():
-        # Remove the tag if it has no content
-        if not tag.text.strip():
-            tag.decompose()
-        # Remove unnecessary attributes except for id
-        else:
-            for attribute in list(tag.attrs):
-                if attribute != 'id':
-                    del tag[attribute]
+    soup = parse_html(html)
+
+    # Find the tags with text in one pass: every non-empty string marks its ancestors, up to the first one
+    # that is already marked, so that each tag is marked once instead of collecting its text for every tag
+    has_text = set()
+    for element in soup.descendants:
+        if not isinstance(element, NavigableString) or not element.strip():
+            continue
+        if type(element) in soup.interesting_string_types:
+            for parent in element.parents:
+                if id(parent) in has_text:
+                    break
+                has_text.add(id(parent))
+        elif type(element) in element.parent.interesting_string_types:
+            # strings like stylesheets only count as the text of their own tag
+            has_text.add(id(element.parent))
+
+    # Remove the tags without text and the attributes except for id, walking down the kept tags only
+    stack = [soup]
+    while stack:
+        tag = stack.pop()
+        children = [child for child in tag.contents if isinstance(child, Tag)]
+        if any(id(child) not in has_text for child in children):
+            # detach the children from the front, where each lookup of their index is immediate,
+            # and put back the ones to keep, instead of removing the empty ones one by one
+            contents = list(tag.contents)
+            for child in contents:
+                child.extract()
+            for child in contents:
+                if isinstance(child, Tag) and id(child) not in has_text:
+                    child.decompose()
+                else:
+                    tag.append(child)
+        for child in children:
+            if id(child) in has_text:
+                child.attrs = {'id': child['id']} if 'id' in child.attrs else {}
+                stack.append(child)
             
     # Return the modified HTML as a string
     return str(soup)
 
-def convert_files(filepaths, output_type='xhtml', overwrite=False, add_ids_to_tags=True):
+class PageCache:
+    '''
+    On-disk cache of the text extracted from PDF pages, keyed by a hash of the page content and the extraction
+    settings, so that only the changed pages of a document are extracted again. The least recently used pages
+    are evicted when the total size of the cache exceeds max_size.
+    '''
+
+    def __init__(self, cache_path, max_size=None):
+        '''
+        Args:
+            cache_path (str): The directory where the extracted pages are stored.
+            max_size (int, optional): The maximum total size of the extracted pages in bytes. Defaults to the
+                environment variable PAGE_CACHE_MAX_SIZE_MB or 1024 MB.
+        '''
+        self.cache_path = cache_path
+        self.max_size = max_size or int(os.getenv("PAGE_CACHE_MAX_SIZE_MB", 1024)) * 1024**2
+        self._entries = LRUDirectory(cache_path, self.max_size, '.txt')
+        os.makedirs(cache_path, exist_ok=True)
+
+    @staticmethod
+    def get_key(doc, page, extraction_type):
+        '''
+        Get the cache key of a page: the hash of its content stream and page object (which refers to its fonts
+        and other resources) and the extraction type.
+        '''
+        page_hash = hashlib.sha256(page.read_contents())
+        page_hash.update(doc.xref_object(page.xref, compressed=True).encode("utf-8"))
+        page_hash.update(extraction_type.encode("utf-8"))
+        return page_hash.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.cache_path, f"{key}.txt")
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                text = file.read()
+        except OSError:
+            return None
+        self._entries.touch(path)
+        return text
+
+    def put(self, key, text):
+        path = os.path.join(self.cache_path, f"{key}.txt")
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        with open(f"{path}.{os.getpid()}.tmp", "w", encoding="utf-8") as file:
+            file.write(text)
+        size = os.path.getsize(f"{path}.{os.getpid()}.tmp")
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+        self._entries.add(size - old_size)
+
+    def evict(self):
+        '''
+        Remove the least recently used pages until the total size of the cache is below max_size. Pages written
+        by other processes are only accounted for by a new PageCache, see convert_files and LRUDirectory.
+        '''
+        self._entries.evict()
+
+_page_caches = {}
+
+def get_page_cache(cache_path):
+    '''
+    Get the page cache of a directory, created once per process so that its size is only listed once.
+    '''
+    if cache_path not in _page_caches:
+        _page_caches[cache_path] = PageCache(cache_path)
+    return _page_caches[cache_path]
+
+def extract_page_text(doc, page, extraction_type, page_cache=None):
     '''
-    Convert scraped documents into specified format
+    Extract the text of a PDF page, from the page cache if the page has been extracted before.
+
+    Args:
+        doc (fitz.Document): The PDF document.
+        page (fitz.Page): The page to extract.
+        extraction_type (str): The PyMuPDF text type, either 'text' or 'xhtml'.
+        page_cache (PageCache, optional): The page cache. Defaults to None.
+
+    Returns:
+        str: The extracted text of the page.
+    '''
+    key = PageCache.get_key(doc, page, extraction_type) if page_cache else None
+    text = page_cache.get(key) if page_cache else None
+    if text is None:
+        text = page.get_text(extraction_type, flags=~fitz.TEXT_PRESERVE_IMAGES &
+                             fitz.TEXT_DEHYPHENATE & fitz.TEXT_PRESERVE_WHITESPACE)
+        if page_cache:
+            page_cache.put(key, text)
+    return text
+
+def iter_converted_document(filepath, output_type='xhtml', add_ids_to_tags=True, id_mode=None, max_pages=None, page_cache_path=None):
+    '''
+    Convert a scraped document into specified format, yielding the output in parts: page by page for PDFs,
+    so that long documents are never held in memory as a whole, and in one part for DOCX files. The parts
+    joined together are the same as the whole document converted at once.
+
+    Args:
+        filepath (str): The filepath of the document to be converted.
+        output_type (str, optional): The type of output, either 'text', 'xhtml' or 'markdown'. Defaults to 'xhtml'.
+        add_ids_to_tags (bool, optional): Whether to add ids to tags. Defaults to True.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        max_pages (int, optional): The number of PDF pages to convert from the beginning, for example for documents that are only used for metadata. Defaults to None, which converts all pages.
+        page_cache_path (str, optional): The directory of the page cache. Defaults to None, in which case pages are not cached.
+
+    Yields:
+        str: The next part of the converted document.
+    '''
+    input_file_extension = os.path.splitext(filepath)[1]
+    if input_file_extension not in ['.pdf', '.docx']:
+        raise ValueError(f"File format {input_file_extension} not supported: {filepath}")
+
+    # markdown is rendered from the xhtml output, with the same ids
+    extraction_type = 'xhtml' if output_type == 'markdown' else output_type
+    # the ids continue from one page to the next
+    stamper = TagIdStamper(id_mode)
+    has_markdown = False
+
+    def finish(text):
+        nonlocal has_markdown
+        # unescape the html special swedish chars
+        text = html.unescape(text)
+
+        if extraction_type == 'xhtml':
+            # every part is parsed once, for the ids and for the markdown rendering
+            soup = parse_html(text)
+            if add_ids_to_tags:
+                add_ids_to_soup(soup, stamper=stamper)
+            else:
+                remove_ids_from_soup(soup)
+            text = soup_to_markdown(soup) if output_type == 'markdown' else str(soup)
+
+        if output_type == 'markdown':
+            # the blocks of consecutive pages are separated by a blank line
+            if not text.strip():
+                return ""
+            if has_markdown:
+                text = "\n" + text
+            has_markdown = True
+        return text
+
+    # Check the file extension and process accordingly
+    if input_file_extension == ".pdf":
+        page_cache = get_page_cache(page_cache_path) if page_cache_path else None
+        # Open the PDF file and extract the text page by page
+        with fitz.open(filepath) as doc:
+            page_count = min(len(doc), max_pages) if max_pages else len(doc)
+            for page_number in range(page_count):
+                yield finish(extract_page_text(doc, doc[page_number], extraction_type, page_cache))
+    else:
+        # Convert the DOCX file to HTML
+        with open(filepath, 'rb') as docx:
+            text = convert_to_html(docx)
+            yield finish(text.value)
+
+def convert_file(filepath, output_type='xhtml', add_ids_to_tags=True, id_mode=None, max_pages=None, page_cache_path=None):
+    '''
+    Convert a scraped document into specified format, see iter_converted_document.
+
+    Args:
+        filepath (str): The filepath of the document to be converted.
+        output_type (str, optional): The type of output, either 'text', 'xhtml' or 'markdown'. Defaults to 'xhtml'.
+        add_ids_to_tags (bool, optional): Whether to add ids to tags. Defaults to True.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        max_pages (int, optional): The number of PDF pages to convert. Defaults to None, which converts all pages.
+        page_cache_path (str, optional): The directory of the page cache. Defaults to None.
+
+    Returns:
+        str: The converted document, or None if the file format is not supported.
+    '''
+    try:
+        return "".join(iter_converted_document(filepath, output_type=output_type, add_ids_to_tags=add_ids_to_tags,
+                                               id_mode=id_mode, max_pages=max_pages, page_cache_path=page_cache_path))
+    except ValueError as e:
+        print(e)
+        return None
+
+def load_conversion_manifest(manifest_path):
+    '''
+    Load the conversion manifest, which records for every output file the hash of its source document and
+    the settings it was converted with.
+
+    Args:
+        manifest_path (str): The path to the manifest file. If None, an empty manifest is returned.
+
+    Returns:
+        dict: The manifest entries by output file path.
+    '''
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    return {}
+
+def save_conversion_manifest(manifest, manifest_path):
+    '''
+    Save the conversion manifest.
+
+    Args:
+        manifest (dict): The manifest entries by output file path.
+        manifest_path (str): The path to the manifest file. If None, nothing is saved.
+    '''
+    if not manifest_path:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=0)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def get_output_id_mode(output, output_type):
+    '''
+    Get the mode of the ids of a converted document from the ids themselves, for output files converted before
+    the manifest recorded their settings. Content-derived ids are checked first, the sequential ids of a document
+    are shorter than them.
+
+    Args:
+        output (str): The converted document.
+        output_type (str): The type of the document, see OUTPUT_TYPES.
+
+    Returns:
+        str | None: The mode of the ids, None if the document has no ids, or 'mixed' if some structural tags have no
+            id or the ids are not all of one mode.
+    '''
+    if output_type == 'xhtml':
+        ids = [tag.get('id') for tag in parse_html(output).find_all(STRUCTURAL_TAGS)
+               if not PAGE_ID_PATTERN.fullmatch(tag.get('id') or '')]
+    elif output_type == 'markdown':
+        ids = list(get_markdown_anchor_texts(output))
+    else:
+        ids = []
+    if not any(ids):
+        return None
+    for id_mode in ['content', 'sequential']:
+        if all(tag_id and TAG_ID_PATTERNS[id_mode].fullmatch(tag_id) for tag_id in ids):
+            return id_mode
+    return 'mixed'
+
+def get_conversion_entry(sha256, output_type, add_ids_to_tags, id_mode, max_pages):
+    '''
+    Get the manifest entry of an output file converted from a source document with the given settings.
+    '''
+    return {
+        "sha256": sha256,
+        "output_type": output_type,
+        "add_ids_to_tags": add_ids_to_tags,
+        "id_mode": id_mode if add_ids_to_tags else None,
+        "max_pages": max_pages,
+        "converter_version": CONVERTER_VERSION
+    }
+
+def convert_job(job):
+    '''
+    Convert a document and write the result to the output files of all its copies. The output is written
+    page by page to a temporary file, which replaces the first output file when it is complete and is copied
+    to the others. Runs in the worker processes of convert_files, errors are returned instead of raised so
+    that one file cannot stop the others.
+
+    Args:
+        job (dict): The filepath of the document and its output file paths, and the output_type, add_ids_to_tags,
+            id_mode, max_pages and page_cache_path arguments of iter_converted_document.
+
+    Returns:
+        (str, str | None): The filepath of the document and the error message, or None if the conversion succeeded.
+    '''
+    filepath = job['filepath']
+    output_file_paths = job['output_file_paths']
+    temp_file_path = f"{output_file_paths[0]}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file_path, "w") as file:
+            for text in iter_converted_document(filepath, output_type=job['output_type'], add_ids_to_tags=job['add_ids_to_tags'],
+                                                id_mode=job['id_mode'], max_pages=job['max_pages'],
+                                                page_cache_path=job['page_cache_path']):
+                file.write(text)
+        os.replace(temp_file_path, output_file_paths[0])
+        # Write the text to the output file of every copy of the document
+        for output_file_path in output_file_paths[1:]:
+            shutil.copyfile(output_file_paths[0], output_file_path)
+        return filepath, None
+    except Exception as e:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        return filepath, str(e)
+
+def convert_files(filepaths, output_type='xhtml', overwrite=False, add_ids_to_tags=True, blob_store=None, max_workers=1, chunksize=4,
+                  manifest_path=None, id_mode=None, max_pages=None, page_cache_path=None):
+    '''
+    Convert scraped documents into specified format. Documents with identical content, like an attachment
+    linked from several agenda items, are converted once and the result is written next to every copy.
+
+    With a conversion manifest, an existing output file is converted again if its source document, the output
+    type, the id mode or CONVERTER_VERSION changed since it was written, and skipped otherwise. Existing output
+    files without an entry, written before the manifest, are kept and get an entry for the current settings if
+    their ids are of the current id mode, see get_output_id_mode, and are converted again otherwise.
+
+    With more than one worker the documents are converted in a process pool. The output files are the same as
+    when converting in this process, and the results are reported in the order of the filepaths.
 
     Args:
         filepaths (list): A list of filepaths to the documents to be converted.
-        output_type (str, optional): The type of output, either 'text' or 'xhtml'. Defaults to 'xhtml'.
+        output_type (str, optional): The type of output, either 'text', 'xhtml' or 'markdown'. Defaults to 'xhtml'.
         overwrite (bool, optional): Whether to overwrite existing files. Defaults to False.
         add_ids_to_tags (bool, optional): Whether to add ids to tags. Defaults to True.
+        blob_store (BlobStore, optional): The store of the downloaded documents, used for their content hashes. Defaults to None, in which case the documents are hashed.
+        max_workers (int, optional): The number of worker processes. Defaults to 1, which converts in this process. None uses all cores.
+        chunksize (int, optional): The number of documents sent to a worker process at a time. Defaults to 4.
+        manifest_path (str, optional): The path to the conversion manifest. Defaults to None, in which case existing output files are only converted again with overwrite.
+        id_mode (str, optional): The mode of the ids, see get_tag_id_mode.
+        max_pages (int, optional): The number of PDF pages to convert from the beginning of each document. Defaults to None, which converts all pages.
+        page_cache_path (str, optional): The directory of the cache of extracted PDF pages. Defaults to None, in which case pages are not cached. The cache is limited to PAGE_CACHE_MAX_SIZE_MB, see PageCache.
 
     Returns:
         None
     '''
 
-    if not output_type in ['text', 'xhtml']:
-        raise ValueError("Output type must be either 'text' or 'xhtml'")
+    if not output_type in OUTPUT_TYPES:
+        raise ValueError("Output type must be either 'text', 'xhtml' or 'markdown'")
 
     # Determine the file extension based on the output type
-    output_extension = '.html' if output_type == 'xhtml' else '.txt'
+    output_extension = OUTPUT_TYPES[output_type]
 
-    # Iterate over each row in the DataFrame
-    for filepath in tqdm(filepaths, desc=f"Converting Documents to {output_type}", total=len(filepaths)):
+    existing_filepaths = []
+    for filepath in filepaths:
         if not os.path.exists(filepath):
             print(f"File {filepath} does not exist")
             continue
-
-        input_file_name, input_file_extension = os.path.splitext(
-            os.path.basename(filepath))
-
-        # get output file path
-        output_folder_path = os.path.dirname(filepath)
-        output_file_path = os.path.join(
-            output_folder_path, input_file_name + output_extension)
-
-        if os.path.exists(output_file_path) and not overwrite:
-            if add_ids_to_tags:
-                # add ids to tags
+        existing_filepaths.append(filepath)
+
+    id_mode = get_tag_id_mode(id_mode)
+    groups = group_by_content(existing_filepaths, blob_store=blob_store)
+    manifest = load_conversion_manifest(manifest_path)
+
+    # Create a conversion job for each unique document with outputs to write
+    jobs = []
+    entries = []
+    stale_count = 0
+    stamped_count = 0
+    for sha256, group in groups.items():
+        entry = get_conversion_entry(sha256, output_type, add_ids_to_tags, id_mode, max_pages)
+        output_file_paths = []
+        for filepath in group:
+            # get output file path
+            input_file_name = os.path.splitext(os.path.basename(filepath))[0]
+            output_file_path = os.path.join(
+                os.path.dirname(filepath), input_file_name + output_extension)
+
+            if os.path.exists(output_file_path) and not overwrite:
+                manifest_entry = manifest.get(os.path.normpath(output_file_path))
+                if manifest_entry == entry:
+                    # the output file is up to date
+                    continue
+                if manifest_entry:
+                    # the source document or the settings changed
+                    stale_count += 1
+                    output_file_paths.append(output_file_path)
+                    continue
+                # files converted before the manifest are kept if their ids are of the requested mode, with ids
+                # added to their tags if they have none, and recorded so that they are converted again when the
+                # source or the settings change. Files with other ids are converted again like stale files.
                 with open(output_file_path, "r") as file:
-                    text = file.read()
-                    text = add_ids_to_tags_(text)
-            continue
-
-        # Initialize the text variable
-        text = ""
-        # Check the file extension and process accordingly
-        if input_file_extension == ".pdf":
-            # Open the PDF file and extract the text
-            with fitz.open(filepath) as doc:
-                text = "".join(page.get_text(output_type, flags=~fitz.TEXT_PRESERVE_IMAGES &
-                               fitz.TEXT_DEHYPHENATE & fitz.TEXT_PRESERVE_WHITESPACE) for page in doc)
-        elif input_file_extension == ".docx":
-            # Convert the DOCX file to HTML
-            with open(filepath, 'rb') as docx:
-                text = convert_to_html(docx)
-                text = text.value
+                    output_id_mode = get_output_id_mode(file.read(), output_type)
+                expected_id_mode = id_mode if add_ids_to_tags and output_type != 'text' else None
+                if output_id_mode is None and expected_id_mode and output_type == 'xhtml':
+                    if add_ids_to_file(output_file_path, id_mode=id_mode):
+                        stamped_count += 1
+                elif output_id_mode != expected_id_mode:
+                    stale_count += 1
+                    output_file_paths.append(output_file_path)
+                    continue
+                manifest[os.path.normpath(output_file_path)] = entry
+                continue
+            output_file_paths.append(output_file_path)
+
+        if output_file_paths:
+            jobs.append({
+                'filepath': group[0],
+                'output_file_paths': output_file_paths,
+                'output_type': output_type,
+                'add_ids_to_tags': add_ids_to_tags,
+                'id_mode': id_mode,
+                'max_pages': max_pages,
+                'page_cache_path': page_cache_path
+            })
+            entries.append(entry)
+
+    progress = tqdm(desc=f"Converting Documents to {output_type}", total=len(filepaths))
+    progress.update(len(filepaths) - sum(len(job['output_file_paths']) for job in jobs))
+    executor = None
+    if max_workers == 1:
+        results = map(convert_job, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        # map returns the results in the order of the jobs
+        results = executor.map(convert_job, jobs, chunksize=chunksize)
+
+    errors = []
+    converted_count = 0
+    for job, entry, (filepath, error) in zip(jobs, entries, results):
+        if error:
+            errors.append((filepath, error))
         else:
-            print(
-                f"File format {input_file_extension} not supported: {filepath}")
-            continue
-
-        # unescape the html special swedish chars
-        text = html.unescape(text)
-
-        if output_type == 'xhtml' and add_ids_to_tags:
-            text = add_ids_to_tags_(text)
-        elif output_type == 'xhtml':
-            text = remove_ids_from_tags(text)
-
-        # Write the text to the output file
-        with open(output_file_path, "w") as file:
-            file.write(text)
+            converted_count += len(job['output_file_paths'])
+            for output_file_path in job['output_file_paths']:
+                manifest[os.path.normpath(output_file_path)] = entry
+        progress.update(len(job['output_file_paths']))
+    if executor:
+        executor.shutdown()
+    progress.close()
+    save_conversion_manifest(manifest, manifest_path)
+    # the workers only track the pages they wrote, so the size of the whole cache is checked once they are done
+    if page_cache_path and jobs:
+        PageCache(page_cache_path).evict()
+
+    for filepath, error in errors:
+        print(f"Error converting {filepath}: {error}")
+    skipped_count = len(existing_filepaths) - sum(len(job['output_file_paths']) for job in jobs)
+    print(f"Converted {converted_count} files ({len(jobs) - len(errors)} unique documents, {stale_count} outdated), "
+          f"skipped {skipped_count} up-to-date files, {len(errors)} documents failed")
+    if stamped_count:
+        print(f"Added ids to tags in {stamped_count} existing files")
     print(
         f"Saved converted files to respective folders in the same directory as the original files")
 
@@ -180,15 +968,17 @@ def get_documents_filepaths(directory, depth=3, file_types=['.pdf', '.docx']):
     return filepaths
 
 
-def main(depth=3, output_type='xhtml', overwrite=False, add_ids_to_tags=True):
+def main(depth=3, output_type='xhtml', overwrite=False, add_ids_to_tags=True, max_workers=None, max_pages=None):
     """
     Convert documents to specified format
 
     Args:
         depth (int, optional): The depth of the folders to traverse for conversion. Defaults to 3. For only agenda and protocols, depth=3, for including attachments, depth=5.
-        output_type (str, optional): The type of output, either 'text' or 'xhtml'. Defaults to 'xhtml'.
+        output_type (str, optional): The type of output, either 'text', 'xhtml' or 'markdown'. Defaults to 'xhtml'.
         overwrite (bool, optional): Whether to overwrite existing files. Defaults to False.
         add_ids_to_tags (bool, optional): Whether to add ids to tags. Defaults to True.
+        max_workers (int, optional): The number of worker processes. Defaults to None, which uses all cores.
+        max_pages (int, optional): The number of PDF pages to convert from the beginning of each document. Defaults to None, which converts all pages.
 
     Returns:
         None
@@ -209,7 +999,10 @@ def main(depth=3, output_type='xhtml', overwrite=False, add_ids_to_tags=True):
         print(f"No documents found. You might try increasing the depth")
         return
 
-    convert_files(filepaths, output_type=output_type, overwrite=overwrite, add_ids_to_tags=add_ids_to_tags)
+    convert_files(filepaths, output_type=output_type, overwrite=overwrite, add_ids_to_tags=add_ids_to_tags,
+                  blob_store=get_blob_store(), max_workers=max_workers,
+                  manifest_path=os.getenv("CONVERSION_MANIFEST_FILE_PATH"), max_pages=max_pages,
+                  page_cache_path=os.getenv("PAGE_CACHE_PATH"))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+import os
+import re
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+
+try:
+    import lxml  # noqa: F401
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+# Available parser backends, the default first. lxml is faster, but repairs malformed markup differently, for
+# example it closes a <p> before a nested <div>, closes unclosed <li> tags and converts \r\n to \n, so it is opt-in.
+PARSER_BACKENDS = ['html.parser', 'lxml']
+
+# Structural tags, which get ids in the converted documents and are the block tags of compact_html
+STRUCTURAL_TAGS = {'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'table', 'tr', 'td', 'th', 'section', 'header', 'footer', 'article', 'aside', 'main', 'nav'}
+
+# Tags that are kept by compact_html even when they are empty, because they carry layout
+KEEP_EMPTY_TAGS = {'td', 'th', 'br', 'hr', 'img'}
+# Wrapper tags that compact_html unwraps when they hold a single tag
+CONTAINER_TAGS = {'div', 'section', 'article', 'main', 'header', 'footer', 'aside', 'nav', 'span', 'font'}
+# Inline tags that compact_html unwraps when they have no id, as they only carried styling attributes
+STYLE_TAGS = {'span', 'font'}
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+DOCUMENT_PATTERN = re.compile(r'<html[\s>]', re.IGNORECASE)
+DOCUMENT_PATTERN_BYTES = re.compile(rb'<html[\s>]', re.IGNORECASE)
+LEADING_WHITESPACE_PATTERN = re.compile(r'[ \t\n\r\f]*')
+LEADING_WHITESPACE_PATTERN_BYTES = re.compile(rb'[ \t\n\r\f]*')
+
+
+def get_parser_backend(backend=None):
+    """
+    Returns the parser backend to use. The backend is taken from the argument, the environment variable
+    HTML_PARSER_BACKEND or, if neither is set, 'html.parser'. Falls back to 'html.parser' if lxml is not installed.
+    Check the stored documents with benchmarks.check_parser_equivalence before opting in to lxml.
+
+    Args:
+        backend (str): The requested backend, either 'lxml' or 'html.parser'.
+
+    Returns:
+        str: The backend that will be used.
+    """
+    backend = backend or os.getenv("HTML_PARSER_BACKEND") or PARSER_BACKENDS[0]
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"HTML parser backend must be one of {PARSER_BACKENDS}")
+    if backend == 'lxml' and not LXML_AVAILABLE:
+        return 'html.parser'
+    return backend
+
+
+def unwrap(tag):
+    """
+    Replaces a tag with its contents, like Tag.unwrap. Tag.unwrap moves the children starting from the last one,
+    which looks up the position of every child in the whole list and is quadratic in the number of children,
+    whereas moving them starting from the first one finds every child at the front.
+
+    Args:
+        tag (bs4.Tag): The tag to replace.
+    """
+    parent = tag.parent
+    index = parent.index(tag)
+    tag.extract()
+    for offset, child in enumerate(list(tag.contents)):
+        parent.insert(index + offset, child)
+
+
+def parse_html(markup, backend=None):
+    """
+    Parses an HTML document or fragment into a BeautifulSoup object with the selected parser backend.
+
+    lxml always builds a complete document, so for fragments (markup without an <html> tag) the added
+    <html>, <head> and <body> wrappers are removed again, and the leading whitespace lxml drops is restored,
+    to give the same tree as 'html.parser'.
+
+    Args:
+        markup (str | bytes): The HTML to parse.
+        backend (str): The parser backend, see get_parser_backend.
+
+    Returns:
+        BeautifulSoup: The parsed HTML.
+    """
+    backend = get_parser_backend(backend)
+    soup = BeautifulSoup(markup, backend)
+
+    if backend == 'lxml':
+        is_bytes = isinstance(markup, bytes)
+        document_pattern = DOCUMENT_PATTERN_BYTES if is_bytes else DOCUMENT_PATTERN
+        html_tag = soup.find('html', recursive=False)
+        if html_tag and not document_pattern.search(markup):
+            for name in ['head', 'body']:
+                wrapper = html_tag.find(name, recursive=False)
+                if wrapper:
+                    unwrap(wrapper)
+            unwrap(html_tag)
+
+            whitespace_pattern = LEADING_WHITESPACE_PATTERN_BYTES if is_bytes else LEADING_WHITESPACE_PATTERN
+            leading_whitespace = whitespace_pattern.match(markup).group()
+            if leading_whitespace:
+                # BeautifulSoup collapses whitespace-only strings to a newline or a space
+                newline = b'\n' if is_bytes else '\n'
+                soup.insert(0, '\n' if newline in leading_whitespace else ' ')
+
+    return soup
+
+
+def replace_contents(tag, contents):
+    """
+    Replaces the children of a tag with the given elements, which may include children of its children. The
+    children are detached from the front, where each lookup of their index is immediate, and the elements are
+    appended, so that rebuilding the children of a tag is linear instead of removing or inserting them one by one.
+
+    Args:
+        tag (bs4.Tag): The tag whose children are replaced.
+        contents (list): The new children of the tag.
+    """
+    if len(contents) == len(tag.contents) and all(a is b for a, b in zip(contents, tag.contents)):
+        return
+    for child in list(tag.contents):
+        child.extract()
+    for child in contents:
+        tag.append(child)
+
+
+def compact_html(html):
+    """
+    Compact an HTML document for LLM input: removes comments and all attributes except ids, collapses whitespace,
+    drops empty tags and unwraps wrappers around a single tag. Ids are kept, a wrapper with an id is only
+    unwrapped if the tag it wraps, which has the same text, has an id too.
+
+    The children of every tag are rebuilt once, instead of removing and unwrapping the tags one by one, which
+    looks up their position among their siblings every time and is quadratic for tags with many children.
+
+    Args:
+        html (str): The HTML document to compact.
+
+    Returns:
+        str: The compacted HTML document.
+    """
+    soup = parse_html(html)
+    # the tags that are removed or unwrapped into their parent, by id(), decided before their parent is rebuilt
+    removed = set()
+    unwrapped = set()
+    tags = soup.find_all(True)
+    # the whitespace of the tags inside a <pre>, at any depth, is kept, parents are found before their children
+    preformatted = set()
+    for tag in tags:
+        if tag.name == 'pre' or id(tag.parent) in preformatted:
+            preformatted.add(id(tag))
+
+    # children are visited before their parents, so a tag is empty once its empty children are removed
+    for tag in reversed([soup] + tags):
+        contents = []
+        for child in tag.contents:
+            if isinstance(child, Tag):
+                if id(child) in unwrapped:
+                    contents.extend(child.contents)
+                elif id(child) not in removed:
+                    contents.append(child)
+            elif isinstance(child, Comment):
+                continue
+            elif (type(child) is NavigableString and id(tag) not in preformatted
+                  and WHITESPACE_PATTERN.search(child)):
+                # collapse the whitespace of the text, doctypes, CDATA and the like are kept as they are
+                contents.append(NavigableString(WHITESPACE_PATTERN.sub(' ', child)))
+            else:
+                contents.append(child)
+        replace_contents(tag, contents)
+        if tag is soup:
+            continue
+
+        # Remove unnecessary attributes except for id
+        tag.attrs = {'id': tag['id']} if 'id' in tag.attrs else {}
+        children = [child for child in contents if isinstance(child, Tag) or child.strip()]
+        if not children and tag.name not in KEEP_EMPTY_TAGS:
+            removed.add(id(tag))
+        elif tag.name in STYLE_TAGS and 'id' not in tag.attrs:
+            unwrapped.add(id(tag))
+        elif (tag.name in CONTAINER_TAGS and len(children) == 1 and isinstance(children[0], Tag)
+              and ('id' not in tag.attrs or 'id' in children[0].attrs)):
+            unwrapped.add(id(tag))
+
+    # drop the whitespace between block tags, a space is dropped if the element before it, after the spaces
+    # dropped before it, or the element after it is missing or a block tag
+    def is_boundary(sibling):
+        return sibling is None or (isinstance(sibling, Tag) and sibling.name in STRUCTURAL_TAGS)
+
+    for tag in [soup] + soup.find_all(True):
+        if id(tag) in preformatted:
+            continue
+        contents = []
+        for index, child in enumerate(tag.contents):
+            next_sibling = tag.contents[index + 1] if index + 1 < len(tag.contents) else None
+            if (isinstance(child, NavigableString) and child == ' '
+                    and (is_boundary(contents[-1] if contents else None) or is_boundary(next_sibling))):
+                continue
+            contents.append(child)
+        replace_contents(tag, contents)
+
+    return str(soup)
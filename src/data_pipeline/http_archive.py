@@ -0,0 +1,176 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+ARCHIVE_MODES = ['record', 'replay']
+
+
+class HTTPArchive:
+    """
+    Local archive of HTTP request/response pairs. The index file 'index.jsonl' holds one record per response with
+    the method, URL, status code, reason and headers (including Content-Disposition), and the bodies are stored
+    in the 'bodies' folder under the SHA-256 of their content.
+    """
+
+    def __init__(self, archive_path):
+        """
+        Args:
+            archive_path (str): The directory of the archive.
+        """
+        self.archive_path = archive_path
+        self.index_path = os.path.join(archive_path, 'index.jsonl')
+        self.bodies_path = os.path.join(archive_path, 'bodies')
+        self._lock = threading.Lock()
+        self._records = None
+        os.makedirs(self.bodies_path, exist_ok=True)
+
+    @staticmethod
+    def get_key(method, url, headers=None):
+        """
+        Returns the key of a request. Range requests are archived separately from requests for the full body.
+        """
+        byte_range = (headers or {}).get('Range')
+        return f"{method.upper()} {url}" + (f" [{byte_range}]" if byte_range else "")
+
+    def load(self):
+        """
+        Loads the index of the archive. If a request was recorded several times, the last response is used.
+
+        Returns:
+            dict: The archived records by request key.
+        """
+        with self._lock:
+            if self._records is None:
+                self._records = {}
+                if os.path.exists(self.index_path):
+                    with open(self.index_path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            record = json.loads(line)
+                            self._records[record['key']] = record
+            return self._records
+
+    def add(self, request, response, content):
+        """
+        Appends a request/response pair to the archive.
+
+        Args:
+            request (requests.PreparedRequest): The sent request.
+            response (requests.Response): The received response.
+            content (bytes): The body of the response.
+        """
+        body_hash = hashlib.sha256(content).hexdigest()
+        body_path = os.path.join(self.bodies_path, body_hash)
+        record = {
+            'key': self.get_key(request.method, request.url, request.headers),
+            'method': request.method,
+            'url': request.url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'body': body_hash
+        }
+        self.load()
+        with self._lock:
+            if not os.path.exists(body_path):
+                with open(body_path, 'wb') as f:
+                    f.write(content)
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._records[record['key']] = record
+
+    def get(self, request):
+        """
+        Returns the archived record and body of a request.
+
+        Args:
+            request (requests.PreparedRequest): The request to look up.
+
+        Returns:
+            (dict, bytes) | None: The record and the body, or None if the request is not archived.
+        """
+        record = self.load().get(self.get_key(request.method, request.url, request.headers))
+        if record is None:
+            return None
+        with open(os.path.join(self.bodies_path, record['body']), 'rb') as f:
+            return record, f.read()
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends requests over the network and records every request/response pair,
+    including each redirect, into an HTTPArchive.
+    """
+
+    def __init__(self, archive, **kwargs):
+        self.archive = archive
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # reading the content keeps it available for streaming consumers through iter_content
+        self.archive.add(request, response, response.content)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter that answers requests from an HTTPArchive without any network access.
+    Requests that are not in the archive raise a ConnectionError.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        super().__init__()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        archived = self.archive.get(request)
+        if archived is None:
+            raise requests.ConnectionError(
+                f"{request.method} {request.url} is not in the HTTP archive", request=request)
+        record, content = archived
+
+        response = requests.Response()
+        response.status_code = record['status_code']
+        response.reason = record['reason']
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response.url = record['url']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def mount_archive(session, archive_path, mode):
+    """
+    Mounts a recording or replaying transport adapter for HTTP and HTTPS on a session.
+
+    Args:
+        session (requests.Session): The session to mount the adapter on.
+        archive_path (str): The directory of the archive.
+        mode (str): 'record' to record a crawl into the archive, 'replay' to serve requests from it.
+
+    Returns:
+        HTTPArchive: The archive used by the adapter.
+    """
+    if mode not in ARCHIVE_MODES:
+        raise ValueError(f"HTTP archive mode must be one of {ARCHIVE_MODES}")
+    archive = HTTPArchive(archive_path)
+    if mode == 'record':
+        # keep the connection pool size of the adapter that is replaced
+        pool_size = getattr(session.get_adapter('https://'), '_pool_maxsize', 10)
+        adapter = RecordingAdapter(archive, pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = ReplayAdapter(archive)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return archive
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .disk_cache import LRUDirectory
+from .http_archive import mount_archive, ARCHIVE_MODES
+
+
+def create_session(pool_size=10):
+    """
+    Creates a requests session whose connection pool can be shared between threads.
+
+    Args:
+        pool_size (int): The maximum number of pooled connections per host (default is 10).
+
+    Returns:
+        requests.Session: The session with keep-alive connection pooling.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostLimiter:
+    """
+    Limits the number of concurrent requests to the same host across threads.
+    """
+
+    def __init__(self, max_connections_per_host=4):
+        self.max_connections_per_host = max_connections_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url):
+        """
+        Blocks until a connection slot for the host of the given URL is free and holds it inside the block.
+
+        Args:
+            url (str): The URL that is about to be requested.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.max_connections_per_host))
+        with semaphore:
+            yield
+
+
+class HTTPCache:
+    """
+    On-disk HTTP response cache keyed by request method and URL. Every entry is stored as a body file and a
+    JSON metadata file with the status code, the headers and the ETag/Last-Modified validators. The least recently
+    used entries are evicted when the total size of the bodies exceeds max_size.
+    """
+
+    def __init__(self, cache_path, max_size=2 * 1024**3):
+        """
+        Args:
+            cache_path (str): The directory where the cached responses are stored.
+            max_size (int): The maximum total size of the cached bodies in bytes (default is 2 GB).
+        """
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self._entries = LRUDirectory(cache_path, max_size, '.body', companion_suffixes=('.json',))
+        os.makedirs(cache_path, exist_ok=True)
+
+    def _get_paths(self, url, method):
+        key = hashlib.sha256(f"{method.upper()} {url}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_path, f"{key}.body"), os.path.join(self.cache_path, f"{key}.json")
+
+    def get(self, url, method='GET'):
+        """
+        Returns the cached metadata and body of the given URL.
+
+        Args:
+            url (str): The URL of the cached response.
+            method (str): The request method of the cached response (default is 'GET').
+
+        Returns:
+            (dict, bytes) | None: The metadata and the body, or None if the URL is not cached.
+        """
+        body_path, meta_path = self._get_paths(url, method)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        self._entries.touch(body_path)
+        return meta, content
+
+    def put(self, url, content, headers=None, status_code=200, method='GET'):
+        """
+        Stores a response in the cache. Can also be used to pre-populate the cache, for example for offline use.
+
+        Args:
+            url (str): The URL of the response.
+            content (bytes): The body of the response.
+            headers (dict): The headers of the response.
+            status_code (int): The status code of the response (default is 200).
+            method (str): The request method of the response (default is 'GET').
+        """
+        headers = CaseInsensitiveDict(headers or {})
+        meta = {
+            'url': url,
+            'status_code': status_code,
+            'headers': dict(headers),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored_at': time.time()
+        }
+        body_path, meta_path = self._get_paths(url, method)
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+
+        # write to temporary files first so that concurrent readers never see partial entries
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(body_path + suffix, 'wb') as f:
+            f.write(content)
+        with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(body_path + suffix, body_path)
+        os.replace(meta_path + suffix, meta_path)
+
+        self._entries.add(len(content) - old_size)
+
+    def touch(self, url, method='GET'):
+        """
+        Marks a cached entry as revalidated by updating its stored_at timestamp.
+
+        Args:
+            url (str): The URL of the cached response.
+            method (str): The request method of the cached response (default is 'GET').
+        """
+        _, meta_path = self._get_paths(url, method)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            meta['stored_at'] = time.time()
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+        except (OSError, ValueError):
+            pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of the cached bodies is below max_size.
+        """
+        self._entries.evict()
+
+
+class HTTPClient:
+    """
+    HTTP client shared by the scraper, the downloader and the chatbot. Requests go through one pooled keep-alive
+    session and, if a cache is given, successful responses are stored on disk and revalidated with conditional
+    requests, so that unchanged pages are served from disk on a 304 Not Modified.
+    """
+
+    def __init__(self, cache=None, pool_size=10, max_age=0, offline=False):
+        """
+        Args:
+            cache (HTTPCache): The cache to store the responses in. If not provided, nothing is cached.
+            pool_size (int): The maximum number of pooled connections per host (default is 10).
+            max_age (int): Seconds during which a cached response is used without revalidation (default is 0).
+            offline (bool): Whether to serve only from the cache without any network requests (default is False).
+        """
+        self.cache = cache
+        self.max_age = max_age
+        self.offline = offline
+        self.session = create_session(pool_size=pool_size)
+
+    def get(self, url, use_cache=True, **kwargs):
+        """
+        Sends a GET request, see request.
+        """
+        return self.request('GET', url, use_cache=use_cache, **kwargs)
+
+    def head(self, url, use_cache=True, **kwargs):
+        """
+        Sends a HEAD request, see request. Like requests.head, redirects are not followed by default.
+        """
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, use_cache=use_cache, **kwargs)
+
+    def request(self, method, url, use_cache=True, **kwargs):
+        """
+        Sends a request, answering it from the cache when the cached response is fresh or not modified.
+
+        Args:
+            method (str): The request method, 'GET' or 'HEAD'.
+            url (str): The URL to request.
+            use_cache (bool): Whether to use the cache for this request (default is True).
+            **kwargs: Additional arguments passed to requests.Session.request.
+
+        Returns:
+            requests.Response: The response. Responses served from the cache have the attribute from_cache set.
+        """
+        if self.cache is None or not use_cache or kwargs.get('stream'):
+            return self.session.request(method, url, **kwargs)
+
+        cached = self.cache.get(url, method=method)
+        if cached:
+            meta, content = cached
+            if self.offline or time.time() - meta['stored_at'] < self.max_age:
+                return self._build_response(meta, content)
+        elif self.offline:
+            raise requests.ConnectionError(f"{method} {url} is not in the HTTP cache and the client is offline")
+
+        # revalidate the cached response with a conditional request
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if cached and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        response = self.session.request(method, url, headers=headers, **kwargs)
+
+        if response.status_code == 304 and cached:
+            self.cache.touch(url, method=method)
+            return self._build_response(meta, content)
+        if response.status_code == 200:
+            self.cache.put(url, response.content, headers=response.headers,
+                           status_code=response.status_code, method=method)
+        return response
+
+    @staticmethod
+    def _build_response(meta, content):
+        response = requests.Response()
+        response.status_code = meta['status_code']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response._content = content
+        response._content_consumed = True
+        response.url = meta['url']
+        response.reason = 'OK'
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.from_cache = True
+        return response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the shared HTTP client, creating it on first use from the environment variables HTTP_CACHE_PATH,
+    HTTP_CACHE_MAX_SIZE_MB, HTTP_CACHE_MAX_AGE and HTTP_CACHE_OFFLINE. If HTTP_CACHE_PATH is not set, responses
+    are not cached.
+
+    If HTTP_ARCHIVE_MODE is 'record' or 'replay', every request is recorded into or replayed from the archive in
+    HTTP_ARCHIVE_PATH, see http_archive.mount_archive. The cache is disabled then, so that every request of a
+    run reaches the archive.
+
+    Returns:
+        HTTPClient: The shared HTTP client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            cache = None
+            HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH")
+            HTTP_ARCHIVE_MODE = os.getenv("HTTP_ARCHIVE_MODE", "off").lower()
+            if HTTP_CACHE_PATH and HTTP_ARCHIVE_MODE in ARCHIVE_MODES:
+                print(f"HTTP cache is disabled while the HTTP archive is in '{HTTP_ARCHIVE_MODE}' mode")
+            elif HTTP_CACHE_PATH:
+                cache = HTTPCache(HTTP_CACHE_PATH,
+                                  max_size=int(os.getenv("HTTP_CACHE_MAX_SIZE_MB", 2048)) * 1024**2)
+            _client = HTTPClient(
+                cache=cache,
+                max_age=int(os.getenv("HTTP_CACHE_MAX_AGE", 0)),
+                offline=os.getenv("HTTP_CACHE_OFFLINE", "false").lower() in ["1", "true", "yes"])
+            if HTTP_ARCHIVE_MODE in ARCHIVE_MODES:
+                mount_archive(_client.session, os.getenv("HTTP_ARCHIVE_PATH"), HTTP_ARCHIVE_MODE)
+        return _client
+
+
+def set_client(client):
+    """
+    Replaces the shared HTTP client, for example with a client using a pre-populated offline cache.
+
+    Args:
+        client (HTTPClient): The client to use for all subsequent requests.
+    """
+    global _client
+    with _client_lock:
+        _client = client
@@ -1,12 +1,18 @@
 import os
+import io
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from openai import AsyncOpenAI, OpenAI
 from tqdm.asyncio import tqdm
 from .utils import *
 import asyncio
 from aiolimiter import AsyncLimiter
-import tiktoken
-from bs4 import BeautifulSoup
+from .html_parser import compact_html
+from .file_converter import get_markdown_anchor_texts, get_html_id_texts, load_id_texts, get_tag_id_mode, TAG_ID_PATTERNS
+from .batch_file import BatchFileWriter, get_batch_shards
+from .batch_results import ingest_batch_output, copy_lines, iter_batch_results, build_custom_id_index, get_errors_path, BatchErrorReport, BatchOutputIndex
+from .token_accounting import count_tokens, get_token_counter, estimate_batch_cost, BATCH_INPUT_PRICE_PER_MILLION
 
 max_calls_per_minute = int(os.getenv("MAX_LLM_CALLS_PER_MINUTE", 100))
 if max_calls_per_minute < 1:
@@ -15,9 +21,27 @@ if max_calls_per_minute < 1:
 # Define the rate limit per 60 seconds
 limiter = AsyncLimiter(max_calls_per_minute, 60)
 
+REFERENCES_PROMPT = "You are an expert structured data extractor. The provided text contains meeting agenda item and references to historical agenda items and decisions."
+
+REFERENCES_JSON_SCHEMA = json.dumps({
+        "type": "object",
+        "properties": {
+        "references": {
+            "type": "array",
+            "description": "An array of historical references in string format.",
+            "items": {
+            "type": "string",
+            "description": "List of historical or previous references (e.g. 'Stadsfullmäktige 15.6.2023, 28 §'). Current reference should not be included."
+            }
+        }
+        },
+        "required": ["references"],
+        "additionalProperties": False
+    }, indent=0, ensure_ascii=False)
+
 def calculate_token_count(text):
     """
-    Calculates the number of tokens in a text using tiktoken
+    Calculates the number of tokens in a text using tiktoken, see token_accounting.count_tokens.
 
     Args:
         text (str): The text to calculate the token count for.
@@ -25,8 +49,7 @@ def calculate_token_count(text):
     Returns:
         int: The number of tokens in the text.
     """
-    encoding = tiktoken.encoding_for_model(os.getenv("OPENAI_MODEL_NAME"))
-    return len(encoding.encode(text))
+    return count_tokens(text)
 
 def create_extraction_task(model, system_prompt, user_prompt, json_schema):
     return {
@@ -62,13 +85,46 @@ def update_json_with_html(json_data, html_content):
     Returns:
     dict: JSON data with IDs replaced by corresponding text from HTML content.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
+    return update_json_with_ids(json_data, get_html_id_texts(html_content).get)
+
+def update_json_with_markdown(json_data, markdown_content):
+    """
+    Replaces IDs in JSON data with corresponding text from the anchored blocks of markdown content.
+
+    Args:
+    json_data (dict): JSON data with IDs to be replaced.
+    markdown_content (str): Markdown content converted by file_converter with anchors for the IDs.
+
+    Returns:
+    dict: JSON data with IDs replaced by corresponding text from markdown content.
+    """
+    return update_json_with_ids(json_data, get_markdown_anchor_texts(markdown_content).get)
+
+def update_json_with_ids(json_data, get_text, unresolved_ids=None, id_mode=None):
+    """
+    Replaces IDs in JSON data with the text returned for them.
+
+    Args:
+    json_data (dict): JSON data with IDs to be replaced.
+    get_text (callable): Returns the text of an ID, or None if the ID is not found.
+    unresolved_ids (list): If provided, the IDs that are not found in values that consist of IDs only are added to it once,
+        these are IDs the model made up. Only values in the format of the IDs of the id mode count as IDs.
+    id_mode (str): The mode of the IDs of the document, see file_converter.get_tag_id_mode.
+
+    Returns:
+    dict: JSON data with IDs replaced by their text.
+    """
+    id_pattern = TAG_ID_PATTERNS[get_tag_id_mode(id_mode)]
+
     def replace_ids(value):
         if isinstance(value, str):
             ids = [id_val.strip() for id_val in value.split(',')]
-            # Replace each ID with its text content from HTML or keep the ID if not found
-            return " ".join(soup.find(id=id_val).get_text(strip=True) if soup.find(id=id_val) else id_val for id_val in ids)
+            # Replace each ID with its text content or keep the ID if not found
+            texts = [get_text(id_val) for id_val in ids]
+            if unresolved_ids is not None and all(id_pattern.fullmatch(id_val) for id_val in ids):
+                # values of objects are replaced twice, an unresolved ID is listed once
+                unresolved_ids.extend(id_val for text, id_val in zip(texts, ids) if text is None and id_val not in unresolved_ids)
+            return " ".join(text if text is not None else id_val for text, id_val in zip(texts, ids))
         return value
 
     def process_json(data):
@@ -100,81 +156,160 @@ def update_json_with_html(json_data, html_content):
 
     return json_data
 
-def save_metadata_llm_batch_results(output_jsonl, filepaths):
+def get_duplicates_path(batch_file_path):
+    """
+    Returns the path of the file listing the tasks left out of a batch file because their document is a duplicate.
+    """
+    return os.path.splitext(batch_file_path)[0] + "_duplicates.json"
+
+def expand_batch_output(output_lines, batch_file_path):
+    """
+    Fans the results of a batch job out to the duplicate documents that were left out of the batch file,
+    by adding a copy of the result line for every duplicate custom ID. The output is expanded as it is read.
+
+    Args:
+        output_lines (str | iterable): JSONL output of the LLM batch job, or its lines, for example an open file.
+        batch_file_path (str): The path to the batch file of the job.
+
+    Yields:
+        str: The lines of the output, each followed by its copies for the duplicate documents.
+    """
+    if isinstance(output_lines, str):
+        output_lines = io.StringIO(output_lines)
+    duplicates = {}
+    if batch_file_path and os.path.exists(get_duplicates_path(batch_file_path)):
+        with open(get_duplicates_path(batch_file_path), 'r', encoding='utf-8') as file:
+            duplicates = json.load(file)
+
+    for line in output_lines or []:
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        yield line + "\n"
+        if not duplicates:
+            continue
+        try:
+            line_json = json.loads(line)
+        except json.JSONDecodeError:
+            # the line is reported by the ingestion
+            continue
+        for custom_id in duplicates.get(line_json.get("custom_id"), []):
+            yield json.dumps({**line_json, "custom_id": custom_id}, ensure_ascii=False) + "\n"
+
+def get_unresolved_ids_path(batch_file_path):
+    """
+    Returns the path of the file listing the IDs in the results of a batch job that are not in their documents.
+    """
+    return os.path.splitext(batch_file_path)[0] + "_unresolved_ids.json"
+
+def save_metadata_llm_batch_results(output_jsonl, filepaths, batch_file_path=None, max_workers=8):
     """
     Saves the LLM batch results in the same directory as the HTML files.
 
     Args:
-    - output_jsonl: str, JSONL output of the LLM batch job for metadata extraction
+    - output_jsonl: str or iterable, JSONL output of the LLM batch job for metadata extraction, or its lines, for example an open file
     - filepaths: list, filepaths of the HTML files used in the LLM batch job
+    - batch_file_path: str, path to the batch file of the job, used to fan results out to duplicate documents. Defaults to METADATA_BATCH_FILE_PATH.
+      Results that cannot be saved are reported next to it, see batch_results.get_errors_path
+    - max_workers: int, number of threads saving the results
     """
-    output_lines = output_jsonl.splitlines()
-    for line in output_lines:
-        line = json.loads(line)
-        filepath = retrieve_filepath_from_custom_id(line["custom_id"], filepaths)
-        line_json = json.loads(line["response"]["body"]["choices"][0]["message"]["content"])
+    batch_file_path = batch_file_path or os.getenv("METADATA_BATCH_FILE_PATH")
+
+    def save_result(content, filepath, custom_id):
+        line_json = json.loads(content)
         path = os.path.dirname(filepath)
         final_path = os.path.join(path, "llm_meeting_metadata.json")
         with open(final_path, "w", encoding="utf-8") as f:
             json.dump(line_json, f, indent=4, ensure_ascii=False)
-    # save raw llm outputs
+
+    # save raw llm outputs while they are ingested
     save_path = "..\\data\\temp\\llm_metadata_batch_output.jsonl"
     with open(save_path, "w", encoding="utf-8") as f:
-        f.write(output_jsonl)
+        ingest_batch_output(copy_lines(expand_batch_output(output_jsonl, batch_file_path), f), filepaths, save_result,
+                            error_report_path=get_errors_path(batch_file_path) if batch_file_path else None, max_workers=max_workers)
 
-def save_agenda_llm_batch_results(output_jsonl, filepaths, replace_ids=True, references_jsonl=None):
+def save_agenda_llm_batch_results(output_jsonl, filepaths, replace_ids=True, references_jsonl=None, batch_file_path=None, references_batch_file_path=None, max_workers=8, side_outputs=None):
     """
     Saves the LLM batch results in the same directory as the HTML files.
 
     Args:
-    - output_jsonl: str, JSONL output of the LLM batch job for agenda extraction 
+    - output_jsonl: str or iterable, JSONL output of the LLM batch job for agenda extraction, or its lines, for example an open file
     - filepaths: list, filepaths of the HTML files used in the LLM batch job
     - replace_ids: bool, whether to replace IDs in the JSON data with corresponding text from HTML content
-    - references_jsonl: str, JSONL output of the LLM batch job for references extraction
-    """
-    output_lines = output_jsonl.splitlines()
-    references_lines = references_jsonl.splitlines() if references_jsonl else []
-    output_jsonl = ""
-    for line in output_lines:
-        line = json.loads(line)
-        filepath = retrieve_filepath_from_custom_id(line["custom_id"], filepaths)
+    - references_jsonl: str or iterable, JSONL output of the LLM batch job for references extraction, or its lines
+    - batch_file_path: str, path to the batch file of the agenda job, used to fan results out to duplicate documents. Defaults to AGENDA_BATCH_FILE_PATH
+    - references_batch_file_path: str, path to the batch file of the references job. Defaults to REFERENCES_BATCH_FILE_PATH
+    - max_workers: int, number of threads saving the results
+    - side_outputs: dict, JSONL outputs of other per-document batch jobs by name, whose fields are added to the result with the same custom ID, like the references
+    """
+    batch_file_path = batch_file_path or os.getenv("AGENDA_BATCH_FILE_PATH")
+
+    # the IDs the model made up, by custom ID
+    unresolved_ids = {}
+
+    # the side outputs are parsed once and indexed by custom ID for the join
+    side_output_indexes = [BatchOutputIndex(side_output) for side_output in (side_outputs or {}).values()]
+    if references_jsonl:
+        # save raw llm outputs for references while they are indexed
+        save_path = "..\\data\\temp\\llm_references_batch_output.jsonl"
+        with open(save_path, "w", encoding="utf-8") as f:
+            references_lines = expand_batch_output(
+                references_jsonl, references_batch_file_path or os.getenv("REFERENCES_BATCH_FILE_PATH"))
+            side_output_indexes.append(BatchOutputIndex(copy_lines(references_lines, f)))
+
+    def save_result(content, filepath, custom_id):
+        # the IDs are resolved from the web HTML, the converted HTML or the converted markdown, whichever exists
         html_path = convert_file_path(filepath, "webhtml")
         if not os.path.exists(html_path):
             html_path = convert_file_path(filepath, "html")
-        with open(html_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
-        line_json = json.loads(line["response"]["body"]["choices"][0]["message"]["content"])
-        output_jsonl += line["response"]["body"]["choices"][0]["message"]["content"] + "\n"
+        if not os.path.exists(html_path):
+            html_path = convert_file_path(filepath, "md")
+        line_json = json.loads(content)
         if replace_ids:
-            final_json = update_json_with_html(line_json, html_content)
+            # the texts of the IDs are cached next to the document, see load_id_texts
+            document_unresolved_ids = []
+            final_json = update_json_with_ids(line_json, load_id_texts(html_path).get, unresolved_ids=document_unresolved_ids)
+            if document_unresolved_ids:
+                unresolved_ids[custom_id] = document_unresolved_ids
         else:
             final_json = line_json    
 
-        # add references to the final JSON by matching the custom ID, string indices must be integers, not 'str'
-        references_line = next((ref_line for ref_line in references_lines if json.loads(ref_line)["custom_id"] == line["custom_id"]), None)
-        if references_line:
-            references_json = json.loads(references_line)["response"]["body"]["choices"][0]["message"]["content"]
-            references_data = json.loads(references_json)
-            final_json["references"] = references_data["references"]
+        # add the references and the other side outputs to the final JSON by matching the custom ID
+        for side_output_index in side_output_indexes:
+            side_output_data = side_output_index.get(custom_id)
+            if side_output_data:
+                final_json.update(side_output_data)
 
         # save final json in the same path as the html file
         path = os.path.dirname(filepath)
         final_path = os.path.join(path, "llm_meeting_agenda.json")
         with open(final_path, "w", encoding="utf-8") as f:
             json.dump(final_json, f, indent=4, ensure_ascii=False)
-    
-    # save raw llm outputs for agenda
-    save_path = "..\\data\\temp\\llm_agenda_batch_output.jsonl"
-    with open(save_path, "w", encoding="utf-8") as f:
-        f.write(output_jsonl)
 
-    # save raw llm outputs for references
-    if references_jsonl:
-        save_path = "..\\data\\temp\\llm_references_batch_output.jsonl"
-        with open(save_path, "w", encoding="utf-8") as f:
-            f.write(references_jsonl)
+    try:
+        # save raw llm outputs for agenda while they are ingested
+        ingest_batch_output(expand_batch_output(output_jsonl, batch_file_path), filepaths, save_result,
+                            error_report_path=get_errors_path(batch_file_path) if batch_file_path else None, max_workers=max_workers,
+                            contents_path="..\\data\\temp\\llm_agenda_batch_output.jsonl")
+    finally:
+        for side_output_index in side_output_indexes:
+            side_output_index.close()
+
+    # report the IDs that are not in the documents next to the batch file
+    if unresolved_ids:
+        print(f"{sum(map(len, unresolved_ids.values()))} IDs in {len(unresolved_ids)} results are not in their documents" +
+              (f", see {get_unresolved_ids_path(batch_file_path)}" if batch_file_path else "."))
+    if batch_file_path and (unresolved_ids or os.path.exists(get_unresolved_ids_path(batch_file_path))):
+        with open(get_unresolved_ids_path(batch_file_path), "w", encoding="utf-8") as file:
+            json.dump(unresolved_ids, file, indent=4, ensure_ascii=False)
+
+def get_compaction_report_path(batch_file_path):
+    """
+    Returns the path of the file with the token counts of the documents of a batch file before and after compaction.
+    """
+    return os.path.splitext(batch_file_path)[0] + "_compaction.json"
 
-def create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=False, batch_file_path=None):
+def create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=False, batch_file_path=None, compact=True):
     """
     Creates a batch file for extracting meeting data from meeting documents using OpenAI Batch API.
 
@@ -184,6 +319,9 @@ def create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=False
         json_schema (dict): The JSON schema to use for the extraction task.
         overwrite_batch_file (bool): If True, the batch file will be overwritten. If False, the tasks will be appended to the batch file.
         batch_file_path (str): The path to the batch file. If not provided, the default batch file path will be used.
+            The file is split into shards at the limits of the Batch API, see BatchFileWriter.
+        compact (bool): If True, HTML documents are compacted with compact_html before they are sent, and the token counts
+            before and after compaction are saved per document next to the batch file.
     """
 
     if not os.path.exists(batch_file_path):
@@ -201,9 +339,37 @@ def create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=False
             return 
 
     token_count = 0
+    # the prompt and the schema are the same in every task, they are counted once
+    token_counter = get_token_counter()
+    static_token_count = token_counter.count(f"{prompt} {json_schema}")
+    # custom IDs of the tasks by the hash of their document, and the custom IDs of the duplicate documents left out by custom ID of their task
+    task_ids = {}
+    duplicates = {}
+    compaction_report = {}
+    # the tasks are streamed into the batch file, which is split into shards at the limits of the Batch API
+    writer = BatchFileWriter(batch_file_path)
+    writer.open()
     for filepath in filepaths:
         with open(filepath, encoding='utf-8') as doc:
             text = doc.read()
+
+        # documents with identical content are sent once, their results are fanned out by expand_batch_output
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if text_hash in task_ids:
+            duplicates.setdefault(task_ids[text_hash], []).append(extract_doc_id(filepath))
+            continue
+        task_ids[text_hash] = extract_doc_id(filepath)
+
+        # remove the markup that costs tokens without carrying content, the ids are kept
+        if compact and os.path.splitext(filepath)[1] in ['.html', '.webhtml']:
+            compacted_text = compact_html(text)
+            compaction_report[extract_doc_id(filepath)] = {
+                "tokens_before": token_counter.count(text),
+                # the count is kept for the original document, so that a dry run finds it without compacting
+                "tokens_after": token_counter.count(text, variant="compact", prepare=lambda _: compacted_text)
+            }
+            text = compacted_text
+
         task = {
             "custom_id": extract_doc_id(filepath),
             "method": "POST",
@@ -215,47 +381,81 @@ def create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=False
             )
         }
         # save the task to batch file
-        with open(batch_file_path, "a") as file:
-            file.write(json.dumps(task, indent=None, ensure_ascii=False) + '\n')
+        try:
+            writer.write(task)
+        except ValueError as e:
+            # a task larger than a whole batch file would make its shard fail, the other tasks are still sent
+            print(f"Left out {filepath}: {e}")
+            continue
 
         # calculate the token count and add to the total token count
-        token_count += calculate_token_count(f"{prompt} {text} {json_schema}")
-
-    print(f"Batch file created at {batch_file_path} with {len(filepaths)} tasks.")
-    print(f"Input token count: {token_count}. Approximate input token cost: ${token_count * 1.25/1_000_000:.2f}")
+        token_count += static_token_count + (compaction_report[task["custom_id"]]["tokens_after"]
+                                             if task["custom_id"] in compaction_report else token_counter.count(text))
+    writer.close()
+    token_counter.save()
+
+    # save the duplicates next to the batch file
+    with open(get_duplicates_path(batch_file_path), "w", encoding="utf-8") as file:
+        json.dump(duplicates, file, indent=4, ensure_ascii=False)
+
+    if compaction_report:
+        with open(get_compaction_report_path(batch_file_path), "w", encoding="utf-8") as file:
+            json.dump(compaction_report, file, indent=4, ensure_ascii=False)
+        tokens_before = sum(counts["tokens_before"] for counts in compaction_report.values())
+        tokens_after = sum(counts["tokens_after"] for counts in compaction_report.values())
+        print(f"Compacted {len(compaction_report)} HTML documents from {tokens_before} to {tokens_after} tokens "
+              f"({1 - tokens_after / max(tokens_before, 1):.0%} fewer), see {get_compaction_report_path(batch_file_path)}")
+
+    print(f"Batch file created at {batch_file_path} with {len(task_ids)} tasks.")
+    if len(writer.shards) > 1:
+        print(f"The batch file is split into {len(writer.shards)} shards, which are submitted as separate batch jobs.")
+    if duplicates:
+        print(f"{len(filepaths) - len(task_ids)} duplicate documents left out, their results are copied from the original documents.")
+    print(f"Input token count: {token_count}. Approximate input token cost: ${token_count * BATCH_INPUT_PRICE_PER_MILLION/1_000_000:.2f}")
     
-def submit_batch_job(batch_file_path, input_id_save_path, metadata_description=None):
+def submit_batch_job(batch_file_path, input_id_save_path, metadata_description=None, max_workers=4):
     """
     Submits a batch job for extracting meeting data from meeting documents using OpenAI Batch API.
+    A batch file split into shards by create_batch_file is submitted as one batch job per shard, in parallel.
 
     Args:
         batch_file_path (str): The path to the batch file.
-        input_id_save_path (str): The path to save the batch input file ID.
+        input_id_save_path (str): The path to save the batch input file ID, one batch ID per line.
         metadata_description (str): The description of the metadata for the batch job.
+        max_workers (int): The maximum number of shards uploaded and submitted at the same time (default is 4).
+
+    Returns:
+        str | list: The batch ID, or the batch IDs of the shards if the batch file has several shards.
     """
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    if not os.path.exists(batch_file_path):
-        raise FileNotFoundError(
-            f"Batch file not found at {batch_file_path}. Please check if the file exists or if the path is correct.")
-    batch_input_file = client.files.create(file=open(batch_file_path, "rb"), purpose="batch")
-    batch_input_file_id = batch_input_file.id
-
-    batch = client.batches.create(
-        input_file_id=batch_input_file_id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h",
-        metadata={
-        "description": f"Extract Structured Outputs from Meeting Documents" if not metadata_description else metadata_description,
-        }
-    )
+    shard_paths = get_batch_shards(batch_file_path)
+    for shard_path in shard_paths:
+        if not os.path.exists(shard_path):
+            raise FileNotFoundError(
+                f"Batch file not found at {shard_path}. Please check if the file exists or if the path is correct.")
+
+    def submit(shard_path):
+        with open(shard_path, "rb") as file:
+            batch_input_file = client.files.create(file=file, purpose="batch")
+        return client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={
+            "description": f"Extract Structured Outputs from Meeting Documents" if not metadata_description else metadata_description,
+            }
+        ).id
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(shard_paths)))) as executor:
+        batch_ids = list(executor.map(submit, shard_paths))
 
     # save batch input file id to a file
     with open(input_id_save_path, "w") as file:
-        file.write(batch.id)
-    print("Batch job submitted successfully.")
-    print(f"Batch ID: {batch.id}")
+        file.write("\n".join(batch_ids))
+    print("Batch job submitted successfully." if len(batch_ids) == 1 else f"{len(batch_ids)} batch jobs submitted successfully.")
+    print(f"Batch ID: {', '.join(batch_ids)}")
     print(f"Batch ID saved at: {input_id_save_path}")
-    return batch.id
+    return batch_ids[0] if len(batch_ids) == 1 else batch_ids
 
 def extract_references_batch(df=None, filetype="html", overwrite_batch_file=False):
     """
@@ -263,7 +463,7 @@ def extract_references_batch(df=None, filetype="html", overwrite_batch_file=Fals
 
     Args:
         df (pandas.DataFrame): The DataFrame containing the meeting data. If not provided, the default DataFrame will be used.
-        filetype (str): The type of file to extract. Can be either "txt" or "html".
+        filetype (str): The type of file to extract. Can be "txt", "html" or "md".
         overwrite_batch_file (bool): If True, the batch file will be overwritten. If False, the tasks will be appended to the batch file.
     """
     # if no dataframe is provided, get the default dataframe
@@ -273,31 +473,91 @@ def extract_references_batch(df=None, filetype="html", overwrite_batch_file=Fals
 
     BATCH_FILE_PATH = os.getenv("REFERENCES_BATCH_FILE_PATH")
 
-    PROMPT = "You are an expert structured data extractor. The provided text contains meeting agenda item and references to historical agenda items and decisions."
-
-    JSON_SCHEMA = {
-            "type": "object",
-            "properties": {
-            "references": {
-                "type": "array",
-                "description": "An array of historical references in string format.",
-                "items": {
-                "type": "string",
-                "description": "List of historical or previous references (e.g. 'Stadsfullmäktige 15.6.2023, 28 §'). Current reference should not be included."
-                }
-            }
-            },
-            "required": ["references"],
-            "additionalProperties": False
-        }
-
-    JSON_SCHEMA = json.dumps(JSON_SCHEMA, indent=0, ensure_ascii=False)
-
     filepaths = df.apply(lambda row: convert_file_path(row['filepath'], filetype), axis=1)
 
-    create_batch_file(filepaths, PROMPT, JSON_SCHEMA, overwrite_batch_file=overwrite_batch_file, batch_file_path=BATCH_FILE_PATH)
+    create_batch_file(filepaths, REFERENCES_PROMPT, REFERENCES_JSON_SCHEMA, overwrite_batch_file=overwrite_batch_file, batch_file_path=BATCH_FILE_PATH)
     return submit_batch_job(BATCH_FILE_PATH, os.getenv("REFERENCES_INPUT_ID_SAVE_PATH"), metadata_description="Extract References from Meeting Documents")
 
+def get_extraction_prompt(type):
+    """
+    Reads the prompt and the JSON schema of an extraction type.
+
+    Args:
+        type (str): The type of data to extract, either "metadata" or "agenda".
+
+    Returns:
+        (str, str): The prompt and the JSON schema.
+    """
+    EXTRACTION_PROMPT_PATH = os.getenv(
+        f"{type.upper()}_EXTRACTION_PROMPT_PATH")
+    
+    JSON_SCHEMA_PATH = os.getenv(f"{type.upper()}_JSON_SCHEMA_PATH")
+
+    # read the prompt text
+    with open(EXTRACTION_PROMPT_PATH, 'r') as file:
+        prompt = file.read()
+
+    # read the json schema
+    with open(JSON_SCHEMA_PATH, 'r') as file:
+        json_schema = json.dumps(json.load(file), indent=0, ensure_ascii=False)
+    return prompt, json_schema
+
+def get_extraction_filepaths(df, filetype="html"):
+    """
+    Returns the filepaths of the documents to extract meeting data from.
+    """
+    # provide webhtml (the html scraped from website) file if available, if not, provide the converted txt or html from pdf
+    return df.apply(lambda row: convert_file_path(row['filepath'], "webhtml") if row['web_html_link']!="" else convert_file_path(row['filepath'], filetype), axis=1)
+
+def estimate_meeting_data_batch(df=None, filetype="html", compact=True, max_workers=4):
+    """
+    Estimates the input tokens, the cost and the duration of the metadata, agenda and references extractions
+    without creating batch files, see token_accounting.estimate_batch_cost. Like create_batch_file, every unique
+    document is counted once and HTML documents are counted compacted. The counts are kept by the hash of the
+    documents in TOKEN_COUNTS_FILE_PATH, so that estimates after the first one only read and hash the documents.
+
+    Args:
+        df (pandas.DataFrame): The DataFrame containing the meeting data. If not provided, the default DataFrame will be used.
+        filetype (str): The type of file to extract. Can be "txt", "html" or "md".
+        compact (bool): Whether HTML documents are counted compacted, see create_batch_file.
+        max_workers (int): The number of tokenizer threads (default is 4).
+
+    Returns:
+        dict: The estimate of every extraction type.
+    """
+    if df is None or df.empty:
+        print("Fetching documents dataframe...")
+        df = get_documents_dataframe()
+
+    agenda_df = filter_agenda(df)
+    extractions = {
+        "metadata": (get_extraction_filepaths(filter_metadata(df), filetype), *get_extraction_prompt("metadata")),
+        "agenda": (get_extraction_filepaths(agenda_df, filetype), *get_extraction_prompt("agenda")),
+        "references": (agenda_df[agenda_df["web_html_link"]!=""].apply(lambda row: convert_file_path(row['filepath'], filetype), axis=1)
+                       if not agenda_df.empty else [], REFERENCES_PROMPT, REFERENCES_JSON_SCHEMA),
+    }
+
+    token_counter = get_token_counter()
+    estimates = {}
+    for type, (filepaths, prompt, json_schema) in extractions.items():
+        # unique documents, the HTML ones separately as they are counted compacted
+        html_texts, other_texts = {}, {}
+        for filepath in filepaths:
+            with open(filepath, encoding='utf-8') as doc:
+                text = doc.read()
+            is_html = compact and os.path.splitext(filepath)[1] in ['.html', '.webhtml']
+            (html_texts if is_html else other_texts)[hashlib.sha256(text.encode('utf-8')).hexdigest()] = text
+        html_estimate = estimate_batch_cost(list(html_texts.values()), prompt, json_schema, token_counter=token_counter,
+                                            variant="compact", prepare=compact_html, max_workers=max_workers)
+        other_estimate = estimate_batch_cost(list(other_texts.values()), prompt, json_schema, token_counter=token_counter,
+                                             max_workers=max_workers)
+        estimates[type] = {key: html_estimate[key] + other_estimate[key] for key in html_estimate}
+        print(f"{type}: {estimates[type]['tasks']} tasks, {estimates[type]['input_tokens']} input tokens, "
+              f"approximate input token cost ${estimates[type]['input_cost']:.2f}, "
+              f"{estimates[type]['minutes']:.0f} minutes at {max_calls_per_minute} calls per minute")
+    token_counter.save()
+    return estimates
+
 def extract_meeting_data_batch(df=None, type=None, filetype="html", overwrite_batch_file=True):
     """
     Creates a batch file to extract meeting data from meeting documents using OpenAI Batch API.
@@ -305,7 +565,7 @@ def extract_meeting_data_batch(df=None, type=None, filetype="html", overwrite_ba
     Args:
         df (pandas.DataFrame): The DataFrame containing the meeting data. If not provided, the default DataFrame will be used.
         type (str): The type of data to extract. Can be either "metadata", "agenda" or None. If None, the function will extract both metadata and agenda.
-        filetype (str): The type of file to extract. Can be either "txt" or "html".
+        filetype (str): The type of file to extract. Can be "txt", "html" or "md".
         overwrite_batch_file (bool): If True, the batch file will be overwritten. If False, the tasks will be appended to the batch file.
 
     Returns:
@@ -330,23 +590,11 @@ def extract_meeting_data_batch(df=None, type=None, filetype="html", overwrite_ba
         raise ValueError(
             "Invalid type. Type must be either 'metadata', 'agenda' or None.")
 
-    EXTRACTION_PROMPT_PATH = os.getenv(
-        f"{type.upper()}_EXTRACTION_PROMPT_PATH")
-    
-    JSON_SCHEMA_PATH = os.getenv(f"{type.upper()}_JSON_SCHEMA_PATH")
-
     BATCH_FILE_PATH = os.getenv(f"{type.upper()}_BATCH_FILE_PATH") 
 
-    # read the prompt text
-    with open(EXTRACTION_PROMPT_PATH, 'r') as file:
-        prompt = file.read()
+    prompt, json_schema = get_extraction_prompt(type)
 
-    # read the json schema
-    with open(JSON_SCHEMA_PATH, 'r') as file:
-        json_schema = json.dumps(json.load(file), indent=0, ensure_ascii=False)
-
-    # provide webhtml (the html scraped from website) file if available, if not, provide the converted txt or html from pdf
-    filepaths = df.apply(lambda row: convert_file_path(row['filepath'], "webhtml") if row['web_html_link']!="" else convert_file_path(row['filepath'], filetype), axis=1)
+    filepaths = get_extraction_filepaths(df, filetype)
         
     print(f"Creating batch extraction job for {type}...")
     create_batch_file(filepaths, prompt, json_schema, overwrite_batch_file=overwrite_batch_file, batch_file_path=BATCH_FILE_PATH)
@@ -371,8 +619,12 @@ def extract_meeting_data_batch(df=None, type=None, filetype="html", overwrite_ba
 
 def check_batch_status(batch_id):
     """
-    Checks the status of the batch.
+    Checks the status of the batch. For the batch IDs of a sharded batch file, the output file IDs
+    are returned once all the batches have completed.
     """
+    if isinstance(batch_id, (list, tuple)):
+        output_file_ids = [check_batch_status(shard_batch_id) for shard_batch_id in batch_id]
+        return output_file_ids if all(output_file_ids) else None
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     batch_status = client.batches.retrieve(batch_id)
     status = batch_status.status
@@ -388,18 +640,21 @@ def check_batch_status(batch_id):
 def retrieve_batch_output(file_id):
     """
     Retrieves the content of the output file using the given file ID.
-    Returns the content of the output file.
+    Returns the content of the output file. The outputs of several file IDs are joined into one JSONL.
     """
     if not file_id:
         print("No file ID provided.")
         return None
+    if isinstance(file_id, (list, tuple)):
+        return "\n".join(retrieve_batch_output(shard_file_id).rstrip("\n") for shard_file_id in file_id)
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     output_content = client.files.content(file_id)
     return output_content.text
 
 def retrieve_filepath_from_custom_id(custom_id, filepaths):
     """
-    Retrieves the filepath from the custom ID.
+    Retrieves the filepath from the custom ID. To look up the filepaths of many custom IDs,
+    build the index once with batch_results.build_custom_id_index.
 
     Args:
         custom_id (str): The custom ID to search for.
@@ -414,7 +669,7 @@ def retrieve_filepath_from_custom_id(custom_id, filepaths):
     return None
 
 
-async def extract_meeting_data_batch_from_output(output_file_id, df, type):
+async def extract_meeting_data_batch_from_output(output_file_id, df, type, max_workers=8):
     """
     Extracts the meeting data from the output file using the given file ID.
 
@@ -422,23 +677,49 @@ async def extract_meeting_data_batch_from_output(output_file_id, df, type):
         output_file_id (str): The file ID of the output file.
         df (pandas.DataFrame): The DataFrame containing the meeting data. Should be the same DataFrame used to create the batch.
         type (str): The type of data to extract. Can be either "metadata", "agenda".
+        max_workers (int): The number of results saved at the same time. The output is read as results finish, so
+            only that many results are held at a time. Results that cannot be saved are reported next to the batch
+            file, see batch_results.get_errors_path.
     """
+    batch_file_path = os.getenv(f"{type.upper()}_BATCH_FILE_PATH")
     output_content = retrieve_batch_output(output_file_id)
-    output_lines = output_content.splitlines()
+    output_content = expand_batch_output(output_content, batch_file_path)
     original_df = get_documents_dataframe()
-    for line in output_lines:
+
+    # the rows of the documents and the attachments of every document are looked up once, not for every result
+    row_indexes = {}
+    for index, filepath in zip(df.index, df['filepath']):
+        row_indexes.setdefault(filepath, index)
+    attachments_by_parent = dict(tuple(original_df.groupby('parent_link')))
+    no_attachments = original_df.iloc[0:0]
+
+    error_report = BatchErrorReport(get_errors_path(batch_file_path) if batch_file_path else None)
+
+    async def save_result(content, filepath, custom_id):
         try:
-            response = json.loads(line)
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON: {line}")
-        if response.get("error"):
-            print(f"Error processing task {response['custom_id']}: {response['error']}")
-        else:
-            filepath = retrieve_filepath_from_custom_id(response['custom_id'], df['filepath'])
-            if not filepath:
-                print(f"Filepath not found for custom ID {response['custom_id']}")
-                continue
-            await combine_and_save_data(response["response"]["body"]["choices"][0]["message"]["content"], filepath, df, original_df, type=type)
+            index = row_indexes[filepath]
+            attachments = attachments_by_parent.get(df.at[index, 'doc_link'], no_attachments) if type == 'agenda' else None
+            await combine_and_save_data(json.loads(content), filepath, df, original_df, type=type, index=index, attachments=attachments)
+        except Exception as e:
+            error_report.add(custom_id, e)
+
+    # the next result is only read when one of the results being saved is done
+    pending = set()
+    try:
+        for custom_id, filepath, content in iter_batch_results(output_content, build_custom_id_index(df['filepath']), error_report):
+            if len(pending) >= max_workers:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.ensure_future(save_result(content, filepath, custom_id)))
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        # the results still being saved when the ingestion is cancelled or fails are not saved
+        for task in pending:
+            task.cancel()
+        error_report.close()
+    if error_report.count:
+        print(f"{error_report.count} batch results could not be saved" +
+              (f", see {error_report.report_path}" if error_report.report_path else "."))
 
 async def extract_meeting_data(df=None, type=None):
     """
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+from functools import lru_cache
+
+import tiktoken
+
+# Encoding for models that tiktoken does not know
+DEFAULT_ENCODING = 'o200k_base'
+# Price of a million input tokens with the Batch API, in dollars
+BATCH_INPUT_PRICE_PER_MILLION = 1.25
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def get_encoding(model=None):
+    """
+    Returns the tiktoken encoding of a model. Encodings are loaded once per model and reused.
+
+    Args:
+        model (str): The name of the model. Defaults to the environment variable OPENAI_MODEL_NAME.
+
+    Returns:
+        tiktoken.Encoding: The encoding of the model, or o200k_base if tiktoken does not know the model.
+    """
+    return _get_encoding(model or os.getenv("OPENAI_MODEL_NAME"))
+
+
+def count_tokens(text, model=None):
+    """
+    Counts the tokens of a text, see get_encoding.
+    """
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+class TokenCounter:
+    """
+    Token counter that keeps the count of every document in a JSON file, keyed by the model, the SHA-256 hash
+    of the content and a variant, so that documents are only tokenized again when they change. The variant
+    distinguishes counts of a derived text, for example 'compact' for the count of the compacted HTML, which
+    can then be looked up by the hash of the original document without compacting it.
+    """
+
+    def __init__(self, model=None, cache_path=None):
+        """
+        Args:
+            model (str): The name of the model. Defaults to the environment variable OPENAI_MODEL_NAME.
+            cache_path (str): The path of the JSON file with the counts. If not provided, the counts are only kept in memory.
+        """
+        self.model = model or os.getenv("OPENAI_MODEL_NAME")
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self.counts = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self.counts = json.load(f)
+
+    def _get_key(self, text, variant=None):
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{self.model}:{variant}:{text_hash}" if variant else f"{self.model}:{text_hash}"
+
+    def count(self, text, variant=None, prepare=None):
+        """
+        Counts the tokens of a text, or of the text derived from it for a variant.
+
+        Args:
+            text (str): The text.
+            variant (str): The name of the derived text, for example 'compact'. Defaults to None, which counts the text itself.
+            prepare (callable): The function deriving the text to count from the text, only called if the count is not known yet.
+
+        Returns:
+            int: The number of tokens.
+        """
+        key = self._get_key(text, variant)
+        count = self.counts.get(key)
+        if count is None:
+            count = count_tokens(prepare(text) if prepare else text, self.model)
+            with self._lock:
+                self.counts[key] = count
+        return count
+
+    def count_documents(self, texts, variant=None, prepare=None, max_workers=4):
+        """
+        Counts the tokens of several texts. The texts whose count is not known yet are tokenized in parallel
+        by the native threads of tiktoken.
+
+        Args:
+            texts (list): The texts.
+            variant (str): See count.
+            prepare (callable): See count.
+            max_workers (int): The number of tokenizer threads (default is 4).
+
+        Returns:
+            list: The number of tokens of every text.
+        """
+        keys = [self._get_key(text, variant) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.counts and key not in missing:
+                missing[key] = prepare(text) if prepare else text
+        if missing:
+            tokens = get_encoding(self.model).encode_ordinary_batch(list(missing.values()), num_threads=max_workers)
+            with self._lock:
+                for key, encoded in zip(missing, tokens):
+                    self.counts[key] = len(encoded)
+        return [self.counts[key] for key in keys]
+
+    def save(self):
+        """
+        Saves the counts to the JSON file, if the counter has one.
+        """
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        with self._lock:
+            with open(self.cache_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.counts, f, indent=0)
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+
+
+def get_token_counter(model=None):
+    """
+    Returns a token counter that keeps its counts in the file of the environment variable TOKEN_COUNTS_FILE_PATH,
+    or only in memory if it is not set.
+    """
+    return TokenCounter(model=model, cache_path=os.getenv("TOKEN_COUNTS_FILE_PATH"))
+
+
+def estimate_batch_cost(texts, prompt, json_schema, token_counter=None, variant=None, prepare=None, max_workers=4, calls_per_minute=None):
+    """
+    Estimates the input tokens, the cost and the duration of an extraction without sending anything. The prompt
+    and the JSON schema, which are the same for every task, are counted once.
+
+    Args:
+        texts (list): The documents of the tasks.
+        prompt (str): The system prompt of the tasks.
+        json_schema (str): The JSON schema of the tasks.
+        token_counter (TokenCounter): The counter to use. Defaults to a counter that keeps its counts in memory.
+        variant (str): The variant of the documents that is sent, see TokenCounter.count.
+        prepare (callable): The function deriving the sent text from a document, see TokenCounter.count.
+        max_workers (int): The number of tokenizer threads (default is 4).
+        calls_per_minute (int): The rate limit of the direct extraction. Defaults to the environment variable MAX_LLM_CALLS_PER_MINUTE or 100.
+
+    Returns:
+        dict: The number of tasks, the input tokens, the input cost in dollars with the Batch API and the minutes
+            the direct extraction takes at the rate limit.
+    """
+    token_counter = token_counter or TokenCounter()
+    calls_per_minute = calls_per_minute or int(os.getenv("MAX_LLM_CALLS_PER_MINUTE", 100))
+    static_token_count = token_counter.count(f"{prompt} {json_schema}")
+    document_token_count = sum(token_counter.count_documents(texts, variant=variant, prepare=prepare, max_workers=max_workers))
+    input_tokens = static_token_count * len(texts) + document_token_count
+    return {
+        "tasks": len(texts),
+        "input_tokens": input_tokens,
+        "input_cost": input_tokens * BATCH_INPUT_PRICE_PER_MILLION / 1_000_000,
+        "minutes": len(texts) / calls_per_minute
+    }
@@ -3,6 +3,7 @@ import os
 import aiofiles
 import pandas as pd
 import re
+from .html_parser import compact_html
 
 def convert_file_path(filepath, filetype='pdf'):
     '''
@@ -350,7 +351,7 @@ def convert_date_to_yyyymmdd(date):
     return re.sub(r'(\d{1,2})\.(\d{1,2})\.(\d{4})', r'\3.\2.\1', date)
 
 
-async def combine_and_save_data(response_json, filepath, df, original_df, type):
+async def combine_and_save_data(response_json, filepath, df, original_df, type, index=None, attachments=None):
     '''
     Combine the data scraped from website and data extracted from the LLM and save it into a JSON file.
 
@@ -360,8 +361,11 @@ async def combine_and_save_data(response_json, filepath, df, original_df, type):
         df (pandas.DataFrame): The DataFrame containing the meeting documents.
         original_df (pandas.DataFrame): The original DataFrame containing all the meeting documents.
         type (str): The type of documents to process. Can be 'metadata' or 'agenda'.
+        index (int): The index of the row of the document in df. Looked up by the filepath if not provided.
+        attachments (pandas.DataFrame): The attachments of the document. Looked up in original_df if not provided.
     '''
-    index = df[df['filepath'] == filepath].index[0]
+    if index is None:
+        index = df[df['filepath'] == filepath].index[0]
     if type == 'metadata':
         response_json['meeting_date'] = df.at[index, 'meeting_date']
         response_json['start_time'] = df.at[index, 'meeting_time']
@@ -380,8 +384,9 @@ async def combine_and_save_data(response_json, filepath, df, original_df, type):
         response_json['title'] = df.at[index, 'title']
         response_json['section'] = df.at[index, 'section']
         # get all the atachments of the row based on parent link
-        attachments = original_df[original_df['parent_link'] == df.at[
-            index, 'doc_link']]
+        if attachments is None:
+            attachments = original_df[original_df['parent_link'] == df.at[
+                index, 'doc_link']]
 
         # add the attachments to the item
         response_json['attachments'] = []
@@ -419,6 +424,8 @@ async def process_html(filepath, df, original_df, client, prompt, limiter, type)
     # Open and read the html file
     async with aiofiles.open(convert_file_path(filepath, filetype="html"), encoding='utf-8') as doc:
         text = await doc.read()
+    # remove the markup that costs tokens without carrying content, the ids are kept
+    text = compact_html(text)
 
     async def return_json_response():
         """
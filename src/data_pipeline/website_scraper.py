@@ -1,28 +1,31 @@
-import requests
-from bs4 import BeautifulSoup
 import json
 import pandas as pd
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from urllib.parse import urlparse, parse_qs
 
-from .utils import convert_date_to_yyyymmdd
+from .download_state import iter_scraped_items
+from .http_client import get_client, HostLimiter
+from .html_parser import parse_html
+from .utils import convert_date_to_yyyymmdd, read_json_file
 
 
-def fetch_and_parse(url):
+def fetch_and_parse(url, client=None):
     """
-    Fetches the content of the given URL and returns a BeautifulSoup object parsed with 'html.parser'.
+    Fetches the content of the given URL and returns a BeautifulSoup object parsed with the configured parser backend.
 
     Args:
         url (str): The URL of the webpage to fetch.
+        client (HTTPClient): The HTTP client to fetch the page with. If not provided, the shared client is used.
 
     Returns:
         BeautifulSoup: The parsed HTML content of the page.
     """
     # Make a GET request to fetch the page's HTML content
-    response = requests.get(url)
+    response = (client or get_client()).get(url)
     # Parse the HTML content and return a BeautifulSoup object
-    return BeautifulSoup(response.text, 'html.parser')
+    return parse_html(response.text)
 
 def get_headers(header_row):
     """
@@ -43,19 +46,23 @@ def get_headers(header_row):
             headers.append(header.get_text(strip=True))
     return headers
 
-def scrape_table(table, base_url, depth=1):
+def parse_table(table, base_url, depth=1, frontier=None):
     """
-    Recursively scrapes data from tables, including nested tables, and returns the data as a list of dictionaries.
-    The JSON output has a generic structure to facilitate recursive scraping. It is a JSON representation of the table.
+    Scrapes a single table without following the links to nested tables. Every nested link gets an empty
+    'nested_data' list which is appended to the frontier together with the depth of the nested table,
+    so that the caller can fetch it and fill the list in place.
 
     Args:
         table (bs4.element.Tag): The <table> element to scrape.
         base_url (str): The base URL of the website.
         depth (int): The depth of the table in the nested structure (default is 1).
+        frontier (list): List that collects (link_entry, nested_depth) tuples of the nested tables still to be scraped.
 
     Returns:
         list: A list of dictionaries containing the scraped data.
     """
+    if frontier is None:
+        frontier = []
 
     data = []
     # Find the header row of the table (if any)
@@ -117,15 +124,14 @@ def scrape_table(table, base_url, depth=1):
                         temp_link_data['title'] = doctype_7_text if doctype_7_text else link_text
                 # Check if it's a link to nested data (id or bid)
                 elif 'id' in href or 'bid' in href:
-                    nested_url = base_url + href
-                    nested_soup = fetch_and_parse(nested_url)
-                    nested_tables = nested_soup.find_all('table')
-                    nested_data = scrape_table(nested_tables[0], base_url, depth=depth+1)
-                    link_data.append({
-                        'url': nested_url,
+                    # The nested table is scraped later by the caller, which fills 'nested_data' in place
+                    link_entry = {
+                        'url': base_url + href,
                         'title': link_text,
-                        'nested_data': nested_data
-                    })
+                        'nested_data': []
+                    }
+                    link_data.append(link_entry)
+                    frontier.append((link_entry, depth+1))
             link_data.append(temp_link_data)
 
             row_data[cell_key] = link_data
@@ -136,6 +142,125 @@ def scrape_table(table, base_url, depth=1):
     return data
 
 
+def scrape_frontier(frontier, base_url, on_link_complete=None):
+    """
+    Scrapes the nested tables collected by parse_table one after another, descending recursively.
+
+    Args:
+        frontier (list): List of (link_entry, nested_depth) tuples whose 'nested_data' lists are filled in place.
+        base_url (str): The base URL of the website.
+        on_link_complete (callable): Called with each link entry of the frontier once all tables below it are scraped.
+    """
+    for link_entry, nested_depth in frontier:
+        nested_soup = fetch_and_parse(link_entry['url'])
+        nested_tables = nested_soup.find_all('table')
+        link_entry['nested_data'].extend(
+            scrape_table(nested_tables[0], base_url, depth=nested_depth))
+        if on_link_complete:
+            on_link_complete(link_entry)
+
+
+def crawl_frontier(frontier, base_url, max_workers=8, max_connections_per_host=4, on_link_complete=None):
+    """
+    Scrapes the nested tables collected by parse_table breadth-first with a thread pool sharing one pooled
+    HTTP client. Tables found on the fetched pages are added to the frontier queue until it is empty, and new
+    entries of the initial frontier are only started when there are idle workers.
+
+    Args:
+        frontier (list): List of (link_entry, nested_depth) tuples whose 'nested_data' lists are filled in place.
+        base_url (str): The base URL of the website.
+        max_workers (int): The maximum number of pages fetched at the same time (default is 8).
+        max_connections_per_host (int): The maximum number of concurrent requests to a single host (default is 4).
+        on_link_complete (callable): Called with each link entry of the frontier once all tables below it are scraped.
+    """
+    client = get_client()
+    host_limiter = HostLimiter(max_connections_per_host)
+
+    def fetch(url):
+        # Limit the number of requests in flight to the same host
+        with host_limiter.limit(url):
+            return fetch_and_parse(url, client=client)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Every fetch remembers the link entry of the initial frontier it descends from, and the number of
+        # unfinished fetches below each of those entries tells when its whole subtree is scraped
+        pending = {}
+        remaining_fetches = {}
+        frontier_queue = iter(frontier)
+
+        def submit_from_frontier():
+            # Entries of the initial frontier are only started when workers are idle, so that the
+            # subtrees already started are completed first instead of all pages of one depth at a time
+            while len(pending) < max_workers:
+                item = next(frontier_queue, None)
+                if item is None:
+                    return
+                link_entry, nested_depth = item
+                pending[executor.submit(fetch, link_entry['url'])] = (link_entry, nested_depth, link_entry)
+                remaining_fetches[id(link_entry)] = 1
+
+        submit_from_frontier()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                link_entry, nested_depth, root_link_entry = pending.pop(future)
+                nested_tables = future.result().find_all('table')
+                # Parse the fetched table and queue the tables nested in it
+                nested_frontier = []
+                link_entry['nested_data'].extend(
+                    parse_table(nested_tables[0], base_url, depth=nested_depth, frontier=nested_frontier))
+                for nested_link_entry, nested_link_depth in nested_frontier:
+                    pending[executor.submit(fetch, nested_link_entry['url'])] = (
+                        nested_link_entry, nested_link_depth, root_link_entry)
+
+                remaining_fetches[id(root_link_entry)] += len(nested_frontier) - 1
+                if remaining_fetches[id(root_link_entry)] == 0:
+                    del remaining_fetches[id(root_link_entry)]
+                    if on_link_complete:
+                        on_link_complete(root_link_entry)
+            submit_from_frontier()
+
+
+def scrape_table(table, base_url, depth=1):
+    """
+    Recursively scrapes data from tables, including nested tables, and returns the data as a list of dictionaries.
+    The JSON output has a generic structure to facilitate recursive scraping. It is a JSON representation of the table.
+
+    Args:
+        table (bs4.element.Tag): The <table> element to scrape.
+        base_url (str): The base URL of the website.
+        depth (int): The depth of the table in the nested structure (default is 1).
+
+    Returns:
+        list: A list of dictionaries containing the scraped data.
+    """
+    frontier = []
+    data = parse_table(table, base_url, depth=depth, frontier=frontier)
+    scrape_frontier(frontier, base_url)
+    return data
+
+
+def crawl_table(table, base_url, max_workers=8, max_connections_per_host=4):
+    """
+    Concurrent alternative to scrape_table. Nested tables are fetched breadth-first from a frontier queue by a
+    thread pool sharing one pooled HTTP client, and the output is exactly the same nested JSON as scrape_table.
+
+    Args:
+        table (bs4.element.Tag): The <table> element to scrape.
+        base_url (str): The base URL of the website.
+        max_workers (int): The maximum number of pages fetched at the same time (default is 8).
+        max_connections_per_host (int): The maximum number of concurrent requests to a single host (default is 4).
+
+    Returns:
+        list: A list of dictionaries containing the scraped data.
+    """
+    frontier = []
+    data = parse_table(table, base_url, frontier=frontier)
+    crawl_frontier(frontier, base_url, max_workers=max_workers,
+                   max_connections_per_host=max_connections_per_host)
+    return data
+
+
 def find_meeting_reference(s):
     """
     Finds the meeting reference in a string.
@@ -211,6 +336,161 @@ def process_scraped_data(json_data):
     return grouped_list
 
 
+def get_meeting_key(meeting):
+    """
+    Returns the key identifying a meeting row of the scraped index: body, meeting reference and meeting date.
+
+    Args:
+        meeting (dict): A meeting row as returned by scrape_table.
+
+    Returns:
+        tuple: The (body, meeting_reference, meeting_date) of the meeting.
+    """
+    return (
+        meeting['Verksamhetsorgan'].split(":")[0].strip(),
+        find_meeting_reference(meeting['Verksamhetsorgan']),
+        convert_date_to_yyyymmdd(meeting['Datum'][0]['title'].split(' ')[0].strip())
+    )
+
+
+def get_scraped_meeting_keys(scraped_data):
+    """
+    Returns the keys of all meetings in processed scraped data, in the same format as get_meeting_key.
+
+    Args:
+        scraped_data (list): List of JSON objects containing processed meeting data.
+
+    Returns:
+        set: Set of (body, meeting_reference, meeting_date) tuples.
+    """
+    return {(body['body'], meeting['meeting_reference'], meeting['meeting_date'])
+            for body in scraped_data for meeting in body['meetings']}
+
+
+def merge_scraped_data(existing_data, new_data, meeting_order=None):
+    """
+    Merges newly scraped meetings into existing processed data. A new meeting replaces the existing meeting of the
+    same body with the same meeting reference (or the same date if there is no reference). The 'filepath' fields
+    added by the document downloader are carried over to the documents and attachments at the same place, that is
+    with the same meeting, section and link, see get_item_key.
+
+    Args:
+        existing_data (list): List of JSON objects containing the previously processed meeting data.
+        new_data (list): List of JSON objects containing the newly processed meeting data.
+        meeting_order (list): Meeting keys in the order of the scraped index. Meetings are sorted in this order,
+            meetings missing from it are kept at the end. If not provided, the order is left unchanged.
+
+    Returns:
+        list: List of JSON objects containing the merged meeting data.
+    """
+    # Collect the filepaths of already downloaded files by the place of their item
+    filepaths = {item_key: item['filepath'] for item_key, item in iter_scraped_items(existing_data)
+                 if 'filepath' in item}
+
+    def identifies_same_meeting(a, b):
+        if a['meeting_reference'] or b['meeting_reference']:
+            return a['meeting_reference'] == b['meeting_reference']
+        return a['meeting_date'] == b['meeting_date']
+
+    merged_data = {body['body']: {'body': body['body'], 'meetings': list(body['meetings'])}
+                   for body in existing_data}
+    for body in new_data:
+        merged_body = merged_data.setdefault(body['body'], {'body': body['body'], 'meetings': []})
+        # Keep the filepaths of files that were downloaded before
+        for item_key, item in iter_scraped_items([body]):
+            if item_key in filepaths:
+                item['filepath'] = filepaths[item_key]
+
+        for meeting in body['meetings']:
+            index = next((i for i, existing_meeting in enumerate(merged_body['meetings'])
+                          if identifies_same_meeting(existing_meeting, meeting)), None)
+            if index is None:
+                merged_body['meetings'].append(meeting)
+            else:
+                merged_body['meetings'][index] = meeting
+
+    if meeting_order:
+        positions = {key: position for position, key in enumerate(meeting_order)}
+        for body_name, merged_body in merged_data.items():
+            merged_body['meetings'].sort(key=lambda meeting: positions.get(
+                (body_name, meeting['meeting_reference'], meeting['meeting_date']), len(positions)))
+
+    return list(merged_data.values())
+
+
+def read_scrape_journal(journal_path):
+    """
+    Reads the meetings journalled by an interrupted or running scrape.
+
+    Args:
+        journal_path (str): The path to the JSONL scrape journal.
+
+    Returns:
+        list: List of journal records with the index 'position' and the scraped 'meeting' row.
+    """
+    records = []
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # the last line may be cut off by a crash, the meeting is scraped again
+                continue
+    return records
+
+
+def truncate_scrape_journal(journal_path):
+    """
+    Truncates the scrape journal after its last complete line. The last line may be cut off by a crash, and the
+    records appended when resuming would otherwise continue it and be lost with it.
+
+    Args:
+        journal_path (str): The path to the JSONL scrape journal.
+    """
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        # search the last newline backwards in chunks, the journal may be large
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline != -1:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def compact_scrape_journal(journal_path, meeting_order=None):
+    """
+    Compacts the scrape journal into the grouped structure returned by process_scraped_data.
+
+    Args:
+        journal_path (str): The path to the JSONL scrape journal.
+        meeting_order (list): Meeting keys in the order of the scraped index. If not provided, the meetings
+            are ordered by the index position stored in the journal.
+
+    Returns:
+        list: List of JSON objects containing processed meeting data.
+    """
+    records = {}
+    for record in read_scrape_journal(journal_path):
+        # a meeting journalled twice keeps its latest record
+        records[get_meeting_key(record['meeting'])] = record
+
+    if meeting_order:
+        positions = {key: position for position, key in enumerate(meeting_order)}
+        sort_key = lambda item: (positions.get(item[0], len(positions)), item[1]['position'])
+    else:
+        sort_key = lambda item: item[1]['position']
+
+    return process_scraped_data([record['meeting'] for _, record in sorted(records.items(), key=sort_key)])
+
+
 def convert_to_df(json_data):
     """
     Converts scraped JSON data into a pandas DataFrame.
@@ -272,7 +552,21 @@ def convert_to_df(json_data):
     return df
 
 
-def main():
+def main(concurrent=True, max_workers=8, max_connections_per_host=4, incremental=False):
+    """
+    Scrapes the meeting index and all nested document tables and saves the processed data.
+
+    Every completed meeting is appended to a JSONL scrape journal while the crawl runs. If the journal of an
+    interrupted run exists, the meetings in it are not scraped again. The journal is compacted into the scraped
+    data file at the end and then removed.
+
+    Args:
+        concurrent (bool): Whether to fetch the nested tables concurrently with crawl_table. Defaults to True.
+        max_workers (int): The maximum number of pages fetched at the same time in concurrent mode. Defaults to 8.
+        max_connections_per_host (int): The maximum number of concurrent requests to a single host. Defaults to 4.
+        incremental (bool): Whether to only descend into meetings that are new or changed compared to the
+            existing scraped data file, and merge them into it. Defaults to False.
+    """
 
     # Load environment variables
     DATA_PATH = os.getenv('DATA_PATH')
@@ -280,17 +574,86 @@ def main():
     parsed_url = urlparse(SCRAPING_START_URL)
     SCRAPING_BASE_URL = f"{parsed_url.scheme}://{parsed_url.netloc}"
     SCRAPED_DATA_FILE_PATH = os.getenv('SCRAPED_DATA_FILE_PATH')
+    SCRAPE_JOURNAL_FILE_PATH = os.getenv(
+        'SCRAPE_JOURNAL_FILE_PATH', os.path.splitext(SCRAPED_DATA_FILE_PATH)[0] + '_journal.jsonl')
+
+    # Load the existing scraped data for incremental scraping
+    existing_data = None
+    if incremental:
+        if os.path.exists(SCRAPED_DATA_FILE_PATH):
+            existing_data = read_json_file(SCRAPED_DATA_FILE_PATH)
+        if not existing_data:
+            print('No existing scraped data found, scraping all meetings...')
+
+    # Resume from the journal of an interrupted run
+    journalled_keys = {get_meeting_key(record['meeting'])
+                       for record in read_scrape_journal(SCRAPE_JOURNAL_FILE_PATH)}
+    if journalled_keys:
+        print(f'Resuming from {SCRAPE_JOURNAL_FILE_PATH} with {len(journalled_keys)} meetings already scraped...')
 
     print('Scraping in progress...')
 
     # Fetch and parse the start URL
     soup = fetch_and_parse(SCRAPING_START_URL)
     tables = soup.find_all('table')  # Find all tables in the page
-    # Start recursive scraping of the found table
-    result = scrape_table(tables[0], SCRAPING_BASE_URL)
+    # Scrape the meeting index without descending into the meetings
+    frontier = []
+    meetings = parse_table(tables[0], SCRAPING_BASE_URL, frontier=frontier)
+    meeting_order = [get_meeting_key(meeting) for meeting in meetings]
+    positions = {id(meeting): position for position, meeting in enumerate(meetings)}
+
+    if existing_data:
+        # Only descend into the meetings that are new or changed since the last run
+        scraped_keys = get_scraped_meeting_keys(existing_data)
+        meetings = [meeting for meeting in meetings if get_meeting_key(meeting) not in scraped_keys]
+        print(f'Found {len(meetings)} new or changed meetings out of {len(meeting_order)}.')
+    meetings = [meeting for meeting in meetings if get_meeting_key(meeting) not in journalled_keys]
+
+    # Map the link entries of the frontier to their meetings, so that a meeting is journalled
+    # as soon as all of its nested tables are scraped
+    meeting_of_link_entry = {}
+    remaining_link_entries = {}
+    for meeting in meetings:
+        link_entries = [entry for value in meeting.values() if isinstance(value, list)
+                        for entry in value if 'nested_data' in entry]
+        for link_entry in link_entries:
+            meeting_of_link_entry[id(link_entry)] = meeting
+        remaining_link_entries[id(meeting)] = len(link_entries)
+    frontier = [item for item in frontier if id(item[0]) in meeting_of_link_entry]
+
+    os.makedirs(os.path.dirname(SCRAPE_JOURNAL_FILE_PATH), exist_ok=True)
+    truncate_scrape_journal(SCRAPE_JOURNAL_FILE_PATH)
+    with open(SCRAPE_JOURNAL_FILE_PATH, 'a', encoding='utf-8') as journal:
+
+        def journal_meeting(meeting):
+            record = {'position': positions[id(meeting)], 'meeting': meeting}
+            journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+            journal.flush()
+
+        def on_link_complete(link_entry):
+            meeting = meeting_of_link_entry.pop(id(link_entry))
+            remaining_link_entries[id(meeting)] -= 1
+            if remaining_link_entries[id(meeting)] == 0:
+                journal_meeting(meeting)
+
+        # Meetings without nested tables are complete already
+        for meeting in meetings:
+            if remaining_link_entries[id(meeting)] == 0:
+                journal_meeting(meeting)
+        # Only the meetings still being scraped are kept in memory
+        del meetings
+
+        # Start recursive scraping of the nested tables
+        if concurrent:
+            crawl_frontier(frontier, SCRAPING_BASE_URL, max_workers=max_workers,
+                           max_connections_per_host=max_connections_per_host, on_link_complete=on_link_complete)
+        else:
+            scrape_frontier(frontier, SCRAPING_BASE_URL, on_link_complete=on_link_complete)
 
     print('Processing scraped data...')
-    result = process_scraped_data(result)
+    result = compact_scrape_journal(SCRAPE_JOURNAL_FILE_PATH, meeting_order=meeting_order)
+    if existing_data:
+        result = merge_scraped_data(existing_data, result, meeting_order=meeting_order)
 
     print(f'Saving scraped data to {SCRAPED_DATA_FILE_PATH}...')
 
@@ -299,6 +662,9 @@ def main():
     with open(SCRAPED_DATA_FILE_PATH, 'w', encoding='utf-8') as f:
         json.dump(result, f, ensure_ascii=False, indent=4)
 
+    # The scraped data is saved, so the journal is not needed for resuming anymore
+    os.remove(SCRAPE_JOURNAL_FILE_PATH)
+
 
 if __name__ == '__main__':
     main()
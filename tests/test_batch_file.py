@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from data_pipeline.batch_file import BatchFileWriter, get_batch_shards, get_shards_path
+
+
+def make_task(custom_id, text='Protokoll'):
+    return {'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': {'input': text}}
+
+
+def read_custom_ids(shard_path):
+    with open(shard_path, encoding='utf-8') as f:
+        return [json.loads(line)['custom_id'] for line in f]
+
+
+def test_shards_by_request_count(tmp_path):
+    batch_file_path = str(tmp_path / 'agenda_batch.jsonl')
+    with BatchFileWriter(batch_file_path, max_requests=2, max_bytes=10**6) as writer:
+        for index in range(5):
+            writer.write(make_task(str(100001 + index)))
+
+    shards = get_batch_shards(batch_file_path)
+    assert shards == [batch_file_path, str(tmp_path / 'agenda_batch_2.jsonl'), str(tmp_path / 'agenda_batch_3.jsonl')]
+    assert [read_custom_ids(shard) for shard in shards] == [['100001', '100002'], ['100003', '100004'], ['100005']]
+    with open(get_shards_path(batch_file_path), encoding='utf-8') as f:
+        assert [shard['requests'] for shard in json.load(f)['shards']] == [2, 2, 1]
+
+
+def test_shards_by_size(tmp_path):
+    batch_file_path = str(tmp_path / 'agenda_batch.jsonl')
+    line_size = len((json.dumps(make_task('100001')) + '\n').encode('utf-8'))
+    with BatchFileWriter(batch_file_path, max_requests=100, max_bytes=2 * line_size + 1) as writer:
+        for index in range(3):
+            writer.write(make_task(str(100001 + index)))
+
+    shards = get_batch_shards(batch_file_path)
+    assert [read_custom_ids(shard) for shard in shards] == [['100001', '100002'], ['100003']]
+    with open(get_shards_path(batch_file_path), encoding='utf-8') as f:
+        assert [shard['bytes'] for shard in json.load(f)['shards']] == [2 * line_size, line_size]
+
+    # a new batch file at the same path removes the shards of the previous one
+    with BatchFileWriter(batch_file_path) as writer:
+        writer.write(make_task('100004'))
+    assert get_batch_shards(batch_file_path) == [batch_file_path]
+    assert not (tmp_path / 'agenda_batch_2.jsonl').exists()
+
+
+def test_task_larger_than_a_shard_is_rejected(tmp_path):
+    batch_file_path = str(tmp_path / 'agenda_batch.jsonl')
+    with BatchFileWriter(batch_file_path, max_bytes=300) as writer:
+        writer.write(make_task('100001'))
+        with pytest.raises(ValueError):
+            writer.write(make_task('100002', 'x' * 500))
+        writer.write(make_task('100003'))
+
+    assert [read_custom_ids(shard) for shard in get_batch_shards(batch_file_path)] == [['100001', '100003']]
@@ -0,0 +1,88 @@
+import json
+import threading
+
+import pytest
+
+from data_pipeline.batch_results import BatchOutputIndex, copy_lines, ingest_batch_output
+
+
+def make_line(custom_id, content=None, error=None):
+    if error:
+        return json.dumps({'custom_id': custom_id, 'error': error})
+    body = {'choices': [{'message': {'content': json.dumps(content)}}]}
+    return json.dumps({'custom_id': custom_id, 'response': {'status_code': 200, 'body': body}})
+
+
+def make_filepath(custom_id):
+    return f'protocols/Council/Protokoll_{custom_id}.pdf'
+
+
+def test_ingest_from_file(tmp_path):
+    output_path = tmp_path / 'output.jsonl'
+    lines = [make_line('100001', {'n': 1}), 'not json', make_line('100002', error={'message': 'failed'}),
+             make_line('100003', {'n': 3}), make_line('999999', {'n': 9})]
+    output_path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    saved = {}
+
+    def save_result(content, filepath, custom_id):
+        saved[filepath] = json.loads(content)
+
+    with open(output_path, encoding='utf-8') as output_file:
+        counts = ingest_batch_output(output_file, [make_filepath(i) for i in ['100001', '100002', '100003']], save_result,
+                                     error_report_path=str(tmp_path / 'errors.jsonl'),
+                                     contents_path=str(tmp_path / 'contents.jsonl'))
+
+    assert counts == (2, 3)
+    assert saved == {make_filepath('100001'): {'n': 1}, make_filepath('100003'): {'n': 3}}
+    assert (tmp_path / 'contents.jsonl').read_text(encoding='utf-8') == '{"n": 1}\n{"n": 3}\n'
+    errors = [json.loads(line) for line in (tmp_path / 'errors.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [error['custom_id'] for error in errors] == [None, '100002', '999999']
+
+
+def test_ingest_reads_a_bounded_number_of_lines_ahead():
+    custom_ids = [str(100000 + i) for i in range(200)]
+    read_count = 0
+    release = threading.Event()
+
+    def output_lines():
+        nonlocal read_count
+        for custom_id in custom_ids:
+            read_count += 1
+            yield make_line(custom_id, {'id': custom_id})
+
+    def save_result(content, filepath, custom_id):
+        # the first results are saved slowly, so the parser has to wait for them
+        release.wait(timeout=5)
+
+    ingestion = threading.Thread(target=ingest_batch_output, args=(
+        output_lines(), [make_filepath(custom_id) for custom_id in custom_ids], save_result), kwargs={'max_workers': 2})
+    ingestion.start()
+    ingestion.join(timeout=0.5)
+    # 8 results in flight, 2 of them being saved, and the line waiting for a free slot
+    assert read_count <= 2 * 4 + 1
+    release.set()
+    ingestion.join()
+    assert read_count == len(custom_ids)
+
+
+def test_copy_lines(tmp_path):
+    with open(tmp_path / 'copy.jsonl', 'w', encoding='utf-8') as f:
+        assert list(copy_lines('{"a": 1}\n{"b": 2}', f)) == ['{"a": 1}\n', '{"b": 2}']
+    assert (tmp_path / 'copy.jsonl').read_text(encoding='utf-8') == '{"a": 1}\n{"b": 2}\n'
+
+
+@pytest.mark.parametrize('max_memory_size', [10**6, 20])
+def test_batch_output_index(max_memory_size):
+    index = BatchOutputIndex([make_line('100001', {'references': ['a']}), 'not json',
+                              make_line('100002', error={'message': 'failed'}),
+                              make_line('100001', {'references': ['duplicate']})], max_memory_size=max_memory_size)
+    index.add_output('\n'.join([make_line('100003', {'references': ['c']}), make_line('100003', {'references': ['d']}),
+                                 make_line('100001', {'references': ['later']})]))
+
+    # the contents are moved to SQLite once they exceed the memory size
+    assert (index._connection is not None) == (max_memory_size == 20)
+    assert len(index) == 2
+    assert index.get('100001') == {'references': ['a']}
+    assert index.get('100003') == {'references': ['c']}
+    assert index.get('100002') is None
+    index.close()
@@ -0,0 +1,59 @@
+import os
+
+from data_pipeline import blob_store
+from data_pipeline.blob_store import BlobStore, group_by_content, hash_file
+
+
+def write_download(path, content):
+    # downloads are written to a partial file and renamed, like document_downloader.finish_download
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.parent / (path.name + '.part')
+    temp_path.write_bytes(content)
+    os.replace(temp_path, path)
+
+
+def test_identical_downloads_share_one_blob(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'))
+    first = tmp_path / 'Council' / '1' / 'Bilaga_100001.pdf'
+    second = tmp_path / 'Council' / '2' / 'Bilaga_100001.pdf'
+    write_download(first, b'%PDF-1.4 Bilaga')
+    write_download(second, b'%PDF-1.4 Bilaga')
+
+    assert store.add(str(first)) == store.add(str(second)) == hash_file(str(first))
+    blob_path = store.get_blob_path(hash_file(str(first)))
+    assert os.stat(first).st_ino == os.stat(second).st_ino == os.stat(blob_path).st_ino
+    assert second.read_bytes() == b'%PDF-1.4 Bilaga'
+
+
+def test_changed_file_gets_a_new_blob(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'))
+    filepath = tmp_path / 'Council' / '1' / 'Protokoll_100001.pdf'
+    write_download(filepath, b'%PDF-1.4 Protokoll')
+    old_hash = store.add(str(filepath))
+
+    write_download(filepath, b'%PDF-1.4 Protokoll, justerat')
+    new_hash = store.add(str(filepath))
+
+    assert new_hash != old_hash and new_hash == hash_file(str(filepath))
+    assert os.path.samefile(filepath, store.get_blob_path(new_hash))
+    with open(store.get_blob_path(old_hash), 'rb') as f:
+        assert f.read() == b'%PDF-1.4 Protokoll'
+
+
+def test_manifest_hashes_are_reused(monkeypatch, tmp_path):
+    store = BlobStore(str(tmp_path / 'store'))
+    linked = tmp_path / 'Council' / '1' / 'Protokoll_100001.pdf'
+    replaced = tmp_path / 'Council' / '1' / 'Protokoll_100002.pdf'
+    write_download(linked, b'%PDF-1.4 Protokoll 1')
+    write_download(replaced, b'%PDF-1.4 Protokoll 2')
+    hashes = {str(path): store.add(str(path)) for path in [linked, replaced]}
+    store.save()
+    # replaced after it was stored, so it is no longer linked to its blob
+    write_download(replaced, b'%PDF-1.4 Protokoll 2, justerat')
+
+    hashed = []
+    monkeypatch.setattr(blob_store, 'hash_file', lambda filepath: hashed.append(filepath) or hash_file(filepath))
+    groups = group_by_content([str(linked), str(replaced)], blob_store=BlobStore(str(tmp_path / 'store')))
+
+    assert list(groups) == [hashes[str(linked)], hash_file(str(replaced))]
+    assert hashed == [str(replaced)]
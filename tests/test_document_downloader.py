@@ -0,0 +1,169 @@
+import http.server
+import multiprocessing
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from data_pipeline import http_client
+from data_pipeline.document_downloader import (
+    download_file, download_named_file, get_temp_file_path, get_validator_path, normalize_web_html)
+from data_pipeline.file_converter import add_ids_to_soup
+from data_pipeline.html_parser import parse_html
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        content = server.content
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (if_range is None or if_range == server.etag):
+            start = int(range_header.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Disposition', 'attachment; filename=Document_100001.pdf')
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        # the body is sent in pieces, so that concurrent downloads overlap
+        for position in range(start, len(content), 1000):
+            self.wfile.write(content[position:position + 1000])
+            time.sleep(server.delay)
+
+
+class FileServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = FileServer(('127.0.0.1', 0), FileHandler)
+    server.content = bytes(range(256)) * 40
+    server.etag = '"v1"'
+    server.delay = 0
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/ktproxy2.dll?doctype=3&docid=100001'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    previous_client = http_client._client
+    http_client.set_client(http_client.HTTPClient())
+    yield server
+    http_client.set_client(previous_client)
+    server.shutdown()
+    server.server_close()
+
+
+def write_partial(server, temp_path, content, validator):
+    temp_file_path = get_temp_file_path(server.url, str(temp_path))
+    temp_path.mkdir(exist_ok=True)
+    with open(temp_file_path, 'wb') as f:
+        f.write(content)
+    if validator:
+        with open(get_validator_path(temp_file_path), 'w', encoding='utf-8') as f:
+            f.write(validator)
+    return temp_file_path
+
+
+def test_resumes_partial_download(server, tmp_path):
+    write_partial(server, tmp_path / 'temp', server.content[:4000], '"v1"')
+    save_path = tmp_path / 'Document_100001.pdf'
+
+    assert download_file(server.url, str(save_path), str(tmp_path / 'temp'))
+    assert save_path.read_bytes() == server.content
+    assert server.requests[0]['Range'] == 'bytes=4000-'
+    assert server.requests[0]['If-Range'] == '"v1"'
+    assert list((tmp_path / 'temp').iterdir()) == []
+
+
+def test_restarts_when_file_changed(server, tmp_path):
+    write_partial(server, tmp_path / 'temp', b'old version of the file', '"v0"')
+    save_path = tmp_path / 'Document_100001.pdf'
+
+    assert download_file(server.url, str(save_path), str(tmp_path / 'temp'))
+    assert save_path.read_bytes() == server.content
+
+
+def test_restarts_partial_without_validator(server, tmp_path):
+    write_partial(server, tmp_path / 'temp', b'partial file of an unknown version', None)
+    save_path = tmp_path / 'Document_100001.pdf'
+
+    assert download_file(server.url, str(save_path), str(tmp_path / 'temp'))
+    assert save_path.read_bytes() == server.content
+    assert 'Range' not in server.requests[0]
+
+
+def test_concurrent_downloads_of_same_url(server, tmp_path):
+    server.delay = 0.002
+    folders = [tmp_path / str(i) for i in range(4)]
+
+    def download(folder):
+        return download_named_file(server.url, lambda filename: str(folder / filename), str(tmp_path / 'temp'))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(download, folders))
+
+    for folder, (filename, save_path) in zip(folders, results):
+        assert filename == 'Document_100001.pdf'
+        assert (folder / filename).read_bytes() == server.content
+
+
+
+def download_in_process(url, folder, temp_path):
+    return download_named_file(url, lambda filename: f'{folder}/{filename}', temp_path)
+
+
+def test_concurrent_downloads_of_same_url_in_processes(server, tmp_path):
+    server.delay = 0.002
+    folders = [tmp_path / str(i) for i in range(4)]
+
+    # forked processes share the partial file, but not the locks of this process
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context('fork')) as executor:
+        results = list(executor.map(download_in_process, [server.url] * 4, map(str, folders), [str(tmp_path / 'temp')] * 4))
+
+    for folder, (filename, save_path) in zip(folders, results):
+        assert filename == 'Document_100001.pdf'
+        assert (folder / filename).read_bytes() == server.content
+
+
+WEB_HTML = ('<html><body><div class="paluu"><a href="/">Tillbaka</a></div><!-- menu -->'
+            '<h1 style="x">Protokoll</h1><table class="t"><tr><td>1</td><td><a href="/doc">Beslut</a></td></tr></table>'
+            '<p class="a">Text</p></body></html>')
+
+
+def normalize(html):
+    return str(normalize_web_html(parse_html(html).find('body')))
+
+
+def test_normalize_web_html(monkeypatch):
+    monkeypatch.setenv('TAG_ID_MODE', 'sequential')
+    assert normalize(WEB_HTML) == ('<body><h1 id="1">Protokoll</h1><table id="2"><tr id="3"><td id="4">1</td>'
+                                   '<td id="5"><a>Beslut</a></td></tr></table><p id="6">Text</p></body>')
+
+
+@pytest.mark.parametrize('id_mode', ['sequential', 'content'])
+def test_normalize_web_html_is_idempotent(monkeypatch, id_mode):
+    monkeypatch.setenv('TAG_ID_MODE', id_mode)
+    normalized = normalize(WEB_HTML)
+    assert normalize(f'<html>{normalized}</html>') == normalized
+
+
+def test_normalize_web_html_content_ids(monkeypatch):
+    monkeypatch.setenv('TAG_ID_MODE', 'content')
+    html = '<html><body>' + '<div class="c">' * 2000 + 'Text' + '</div>' * 2000 + '<p>Slut</p></body></html>'
+    # the same ids as stamping the whole body at once, hashed in one pass instead of once per tag
+    expected = parse_html(html).find('body')
+    for tag in expected.find_all(True):
+        tag.attrs = {}
+    add_ids_to_soup(expected, id_mode='content')
+    assert normalize(html) == str(expected)
@@ -0,0 +1,69 @@
+import sqlite3
+
+from data_pipeline.download_state import DownloadState, apply_download_state, get_item_key, FAILED
+
+
+def make_scraped_data(shared_link):
+    return [{
+        'body': 'Council',
+        'meetings': [{
+            'meeting_reference': 'M-1',
+            'meeting_date': '2024.01.10',
+            'documents': [
+                {'section': '1', 'doc_link': 'https://example.org/a',
+                 'attachments': [{'doc_link': shared_link}]},
+                {'section': '2', 'doc_link': 'https://example.org/b',
+                 'attachments': [{'doc_link': shared_link}]},
+            ],
+        }],
+    }]
+
+
+def test_shared_attachment_resumes_into_its_own_item(tmp_path):
+    shared_link = 'https://example.org/shared'
+    scraped_data = make_scraped_data(shared_link)
+    meeting = scraped_data[0]['meetings'][0]
+    first, second = meeting['documents']
+    first_path = tmp_path / '1' / 'shared.pdf'
+    first_path.parent.mkdir()
+    first_path.write_bytes(b'pdf')
+
+    state = DownloadState(str(tmp_path / 'state.db'))
+    # only the copy of the first item was downloaded before the run was cancelled
+    state.record(shared_link, get_item_key('Council', meeting, first, first['attachments'][0]), str(first_path))
+    state.record(shared_link, get_item_key('Council', meeting, second, second['attachments'][0]), status=FAILED)
+
+    apply_download_state(scraped_data, state)
+    state.close()
+
+    assert first['attachments'][0]['filepath'] == str(first_path)
+    assert 'filepath' not in second['attachments'][0]
+
+
+def test_missing_files_are_not_applied(tmp_path):
+    scraped_data = make_scraped_data('https://example.org/shared')
+    meeting = scraped_data[0]['meetings'][0]
+    document = meeting['documents'][0]
+
+    state = DownloadState(str(tmp_path / 'state.db'))
+    state.record(document['doc_link'], get_item_key('Council', meeting, document), str(tmp_path / 'removed.pdf'))
+    apply_download_state(scraped_data, state)
+    state.close()
+
+    assert 'filepath' not in document
+
+
+def test_url_keyed_database_is_replaced(tmp_path):
+    db_path = str(tmp_path / 'state.db')
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE downloads (url TEXT PRIMARY KEY, filepath TEXT, size INTEGER, "
+                       "sha256 TEXT, status TEXT NOT NULL, updated_at REAL NOT NULL)")
+    connection.execute("INSERT INTO downloads VALUES ('https://example.org/a', 'a.pdf', 3, NULL, 'downloaded', 0)")
+    connection.commit()
+    connection.close()
+
+    state = DownloadState(db_path)
+    assert state.get_filepaths() == {}
+    state.record('https://example.org/a', 'key', 'a.pdf')
+    assert state.get_filepaths() == {('https://example.org/a', 'key'): 'a.pdf'}
+    state.close()
@@ -0,0 +1,246 @@
+import json
+import os
+import random
+import shutil
+
+import fitz
+import pytest
+
+from data_pipeline.blob_store import hash_file
+from data_pipeline.file_converter import (
+    PageCache, TAG_ID_PATTERNS, TagIdStamper, add_ids_to_soup, add_ids_to_tags_, clean_html, convert_files, get_conversion_entry,
+    get_id_texts_path, get_markdown_anchor_texts, get_output_id_mode, html_to_markdown, load_conversion_manifest,
+    load_id_texts)
+from data_pipeline.html_parser import parse_html
+
+
+def get_ids(html):
+    return {tag.get_text(' ', strip=True): tag['id'] for tag in parse_html(add_ids_to_tags_(html, 'content')).find_all('p')}
+
+
+def test_content_ids_are_stable():
+    html = '<div><p>Intro</p><p>Beslut <b>§ 12</b></p><table><tr><td>1</td></tr></table><p>Slut</p></div>'
+    assert add_ids_to_tags_(html, 'content') == add_ids_to_tags_(html, 'content')
+    assert all(TAG_ID_PATTERNS['content'].fullmatch(tag_id) for tag_id in get_ids(html).values())
+
+
+def test_content_ids_survive_inserted_blocks_and_whitespace():
+    before = get_ids('<div><p>Intro</p><p>Beslut</p><p>Slut</p></div>')
+    after = get_ids('<div>\n  <p>Intro</p>\n  <p>Nytt förslag</p>\n  <p>Beslut\n</p>\n  <p>Slut</p>\n</div>')
+    assert {text: after[text] for text in before} == before
+
+
+def test_content_ids_change_with_text_and_path():
+    def get_paragraph_ids(html):
+        return [tag['id'] for tag in parse_html(add_ids_to_tags_(html, 'content')).find_all('p')]
+
+    first, second = get_paragraph_ids('<div><p>Beslut</p></div><section><p>Beslut</p></section>')
+    changed_first, changed_second = get_paragraph_ids('<div><p>Beslut ändrat</p></div><section><p>Beslut</p></section>')
+    # the same text at another path has another id, without a suffix
+    assert first != second and '-' not in second
+    assert changed_first != first and changed_second == second
+
+
+def test_duplicate_blocks_get_suffixes():
+    soup = add_ids_to_soup(parse_html('<p>Bilaga</p><p>Bilaga</p><p>Bilaga</p>'), id_mode='content')
+    first, second, third = [tag['id'] for tag in soup.find_all('p')]
+    assert (second, third) == (f'{first}-2', f'{first}-3')
+
+
+def test_unprepared_tags_get_the_same_ids():
+    html = '<div><ul><li>Ett <i>två</i></li><li>Tre</li></ul></div>'
+    prepared = add_ids_to_soup(parse_html(html), id_mode='content')
+    soup = parse_html(html)
+    stamper = TagIdStamper('content')
+    for tag in soup.find_all(True):
+        stamper.stamp(tag)
+    assert str(soup) == str(prepared)
+
+
+def test_content_ids_of_deeply_nested_documents():
+    depth = 5000
+    soup = parse_html('<div>' * depth + 'Text' + '</div>' * depth)
+    add_ids_to_soup(soup, id_mode='content')
+    assert len({tag['id'] for tag in soup.find_all('div')}) == depth
+
+
+def write_pdf(filepath, text):
+    document = fitz.open()
+    document.new_page().insert_text((72, 72), text)
+    document.save(filepath)
+    document.close()
+
+
+def test_legacy_outputs_are_recorded_in_the_manifest(tmp_path):
+    pdf_path = str(tmp_path / 'Protokoll_100001.pdf')
+    html_path = tmp_path / 'Protokoll_100001.html'
+    manifest_path = str(tmp_path / 'manifest.json')
+    write_pdf(pdf_path, 'Protokoll')
+    # converted before the manifest existed, without ids
+    html_path.write_text('<div><p>Protokoll</p></div>', encoding='utf-8')
+
+    convert_files([pdf_path], manifest_path=manifest_path)
+
+    assert html_path.read_text(encoding='utf-8') == '<div id="1"><p id="2">Protokoll</p></div>'
+    assert load_conversion_manifest(manifest_path) == {
+        os.path.normpath(str(html_path)): get_conversion_entry(hash_file(pdf_path), 'xhtml', True, 'sequential', None)}
+
+    # the recorded output is converted again when its source changes
+    write_pdf(pdf_path, 'Protokoll ändrat')
+    convert_files([pdf_path], manifest_path=manifest_path)
+    assert 'ändrat' in html_path.read_text(encoding='utf-8')
+    assert load_conversion_manifest(manifest_path)[os.path.normpath(str(html_path))]['sha256'] == hash_file(pdf_path)
+
+
+def test_legacy_outputs_with_ids_of_another_mode_are_converted_again(tmp_path):
+    pdf_path = str(tmp_path / 'Protokoll_100001.pdf')
+    html_path = tmp_path / 'Protokoll_100001.html'
+    manifest_path = str(tmp_path / 'manifest.json')
+    write_pdf(pdf_path, 'Protokoll')
+    html_path.write_text('<div id="1"><p id="2">Protokoll</p></div>', encoding='utf-8')
+
+    convert_files([pdf_path], manifest_path=manifest_path, id_mode='content')
+
+    html = html_path.read_text(encoding='utf-8')
+    assert get_output_id_mode(html, 'xhtml') == 'content'
+    assert load_conversion_manifest(manifest_path) == {
+        os.path.normpath(str(html_path)): get_conversion_entry(hash_file(pdf_path), 'xhtml', True, 'content', None)}
+
+    # a legacy output with ids of the requested mode is kept as it is
+    os.remove(manifest_path)
+    html_path.write_text(html.replace('Protokoll', 'Protokoll (kept)'), encoding='utf-8')
+    convert_files([pdf_path], manifest_path=manifest_path, id_mode='content')
+    assert 'Protokoll (kept)' in html_path.read_text(encoding='utf-8')
+    assert os.path.normpath(str(html_path)) in load_conversion_manifest(manifest_path)
+
+
+def test_output_id_modes():
+    assert get_output_id_mode('<div><p>Text</p></div>', 'xhtml') is None
+    assert get_output_id_mode('<div id="1"><p id="a">Text</p></div>', 'xhtml') == 'sequential'
+    assert get_output_id_mode('<div id="0f3a9c21"><p id="5be2c7d0-2">Text</p></div>', 'xhtml') == 'content'
+    assert get_output_id_mode('<div id="page0"><p id="5be2c7d0">Text</p></div>', 'xhtml') == 'content'
+    assert get_output_id_mode('<div id="1"><p>Text</p></div>', 'xhtml') == 'mixed'
+    assert get_output_id_mode('Text {#0f3a9c21}\n', 'markdown') == 'content'
+    assert get_output_id_mode('Text', 'text') is None
+
+
+def clean_html_by_tag(html):
+    # clean_html as it was written with the text of every tag, the reference for the linear version
+    soup = parse_html(html)
+    for tag in soup.find_all():
+        if not tag.text.strip():
+            tag.decompose()
+        else:
+            for attribute in list(tag.attrs):
+                if attribute != 'id':
+                    del tag[attribute]
+    return str(soup)
+
+
+def generate_html(random, depth):
+    if depth == 0 or random.random() < 0.2:
+        return random.choice(['', ' ', '\n ', 'text', '<!-- c -->', '<br>', '<img src=x>', '<style>p { }</style>'])
+    name = random.choice(['div', 'p', 'span', 'b', 'table', 'td', 'pre'])
+    attributes = random.choice(['', ' id="x1"', ' class="c" id="y"', ' style="s"'])
+    children = ''.join(generate_html(random, depth - 1) for _ in range(random.randint(0, 3)))
+    return f'<{name}{attributes}>{children}</{name}>'
+
+
+def test_clean_html_matches_cleaning_tag_by_tag():
+    generator = random.Random(5)
+    for _ in range(1000):
+        html = generate_html(generator, 6) + generate_html(generator, 3)
+        assert clean_html(html) == clean_html_by_tag(html), html
+
+
+def test_clean_html_of_large_documents():
+    html = ('<div>' * 500 + 'x' + '</div>' * 500 +
+            ''.join(f'<div class="a"><p>{i}</p><span></span></div>' for i in range(5000)))
+    assert clean_html(html) == clean_html_by_tag(html)
+
+
+def test_page_cache_evicts_least_recently_used_pages(tmp_path):
+    cache = PageCache(str(tmp_path), max_size=35)
+    for index, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, '0123456789')
+        os.utime(tmp_path / f'{key}.txt', (index, index))
+    assert cache.get('a') == '0123456789'
+    cache.put('d', '0123456789')
+    assert [cache.get(key) is not None for key in 'abcd'] == [True, False, True, True]
+    assert sum(os.path.getsize(path) for path in tmp_path.iterdir()) <= 35
+
+
+def test_page_cache_evicts_pages_written_by_other_processes(tmp_path):
+    for key in 'abc':
+        (tmp_path / f'{key}.txt').write_text('0123456789')
+    PageCache(str(tmp_path), max_size=15).evict()
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.parametrize('output_type', ['xhtml', 'markdown', 'text'])
+def test_parallel_conversion_matches_serial_conversion(tmp_path, output_type):
+    sources = tmp_path / 'sources'
+    sources.mkdir()
+    for index in range(5):
+        document = fitz.open()
+        for page in range(3):
+            document.new_page().insert_text((72, 72), f'Protokoll {index}\n§ {page} Beslut\nJusterat')
+        document.save(str(sources / f'Protokoll_{100001 + index}.pdf'))
+        document.close()
+    # a copy of a document is converted once and written next to both copies
+    shutil.copyfile(sources / 'Protokoll_100001.pdf', sources / 'Bilaga_100001.pdf')
+
+    outputs = {}
+    for max_workers in [1, 2]:
+        directory = tmp_path / str(max_workers)
+        shutil.copytree(sources, directory)
+        manifest_path = str(directory / 'manifest.json')
+        convert_files(sorted(str(path) for path in directory.glob('*.pdf')), output_type=output_type,
+                      max_workers=max_workers, chunksize=1, manifest_path=manifest_path, id_mode='content')
+
+        manifest = {os.path.relpath(path, directory): entry for path, entry in load_conversion_manifest(manifest_path).items()}
+        files = {path.name: path.read_bytes() for path in directory.iterdir() if path.suffix not in ['.pdf', '.json']}
+        outputs[max_workers] = files, manifest
+
+    assert len(outputs[1][0]) == 6
+    assert outputs[2] == outputs[1]
+
+
+def test_markdown_anchors():
+    html = ('<h1 id="1">Protokoll</h1><p id="2">Närvarande <b>ledamöter</b></p>'
+            '<ol id="3"><li id="4">Budget 2024</li><li id="5">Ärenden<ul id="6"><li id="7">Motion</li></ul></li></ol>'
+            '<table id="8"><tr id="9"><th>§</th><th>Rubrik</th></tr><tr id="a"><td>12</td><td>Beslut | Ja</td></tr></table>')
+    markdown = html_to_markdown(html)
+    assert markdown == ('# Protokoll {#1}\n\nNärvarande ledamöter {#2}\n\n1. Budget 2024 {#4}\n\n1. Ärenden {#5}\n\n'
+                        '- Motion {#7}\n\n{#8}\n| {#9} | § | Rubrik |\n| --- | --- | --- |\n| {#a} | 12 | Beslut \\| Ja |\n')
+    assert get_markdown_anchor_texts(markdown) == {
+        '1': 'Protokoll', '2': 'Närvarande ledamöter', '4': 'Budget 2024', '5': 'Ärenden', '7': 'Motion',
+        '8': '§ Rubrik 12 Beslut | Ja', '9': '§ Rubrik', 'a': '12 Beslut | Ja'}
+
+
+def test_markdown_tables_without_ids_have_no_anchors():
+    markdown = html_to_markdown('<table><tr><th>År</th><th>Rubrik</th></tr><tr><td>2023</td><td>Budget</td></tr></table>')
+    assert markdown == '| År | Rubrik |\n| --- | --- |\n| 2023 | Budget |\n'
+    assert get_markdown_anchor_texts(markdown) == {}
+
+
+def test_load_id_texts_caches_by_content(tmp_path):
+    html_path = tmp_path / 'Protokoll_100001.html'
+    html_path.write_text('<div id="1"><p id="2">Beslut</p></div>', encoding='utf-8')
+    assert load_id_texts(str(html_path)) == {'1': 'Beslut', '2': 'Beslut'}
+
+    # the cached texts are used while the document is unchanged
+    cache_path = get_id_texts_path(str(html_path))
+    with open(cache_path, encoding='utf-8') as f:
+        cached = json.load(f)
+    cached['texts']['2'] = 'Cached'
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cached, f)
+    assert load_id_texts(str(html_path))['2'] == 'Cached'
+
+    html_path.write_text('<div id="1"><p id="2">Nytt beslut</p></div>', encoding='utf-8')
+    assert load_id_texts(str(html_path))['2'] == 'Nytt beslut'
+
+    markdown_path = tmp_path / 'Protokoll_100001.md'
+    markdown_path.write_text('# Protokoll {#1}\n\n- Beslut {#2}\n', encoding='utf-8')
+    assert load_id_texts(str(markdown_path)) == {'1': 'Protokoll', '2': 'Beslut'}
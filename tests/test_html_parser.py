@@ -0,0 +1,163 @@
+import random
+
+import pytest
+from bs4 import BeautifulSoup, Comment, Doctype, NavigableString, Tag
+
+from data_pipeline.benchmarks import check_parser_equivalence
+from data_pipeline.html_parser import (
+    CONTAINER_TAGS, KEEP_EMPTY_TAGS, LXML_AVAILABLE, STRUCTURAL_TAGS, STYLE_TAGS, WHITESPACE_PATTERN, compact_html,
+    get_parser_backend, parse_html, unwrap)
+
+# Markup that lxml repairs differently from html.parser
+MALFORMED_MARKUP = [
+    '<p>Paragraph <div>with a block</div> inside</p>',
+    '<ul><li>First item<li>Second item</ul>',
+    '<p>Line one\r\nLine two</p>',
+]
+# Markup like the scraped pages and web HTML documents, which both backends parse alike
+WELL_FORMED_MARKUP = [
+    '<table><caption>Protokoll</caption><tr class="colheader"><th>§</th><th>Rubrik</th></tr>'
+    '<tr><td>1</td><td><a href="/ktproxy2.dll?doctype=3&amp;docid=100001">Titel</a></td></tr></table>',
+    '\n  <h1 style="x">Rubrik</h1><p class="a">Text   <b>100001</b></p><!-- c --><p></p>',
+    '<html><body><div class="paluu">back</div><p>Text</p></body></html>',
+]
+
+
+def test_default_backend_is_html_parser(monkeypatch):
+    monkeypatch.delenv('HTML_PARSER_BACKEND', raising=False)
+    assert get_parser_backend() == 'html.parser'
+
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')
+def test_lxml_is_opt_in(monkeypatch):
+    monkeypatch.setenv('HTML_PARSER_BACKEND', 'lxml')
+    assert get_parser_backend() == 'lxml'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_parser_backend('html5lib')
+
+
+@pytest.mark.parametrize('markup', MALFORMED_MARKUP + WELL_FORMED_MARKUP)
+def test_default_parse_matches_html_parser(monkeypatch, markup):
+    monkeypatch.delenv('HTML_PARSER_BACKEND', raising=False)
+    assert str(parse_html(markup)) == str(BeautifulSoup(markup, 'html.parser'))
+
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')
+@pytest.mark.parametrize('markup', WELL_FORMED_MARKUP)
+def test_lxml_matches_html_parser(markup):
+    assert str(parse_html(markup, 'lxml')) == str(parse_html(markup, 'html.parser'))
+
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')
+@pytest.mark.parametrize('markup', MALFORMED_MARKUP)
+def test_lxml_differs_on_malformed_markup(markup):
+    assert str(parse_html(markup, 'lxml')) != str(parse_html(markup, 'html.parser'))
+
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')
+def test_parser_equivalence_reports_differences(tmp_path):
+    # the stored documents are read with universal newlines, so only the tree differences remain
+    documents = MALFORMED_MARKUP[:2] + WELL_FORMED_MARKUP
+    filepaths = []
+    for index, markup in enumerate(documents):
+        filepath = tmp_path / f'{index}.html'
+        filepath.write_text(markup, encoding='utf-8')
+        filepaths.append(str(filepath))
+
+    differences = check_parser_equivalence(filepaths)
+    assert differences == {'lxml': filepaths[:2]}
+
+
+def compact_html_by_tag(html):
+    # compact_html as it was written with Tag.unwrap and one removal at a time, the reference for the linear version
+    soup = BeautifulSoup(html, 'html.parser')
+    for string in soup.find_all(string=True):
+        if isinstance(string, Comment):
+            string.extract()
+        elif (type(string) is NavigableString and string.find_parent('pre') is None
+              and WHITESPACE_PATTERN.search(string)):
+            string.replace_with(WHITESPACE_PATTERN.sub(' ', string))
+    for tag in reversed(soup.find_all(True)):
+        tag.attrs = {'id': tag['id']} if 'id' in tag.attrs else {}
+        children = [child for child in tag.contents if isinstance(child, Tag) or child.strip()]
+        if not children and tag.name not in KEEP_EMPTY_TAGS:
+            tag.decompose()
+        elif tag.name in STYLE_TAGS and 'id' not in tag.attrs:
+            tag.unwrap()
+        elif (tag.name in CONTAINER_TAGS and len(children) == 1 and isinstance(children[0], Tag)
+              and ('id' not in tag.attrs or 'id' in children[0].attrs)):
+            tag.unwrap()
+    for string in soup.find_all(string=True):
+        if string == ' ' and string.find_parent('pre') is None:
+            siblings = [string.previous_sibling, string.next_sibling]
+            if any(sibling is None or (isinstance(sibling, Tag) and sibling.name in STRUCTURAL_TAGS) for sibling in siblings):
+                string.extract()
+    return str(soup)
+
+
+def generate_html(random, depth):
+    if depth == 0 or random.random() < 0.25:
+        return random.choice(['', ' ', '  \n ', 'text', ' a  b ', '<!-- c -->', '<br>', '<img src=x>', '<style>p { }</style>'])
+    name = random.choice(['div', 'p', 'span', 'font', 'b', 'code', 'table', 'tr', 'td', 'pre', 'section', 'li', 'h1'])
+    attributes = random.choice(['', ' id="a1"', ' class="c" id="b2"', ' style="s"'])
+    children = ''.join(generate_html(random, depth - 1) for _ in range(random.randint(0, 4)))
+    return f'<{name}{attributes}>{children}</{name}>'
+
+
+def test_compact_html():
+    html = ('<div class="page"><div id="1"><p id="2" style="x">Beslut  <span class="s">§ 12</span></p></div>'
+            '<!-- comment --><p id="3"></p>\n<table id="4"><tr id="5"><td id="6"></td><td id="7">Ja</td></tr></table></div>')
+    assert compact_html(html) == ('<div><p id="2">Beslut § 12</p>'
+                                  '<table id="4"><tr id="5"><td id="6"></td><td id="7">Ja</td></tr></table></div>')
+
+
+def test_compact_html_keeps_preformatted_text():
+    html = '<div><pre><code>def f():\n    return  1</code>\n<b> x </b> <p>y</p></pre><p>a   b</p></div>'
+    assert compact_html(html) == '<div><pre><code>def f():\n    return  1</code>\n<b> x </b> <p>y</p></pre><p>a b</p></div>'
+
+
+def test_compact_html_keeps_declarations():
+    html = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN">\n<p>Text</p><![CDATA[a  b]]>'
+    compacted = compact_html(html)
+    assert compacted == '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN">\n<p>Text</p><![CDATA[a  b]]>'
+    assert isinstance(parse_html(compacted).contents[0], Doctype)
+
+
+def test_compact_html_matches_unwrapping_tag_by_tag():
+    generator = random.Random(17)
+    for _ in range(500):
+        html = ' ' + generate_html(generator, 6) + '\n' + generate_html(generator, 4)
+        assert compact_html(html) == compact_html_by_tag(html), html
+
+
+def test_compact_html_of_wide_documents():
+    # quadratic in the number of children when the tags are unwrapped one by one, which takes minutes here
+    html = '<div>' + '<span>a</span> <!-- c --> <p>b</p>\n' * 10000 + '</div>'
+    assert compact_html(html) == '<div>' + 'a <p>b</p>' * 10000 + '</div>'
+
+
+def test_unwrap_matches_tag_unwrap():
+    generator = random.Random(23)
+    for _ in range(300):
+        html = '<body>' + generate_html(generator, 5) + '</body>'
+        expected, soup = BeautifulSoup(html, 'html.parser'), BeautifulSoup(html, 'html.parser')
+        for reference, tag in zip(expected.find_all(True)[1::3], soup.find_all(True)[1::3]):
+            reference.unwrap()
+            unwrap(tag)
+        assert str(soup) == str(expected), html
+
+
+def test_unwrap_of_wide_tags():
+    soup = BeautifulSoup('<div><section>' + '<p>a</p> ' * 20000 + '</section></div>', 'html.parser')
+    unwrap(soup.section)
+    assert str(soup) == '<div>' + '<p>a</p> ' * 20000 + '</div>'
+    assert all(child.parent is soup.div for child in soup.div.contents)
+
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')
+def test_lxml_parse_of_wide_fragments():
+    html = '<p>a</p>\n' * 20000
+    assert str(parse_html(html, 'lxml')) == str(parse_html(html, 'html.parser'))
@@ -0,0 +1,61 @@
+import io
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from data_pipeline.http_archive import HTTPArchive, mount_archive
+from data_pipeline.http_client import create_session
+
+URL = 'https://example.org/ktproxy2.dll?doctype=3&docid=100001'
+CONTENT = b'%PDF-1.4 Protokoll'
+
+
+def send_archived_response(adapter, request, **kwargs):
+    # the network response of the recording, built like HTTPAdapter.build_response does
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers = CaseInsensitiveDict({'Content-Disposition': 'attachment; filename=Protokoll_100001.pdf'})
+    response.raw = io.BytesIO(CONTENT)
+    response.url = request.url
+    response.request = request
+    response.connection = adapter
+    return response
+
+
+def refuse_network(adapter, request, **kwargs):
+    raise AssertionError(f"{request.url} was sent over the network")
+
+
+def test_records_and_replays_responses(monkeypatch, tmp_path):
+    monkeypatch.setattr(HTTPAdapter, 'send', send_archived_response)
+    session = create_session()
+    mount_archive(session, str(tmp_path), 'record')
+    assert session.get(URL).content == CONTENT
+
+    monkeypatch.setattr(HTTPAdapter, 'send', refuse_network)
+    session = create_session()
+    mount_archive(session, str(tmp_path), 'replay')
+    response = session.get(URL)
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers['Content-Disposition'] == 'attachment; filename=Protokoll_100001.pdf'
+    assert len(HTTPArchive(str(tmp_path)).load()) == 1
+
+
+def test_replay_miss_raises(monkeypatch, tmp_path):
+    monkeypatch.setattr(HTTPAdapter, 'send', send_archived_response)
+    session = create_session()
+    mount_archive(session, str(tmp_path), 'record')
+    session.get(URL)
+
+    monkeypatch.setattr(HTTPAdapter, 'send', refuse_network)
+    session = create_session()
+    mount_archive(session, str(tmp_path), 'replay')
+    with pytest.raises(requests.ConnectionError):
+        session.get(URL.replace('100001', '100002'))
+    # range requests are archived separately from the full body
+    with pytest.raises(requests.ConnectionError):
+        session.get(URL, headers={'Range': 'bytes=100-'})
@@ -0,0 +1,111 @@
+import http.server
+import json
+import os
+import socketserver
+import threading
+
+import pytest
+import requests
+
+from data_pipeline.http_client import HTTPCache, HTTPClient
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+
+class PageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = PageServer(('127.0.0.1', 0), PageHandler)
+    server.content = '<html><body><p>Protokoll</p></body></html>'.encode('utf-8')
+    server.etag = '"v1"'
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/ktproxy2.dll?doctype=1&docid=100001'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_serves_prepopulated_cache_offline(tmp_path):
+    # nothing listens on the discard port, any network request would fail
+    url = 'http://127.0.0.1:9/ktproxy2.dll?doctype=1&docid=100001'
+    cache = HTTPCache(str(tmp_path))
+    cache.put(url, b'<p>Protokoll</p>', headers={'Content-Type': 'text/html; charset=utf-8'})
+    client = HTTPClient(cache=cache, offline=True)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.text == '<p>Protokoll</p>'
+    assert response.from_cache
+    with pytest.raises(requests.ConnectionError):
+        client.get('http://127.0.0.1:9/ktproxy2.dll?doctype=1&docid=100002')
+
+
+def test_revalidates_with_etag(server, tmp_path):
+    cache = HTTPCache(str(tmp_path))
+    client = HTTPClient(cache=cache)
+    assert client.get(server.url).content == server.content
+    stored_at = cache.get(server.url)[0]['stored_at']
+
+    # not modified, the cached body is served and the entry is marked as revalidated
+    response = client.get(server.url)
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+    assert response.from_cache and response.content == server.content
+    assert cache.get(server.url)[0]['stored_at'] >= stored_at
+
+    # modified, the new body replaces the cached one
+    server.content, server.etag = b'<p>Protokoll, justerat</p>', '"v2"'
+    response = client.get(server.url)
+    assert not getattr(response, 'from_cache', False)
+    assert response.content == b'<p>Protokoll, justerat</p>'
+    meta, content = cache.get(server.url)
+    assert content == b'<p>Protokoll, justerat</p>' and meta['etag'] == '"v2"'
+
+
+def test_fresh_responses_are_not_revalidated(server, tmp_path):
+    client = HTTPClient(cache=HTTPCache(str(tmp_path)), max_age=60)
+    client.get(server.url)
+    response = client.get(server.url)
+    assert response.from_cache
+    assert len(server.requests) == 1
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = HTTPCache(str(tmp_path), max_size=35)
+    urls = [f'http://127.0.0.1:9/page{index}' for index in range(4)]
+    for index, url in enumerate(urls[:3]):
+        cache.put(url, b'0123456789')
+        body_path = cache._get_paths(url, 'GET')[0]
+        os.utime(body_path, (index, index))
+    # reading the oldest entry makes the second one the least recently used
+    assert cache.get(urls[0])[1] == b'0123456789'
+    cache.put(urls[3], b'0123456789')
+
+    assert [cache.get(url) is not None for url in urls] == [True, False, True, True]
+    assert not os.path.exists(cache._get_paths(urls[1], 'GET')[1])
+    assert sum(os.path.getsize(path) for path in tmp_path.glob('*.body')) <= 35
+    assert all(json.loads(path.read_text(encoding='utf-8'))['url'] in urls for path in tmp_path.glob('*.json'))
@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pandas as pd
+
+from data_pipeline import meeting_data_extractor
+from data_pipeline.meeting_data_extractor import expand_batch_output, get_duplicates_path, update_json_with_ids
+
+
+def test_expand_batch_output_streams_copies_for_duplicates(tmp_path):
+    batch_file_path = str(tmp_path / 'agenda_batch.jsonl')
+    with open(get_duplicates_path(batch_file_path), 'w', encoding='utf-8') as f:
+        json.dump({'100001': ['100002', '100003']}, f)
+    lines = iter(['{"custom_id": "100001", "response": {}}\n', 'not json\n', '\n', '{"custom_id": "100004"}'])
+
+    expanded = expand_batch_output(lines, batch_file_path)
+
+    assert next(expanded) == '{"custom_id": "100001", "response": {}}\n'
+    assert [json.loads(line)['custom_id'] for line in [next(expanded), next(expanded)]] == ['100002', '100003']
+    assert list(expanded) == ['not json\n', '{"custom_id": "100004"}\n']
+
+
+def test_expand_batch_output_without_duplicates():
+    assert list(expand_batch_output('{"custom_id": "1"}\n{"custom_id": "2"}', None)) == [
+        '{"custom_id": "1"}\n', '{"custom_id": "2"}\n']
+
+
+def test_batch_output_is_saved_with_bounded_concurrency(monkeypatch, tmp_path):
+    custom_ids = [str(100000 + i) for i in range(100)]
+    df = pd.DataFrame({'filepath': [f'protocols/Protokoll_{custom_id}.pdf' for custom_id in custom_ids],
+                       'doc_link': custom_ids})
+    read_count = 0
+    max_read_ahead = 0
+    saved = []
+
+    def retrieve_batch_output(output_file_id):
+        nonlocal read_count
+        for custom_id in custom_ids:
+            read_count += 1
+            body = {'choices': [{'message': {'content': json.dumps({'id': custom_id})}}]}
+            yield json.dumps({'custom_id': custom_id, 'response': {'status_code': 200, 'body': body}})
+
+    async def combine_and_save_data(response_json, filepath, df, original_df, type, index=None, attachments=None):
+        nonlocal max_read_ahead
+        max_read_ahead = max(max_read_ahead, read_count - len(saved))
+        await asyncio.sleep(0.001)
+        saved.append(response_json['id'])
+
+    monkeypatch.setattr(meeting_data_extractor, 'retrieve_batch_output', retrieve_batch_output)
+    monkeypatch.setattr(meeting_data_extractor, 'combine_and_save_data', combine_and_save_data)
+    monkeypatch.setattr(meeting_data_extractor, 'get_documents_dataframe', lambda: df.assign(parent_link=''))
+    monkeypatch.setenv('METADATA_BATCH_FILE_PATH', str(tmp_path / 'metadata_batch.jsonl'))
+
+    asyncio.run(meeting_data_extractor.extract_meeting_data_batch_from_output('file-1', df, 'metadata', max_workers=4))
+
+    assert sorted(saved) == custom_ids
+    # the results being saved and the one waiting for a free slot
+    assert max_read_ahead <= 4 + 1
+    assert not (tmp_path / 'metadata_batch_errors.jsonl').exists()
+
+
+def test_unresolved_content_ids_are_reported():
+    texts = {'0f3a9c21': 'Budget 2024', '5be2c7d0-2': 'Beslut'}
+    unresolved_ids = []
+    result = update_json_with_ids({
+        'title': '0f3a9c21',
+        'decision': '5be2c7d0-2, 77aa00ff',
+        'items': [{'year': '2023'}, {'section': '12'}, {'word': 'add'}, {'note': 'bed, 77aa00ff'}],
+        'made_up': ['9999abcd'],
+    }, texts.get, unresolved_ids=unresolved_ids, id_mode='content')
+
+    assert result['title'] == 'Budget 2024'
+    assert result['decision'] == 'Beslut 77aa00ff'
+    assert result['items'] == [{'year': '2023'}, {'section': '12'}, {'word': 'add'}, {'note': 'bed 77aa00ff'}]
+    # ordinary values are not content ids, and an unresolved id is listed once
+    assert unresolved_ids == ['77aa00ff', '9999abcd']
+
+
+def test_unresolved_sequential_ids_are_reported():
+    unresolved_ids = []
+    update_json_with_ids({'a': '1, 2f', 'b': '0f3a9c21-2', 'c': '012', 'd': 'Budget'},
+                         {'1': 'Protokoll'}.get, unresolved_ids=unresolved_ids, id_mode='sequential')
+    assert unresolved_ids == ['2f']
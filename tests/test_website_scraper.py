@@ -0,0 +1,129 @@
+import functools
+import json
+import time
+import zlib
+
+import pytest
+
+from data_pipeline import website_scraper
+from data_pipeline.html_parser import parse_html
+from data_pipeline.website_scraper import crawl_table, merge_scraped_data, scrape_table, truncate_scrape_journal
+
+
+def make_meeting(reference, date, documents):
+    return {'meeting_reference': reference, 'meeting_date': date, 'documents': documents}
+
+
+def make_document(section, link, attachments=()):
+    return {'section': section, 'doc_link': link, 'attachments': [{'doc_link': a} for a in attachments]}
+
+
+def test_filepaths_are_carried_over_by_item():
+    existing_document = make_document('1', 'https://example.org/a', ['https://example.org/shared'])
+    existing_document['filepath'] = 'council/1/a.pdf'
+    existing_document['attachments'][0]['filepath'] = 'council/1/shared.pdf'
+    existing_data = [{'body': 'Council', 'meetings': [make_meeting('M-1', '2024.01.10', [existing_document])]}]
+
+    new_data = [{'body': 'Council', 'meetings': [
+        make_meeting('M-1', '2024.01.10', [
+            make_document('1', 'https://example.org/a', ['https://example.org/shared']),
+            # the same attachment under another agenda item has its own file
+            make_document('2', 'https://example.org/b', ['https://example.org/shared']),
+        ]),
+        # the same document in another meeting has its own file
+        make_meeting('M-2', '2024.02.14', [make_document('1', 'https://example.org/a')]),
+    ]}]
+
+    merged = merge_scraped_data(existing_data, new_data)
+    first_meeting, second_meeting = merged[0]['meetings']
+    first, second = first_meeting['documents']
+
+    assert first['filepath'] == 'council/1/a.pdf'
+    assert first['attachments'][0]['filepath'] == 'council/1/shared.pdf'
+    assert 'filepath' not in second['attachments'][0]
+    assert 'filepath' not in second_meeting['documents'][0]
+
+
+BASE_URL = 'http://example.org'
+MEETING_COUNT = 4
+PAGES = {'/index.htm': (
+    '<html><body><table><caption>Sammanträden</caption>'
+    '<tr class="colheader"><th>Verksamhetsorgan</th><th>Datum</th></tr>'
+    + ''.join(f'<tr><td>Stadsstyrelsen: {m + 1}/2024</td><td><a href="/k?id={m}">{m + 1}.2.2024 18:00</a></td></tr>'
+              for m in range(MEETING_COUNT))
+    + '</table></body></html>')}
+for m in range(MEETING_COUNT):
+    PAGES[f'/k?id={m}'] = (
+        '<table><caption>Protokoll</caption><tr class="colheader"><th>§</th><th>Rubrik</th><th>Bilagor</th></tr>'
+        f'<tr><td>1</td><td><a href="/ktproxy2.dll?doctype=3&docid={100000 + m}">Titel {m}</a></td>'
+        f'<td><a href="/b?bid={m}">Bilagor</a></td></tr>'
+        f'<tr><td>2</td><td><a href="/ktproxy2.dll?doctype=3&docid={200000 + m}">Beslut {m}</a></td><td>-</td></tr>'
+        '</table>')
+    PAGES[f'/b?bid={m}'] = (
+        '<table><caption>Bilagor</caption>'
+        + ''.join(f'<tr><td><a href="/ktproxy2.dll?doctype=3&docid={300000 + 10 * m + a}">Bilaga {a}</a></td></tr>'
+                  for a in range(2))
+        + '</table>')
+
+
+def fetch_page(url, fail_on=None, client=None):
+    path = url[len(BASE_URL):]
+    # pages take different times, so that concurrent fetches complete out of order
+    time.sleep(zlib.crc32(path.encode('utf-8')) % 5 / 200)
+    if path == fail_on:
+        # the other meetings are completed before the crawl fails
+        time.sleep(0.3)
+        raise RuntimeError('Connection lost')
+    return parse_html(PAGES[path])
+
+
+def scrape(monkeypatch, tmp_path, fail_on=None, concurrent=False):
+    monkeypatch.setattr(website_scraper, 'fetch_and_parse', functools.partial(fetch_page, fail_on=fail_on))
+    monkeypatch.setenv('DATA_PATH', str(tmp_path))
+    monkeypatch.setenv('SCRAPING_START_URL', BASE_URL + '/index.htm')
+    monkeypatch.setenv('SCRAPED_DATA_FILE_PATH', str(tmp_path / 'scraped.json'))
+    website_scraper.main(concurrent=concurrent)
+    with open(tmp_path / 'scraped.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_crawl_table_matches_scrape_table(monkeypatch, tmp_path, concurrent):
+    monkeypatch.setattr(website_scraper, 'fetch_and_parse', fetch_page)
+    table = parse_html(PAGES['/index.htm']).find('table')
+    data = crawl_table(table, BASE_URL) if concurrent else scrape_table(table, BASE_URL)
+    assert json.dumps(data) == json.dumps(scrape_table(table, BASE_URL))
+    assert len(data) == MEETING_COUNT and data[0]['Datum'][0]['nested_data'][0]['Bilagor'][0]['nested_data']
+
+
+def test_concurrent_scrape_matches_serial_scrape(monkeypatch, tmp_path):
+    expected = scrape(monkeypatch, tmp_path / 'serial')
+    assert json.dumps(scrape(monkeypatch, tmp_path / 'concurrent', concurrent=True)) == json.dumps(expected)
+    assert sum(len(meeting['documents']) for meeting in expected[0]['meetings']) == 2 * MEETING_COUNT
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_resume_from_journal_with_cut_off_line(monkeypatch, tmp_path, concurrent):
+    expected = scrape(monkeypatch, tmp_path / 'full')
+
+    with pytest.raises(RuntimeError):
+        scrape(monkeypatch, tmp_path, fail_on=f'/k?id={MEETING_COUNT - 1}', concurrent=concurrent)
+    journal_path = tmp_path / 'scraped_journal.jsonl'
+    lines = journal_path.read_text(encoding='utf-8').splitlines(keepends=True)
+    assert len(lines) == MEETING_COUNT - 1
+    # the crash cut off the record of the last meeting
+    journal_path.write_text(''.join(lines[:-1]) + lines[-1][:len(lines[-1]) // 2], encoding='utf-8')
+
+    assert scrape(monkeypatch, tmp_path, concurrent=concurrent) == expected
+    assert not journal_path.exists()
+
+
+def test_truncate_scrape_journal(tmp_path):
+    journal_path = tmp_path / 'journal.jsonl'
+    journal_path.write_text('{"a": 1}\n' + 'x' * 10000, encoding='utf-8')
+    truncate_scrape_journal(str(journal_path))
+    assert journal_path.read_text(encoding='utf-8') == '{"a": 1}\n'
+
+    journal_path.write_text('{"a": 1', encoding='utf-8')
+    truncate_scrape_journal(str(journal_path))
+    assert journal_path.read_text(encoding='utf-8') == ''